@@ -1,35 +1,155 @@
 import asyncio
 import json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 
 # import your existing function
-from src.core.rag_controller import rag_inference   # adjust path if different
+from src.core.rag_controller import DEFAULT_PATIENT_ID, answer_cache, arag_inference, arag_inference_stream, pipeline_stats, sessions   # adjust path if different
+from src.drug_lookup import db as drug_db
+from src.drug_lookup.rxnorm_index import RXNORM_MAP_ENABLED, get_index as get_rxnorm_index
+from src.llm.model_runner import get_client as get_llm_client
+from src.llm.scheduler import SchedulerBusy
+from src.core.fast_router import get_fast_router
+from src.core.prompt_router import router_cache
+from src.fhir.client import get_bundle_cache
+from src.core.summary_store import summary_store
+from src.core.memory import DEFAULT_SESSION_ID, SESSION_ID_MAX_LEN
+from src.drug_lookup.label_retriever import get_retriever
 
-app = FastAPI()
+def warm_caches():
+    get_fast_router()
+    get_retriever()
+    if RXNORM_MAP_ENABLED:
+        try:
+            get_rxnorm_index().load()
+        except FileNotFoundError as e:
+            # no drug DB yet; lookups will load the map once it exists
+            print(f"[startup] RxNorm map not loaded: {e}")
+    try:
+        summary_store.warm([DEFAULT_PATIENT_ID])
+    except FileNotFoundError as e:
+        print(f"[startup] Patient summaries not warmed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_caches()
+    yield
+    await get_llm_client().aclose()
+    get_llm_client().close()
+    answer_cache.close()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/health")
 def health():
     return PlainTextResponse("ok")
 
-async def run_rag_async(prompt: str):
-    # rag_inference is sync -> offload to thread pool
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, rag_inference, prompt)
+@app.get("/metrics")
+def metrics():
+    return {
+        "drug_db": drug_db.stats(),
+        "rxnorm_map": get_rxnorm_index().stats(),
+        "llm": get_llm_client().stats(),
+        "fast_router": get_fast_router().stats() if get_fast_router() else None,
+        "router_cache": router_cache.stats(),
+        "fhir_cache": get_bundle_cache().stats(),
+        "fhir_summaries": summary_store.stats(),
+        "sessions": sessions.stats(),
+        "label_retriever": get_retriever().stats() if get_retriever() else None,
+        "pipeline": pipeline_stats.stats(),
+        "answer_cache": answer_cache.stats(),
+    }
+
+KEEPALIVE_SECONDS = 10
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+def stream_format(payload: dict, accept: str):
+    """
+    Pick a token-streaming format from the payload ("stream": "ndjson" | "sse" | true)
+    or the Accept header; None keeps the original plain-text response.
+    """
+    requested = payload.get("stream")
+    if requested is True:
+        return "ndjson"
+    if isinstance(requested, str) and requested.lower() in STREAM_MEDIA_TYPES:
+        return requested.lower()
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return None
+
+def encode_event(event: dict, fmt: str) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {event['event']}\ndata: {data}\n\n"
+    return data + "\n"
+
+def session_id_for(payload: dict, headers) -> str:
+    """
+    Conversation id from the body ("session_id") or the X-Session-Id header.
+    Raises ValueError if it is longer than SESSION_ID_MAX_LEN.
+    """
+    session_id = str(payload.get("session_id") or headers.get("x-session-id") or DEFAULT_SESSION_ID)
+    if len(session_id) > SESSION_ID_MAX_LEN:
+        raise ValueError(f"session_id is longer than {SESSION_ID_MAX_LEN} characters")
+    return session_id
+
+def busy_response(status: int, retry_after: int, message: str) -> JSONResponse:
+    return JSONResponse(
+        {"error": message, "retry_after": retry_after},
+        status_code=status,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+async def event_streamer(prompt: str, fmt: str, session_id: str):
+    try:
+        async for event in arag_inference_stream(prompt, session_id):
+            yield encode_event(event, fmt)
+    except SchedulerBusy as e:
+        yield encode_event({"event": "error", "error": str(e), "status": e.status, "retry_after": e.retry_after}, fmt)
+    except Exception as e:
+        yield encode_event({"event": "error", "error": repr(e)}, fmt)
 
 @app.post("/ask")
 async def ask(req: Request):
     payload = await req.json()
     prompt = payload.get("prompt", "")
+    try:
+        session_id = session_id_for(payload, req.headers)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    headers = {"X-Session-Id": session_id}
+
+    # fail fast instead of queueing behind a saturated model
+    scheduler = get_llm_client().scheduler
+    if scheduler.saturated():
+        return busy_response(429, scheduler.retry_after(), "LLM queue is full")
+
+    fmt = stream_format(payload, req.headers.get("accept", ""))
+    if fmt:
+        return StreamingResponse(
+            event_streamer(prompt, fmt, session_id),
+            media_type=STREAM_MEDIA_TYPES[fmt],
+            headers=headers,
+        )
 
-    task = asyncio.create_task(run_rag_async(prompt))
+    task = asyncio.create_task(arag_inference(prompt, session_id))
 
     async def streamer():
         # send something immediately
         yield "starting...\n"
         tick = 0
         while not task.done():
-            await asyncio.sleep(10)
+            # wake up as soon as the task finishes, or every KEEPALIVE_SECONDS
+            await asyncio.wait({task}, timeout=KEEPALIVE_SECONDS)
+            if task.done():
+                break
             tick += 1
             # keep-alive byte(s)
             yield f"--- keepalive {tick} ---\n"
@@ -47,4 +167,4 @@ async def ask(req: Request):
         else:
             yield str(result) + "\n"
 
-    return StreamingResponse(streamer(), media_type="text/plain")
+    return StreamingResponse(streamer(), media_type="text/plain", headers=headers)
@@ -0,0 +1,205 @@
+# src/core/answer_cache.py
+
+"""
+answer_cache.py
+
+Opt-in cache of full generated answers (ANSWER_CACHE_ENABLED=1).
+
+An answer is reused only when everything that went into generating it is
+unchanged, so the key is a hash of:
+
+  - the normalized prompt (same folding as the router cache) and the route,
+  - the exact retrieved_data handed to the model (patient summaries, label
+    sections, drug facts), which changes whenever the patient's bundle does,
+  - whether Sally introduces herself,
+  - the model name and the prompt template version,
+  - the drug database build version stamped by the ETL.
+
+Nothing has to be invalidated explicitly: a changed bundle or drug DB gives
+new keys, and the old entries age out.
+
+The in-memory tier is an LRU bounded by entry count and by the bytes of
+cached text, with a TTL. With ANSWER_CACHE_DB set, entries are also written
+to a SQLite table and memory misses fall through to it, so answers survive
+a restart.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from src.core.router_cache import normalize_prompt
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "0") not in ("0", "false", "no")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_DB = os.getenv("ANSWER_CACHE_DB", "")
+
+
+def answer_key(
+    prompt: str,
+    route: Dict[str, Any],
+    retrieved_data: str,
+    show_intro: bool,
+    model: str,
+    template_version: str,
+    drug_db_version: Optional[str],
+) -> str:
+    parts = [
+        normalize_prompt(prompt),
+        json.dumps(route, sort_keys=True, ensure_ascii=False),
+        hashlib.sha1(retrieved_data.encode("utf-8")).hexdigest(),
+        "intro" if show_intro else "",
+        model,
+        template_version,
+        drug_db_version or "",
+    ]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        enabled: bool = ANSWER_CACHE_ENABLED,
+        maxsize: int = ANSWER_CACHE_SIZE,
+        max_bytes: int = ANSWER_CACHE_MAX_BYTES,
+        ttl: float = ANSWER_CACHE_TTL,
+        db_path: str = ANSWER_CACHE_DB,
+    ):
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+
+        # key -> (answer, expires_at as wall-clock time, size in bytes)
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    # ---------- SQLite tier (caller holds the lock) ----------
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                answer TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID""")
+            conn.execute("DELETE FROM answers WHERE expires_at <= ?", (time.time(),))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    # ---------- memory tier (caller holds the lock) ----------
+
+    def _drop(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _remember(self, key: str, answer: str, expires_at: float) -> None:
+        if key in self._entries:
+            self._drop(key)
+        size = len(key) + len(answer.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (answer, expires_at, size)
+        self._bytes += size
+        while len(self._entries) > self.maxsize or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self._evictions += 1
+
+    # ---------- public API ----------
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[0]
+                self._drop(key)
+                self._expirations += 1
+
+            conn = self._db()
+            if conn is not None:
+                row = conn.execute(
+                    "SELECT answer, expires_at FROM answers WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0], row[1])
+                    self._disk_hits += 1
+                    return row[0]
+
+            self._misses += 1
+            return None
+
+    def put(self, key: str, answer: str) -> None:
+        if not self.enabled or not answer:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, answer, expires_at)
+            conn = self._db()
+            if conn is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, expires_at) VALUES (?, ?, ?)",
+                    (key, answer, expires_at),
+                )
+                conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            conn = self._db()
+            if conn is not None:
+                conn.execute("DELETE FROM answers")
+                conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "maxsize": self.maxsize,
+                "max_bytes": self.max_bytes,
+                "persistent": bool(self.db_path),
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._disk_hits) / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
@@ -0,0 +1,211 @@
+# src/core/context_builder.py
+
+"""
+context_builder.py
+
+Assembles retrieved_data for the LLM under a token budget.
+
+The context is made of blocks (one per requested category, then drug facts,
+then label sections), each a list of items: summary lines, or one passage
+per drug / label section. Items are ranked within their block (latest
+observations and conditions first, active medications before stopped ones)
+and packed greedily:
+
+  1. the top item of every block, so each requested category is represented;
+  2. then the remaining items, block by block in the order they were added.
+
+Items over CONTEXT_MAX_ITEM_TOKENS are truncated; items that no longer fit
+are dropped, and a short note in the block (always budgeted for) tells the
+model that some were left out. The result reports what was kept, dropped and truncated.
+
+Tokens are counted with a local estimator (runs of up to four word
+characters, punctuation marks and newlines each count as one), which tracks
+BPE tokenizers closely enough for budgeting and is additive, so the packed
+text never exceeds the budget by the estimator's measure.
+"""
+
+import os
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Set
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_ITEM_TOKENS = int(os.getenv("CONTEXT_MAX_ITEM_TOKENS", "400"))
+
+_TOKEN = re.compile(r"\w{1,4}|[^\w\s]|\n")
+_DATED = re.compile(r"^(\d{4}(?:-\d{2}){0,2}(?:T[\d:.+\-Z]*)?): ")
+_STATUS = re.compile(r"\(status: ([\w-]+)\)")
+
+BLOCK_SEP = "\n\n"
+ELLIPSIS = " …"
+
+# FHIR MedicationStatement.status, most relevant first
+MEDICATION_STATUS_ORDER = {
+    "active": 0,
+    "intended": 1,
+    "on-hold": 2,
+    "unknown": 3,
+    "not-taken": 4,
+    "completed": 5,
+    "stopped": 6,
+    "entered-in-error": 7,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(_TOKEN.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """`text` cut after its first max_tokens tokens (plus an ellipsis)."""
+    if max_tokens <= 0:
+        return ""
+    for i, m in enumerate(_TOKEN.finditer(text)):
+        if i == max_tokens:
+            return text[:m.start()].rstrip() + ELLIPSIS
+    return text
+
+
+# ---------- rankers ----------
+
+def latest_first(lines: Sequence[str]) -> List[str]:
+    """Lines starting with "<ISO date>: " newest first; undated lines last, in order."""
+    dated = [(m.group(1), i) for i, line in enumerate(lines) for m in [_DATED.match(line)] if m]
+    dated_idx = {i for _, i in dated}
+    order = [i for _, i in sorted(dated, key=lambda d: d[0], reverse=True)]
+    order += [i for i in range(len(lines)) if i not in dated_idx]
+    return [lines[i] for i in order]
+
+
+def active_first(lines: Sequence[str]) -> List[str]:
+    def rank(line: str) -> int:
+        m = _STATUS.search(line)
+        return MEDICATION_STATUS_ORDER.get(m.group(1), 3) if m else 3
+    return sorted(lines, key=rank)
+
+
+CATEGORY_RANKERS: Dict[str, Callable[[Sequence[str]], List[str]]] = {
+    "observations": latest_first,
+    "conditions": latest_first,
+    "currentMedications": active_first,
+}
+
+
+# ---------- packing ----------
+
+class ContextResult(NamedTuple):
+    text: str
+    tokens: int
+    budget: int
+    kept: Dict[str, int]
+    dropped: Dict[str, int]
+    truncated: int
+    kept_keys: Set[str]
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "tokens": self.tokens,
+            "budget": self.budget,
+            "dropped": {name: n for name, n in self.dropped.items() if n},
+            "truncated": self.truncated,
+        }
+
+
+class _Block:
+    def __init__(self, name: str, items: List[str], keys: List[Optional[str]], title: str, sep: str):
+        self.name = name
+        self.items = items
+        self.keys = keys
+        self.title = title
+        self.sep = sep
+        self.kept: List[int] = []
+
+
+def _omitted_note(name: str, n: int) -> str:
+    return f"({n} more {name} entries omitted)"
+
+
+class ContextBuilder:
+    def __init__(self, budget: Optional[int] = None, max_item_tokens: Optional[int] = None):
+        self.budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+        self.max_item_tokens = CONTEXT_MAX_ITEM_TOKENS if max_item_tokens is None else max_item_tokens
+        self._blocks: List[_Block] = []
+
+    def add(
+        self,
+        name: str,
+        items: Sequence[str],
+        title: str = "",
+        sep: str = "\n",
+        keys: Optional[Sequence[Optional[str]]] = None,
+    ) -> None:
+        """
+        Add a block of items, most relevant first. `keys` (aligned with
+        items) are reported back in ContextResult.kept_keys for kept items.
+        """
+        if keys is None:
+            keys = [None] * len(items)
+        # drop empty items together with their keys so the two stay aligned
+        pairs = [(item, key) for item, key in zip(items, keys) if item]
+        if not pairs:
+            return
+        self._blocks.append(_Block(name, [item for item, _ in pairs], [key for _, key in pairs], title, sep))
+
+    def add_category(self, category: str, summary: str) -> None:
+        """A category summary, one item per line, ranked for that category."""
+        lines = summary.splitlines()
+        self.add(category, CATEGORY_RANKERS.get(category, list)(lines))
+
+    def build(self, empty: str = "No data found.") -> ContextResult:
+        truncated = 0
+        costs: List[List[int]] = []
+        for block in self._blocks:
+            block_costs = []
+            for i, item in enumerate(block.items):
+                if estimate_tokens(item) > self.max_item_tokens:
+                    block.items[i] = truncate_tokens(item, self.max_item_tokens)
+                    truncated += 1
+                block_costs.append(estimate_tokens(block.items[i]))
+            costs.append(block_costs)
+
+        # Room for an omission note in every block and the separators between blocks
+        sep_tokens = estimate_tokens(BLOCK_SEP)
+        reserve = sum(
+            estimate_tokens(_omitted_note(b.name, len(b.items))) + estimate_tokens(b.sep) for b in self._blocks
+        ) + sep_tokens * max(len(self._blocks) - 1, 0)
+        remaining = self.budget - reserve
+
+        def take(b: int, i: int) -> None:
+            nonlocal remaining
+            block = self._blocks[b]
+            cost = costs[b][i]
+            if block.kept:
+                cost += estimate_tokens(block.sep)
+            elif block.title:
+                cost += estimate_tokens(block.title + "\n")
+            if cost <= remaining:
+                block.kept.append(i)
+                remaining -= cost
+
+        for b in range(len(self._blocks)):
+            take(b, 0)
+        for b, block in enumerate(self._blocks):
+            for i in range(1, len(block.items)):
+                take(b, i)
+
+        parts: List[str] = []
+        kept: Dict[str, int] = {}
+        dropped: Dict[str, int] = {}
+        kept_keys: Set[str] = set()
+        for block in self._blocks:
+            n_dropped = len(block.items) - len(block.kept)
+            kept[block.name] = len(block.kept)
+            dropped[block.name] = n_dropped
+            body = [block.items[i] for i in block.kept]
+            if n_dropped:
+                body.append(_omitted_note(block.name, n_dropped))
+            text = block.sep.join(body)
+            parts.append(f"{block.title}\n{text}" if block.title and block.kept else text)
+            kept_keys.update(block.keys[i] for i in block.kept if block.keys[i] is not None)
+
+        text = BLOCK_SEP.join(parts) or empty
+        return ContextResult(text, estimate_tokens(text), self.budget, kept, dropped, truncated, kept_keys)
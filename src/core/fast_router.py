@@ -0,0 +1,258 @@
+# src/core/fast_router.py
+
+"""
+fast_router.py
+
+Local first-stage router: nearest-neighbour classification over TF-IDF
+character n-grams. Training prompts are stored as sparse unit vectors behind
+an inverted index, so scoring a prompt only touches the n-grams it contains
+and takes well under a millisecond.
+
+The model is trained from router_dataset.jsonl by src/etl/build_fast_router.py
+and saved as a small JSON artifact. route_prompt only trusts a prediction when
+the best cosine similarity clears FAST_ROUTER_THRESHOLD and beats the best
+other label by FAST_ROUTER_MIN_MARGIN; everything else goes to the LLM router.
+A model with fewer than two labels has no runner-up to measure a margin
+against, so it is never confident.
+
+Off by default (FAST_ROUTER_ENABLED=1 to turn it on): the router dataset
+doesn't yet cover every category and the drug route.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+FAST_ROUTER_PATH = os.getenv("FAST_ROUTER_PATH", "data/router/fast_router.json")
+FAST_ROUTER_ENABLED = os.getenv("FAST_ROUTER_ENABLED", "0") not in ("0", "false", "no")
+FAST_ROUTER_THRESHOLD = float(os.getenv("FAST_ROUTER_THRESHOLD", "0.65"))
+FAST_ROUTER_MIN_MARGIN = float(os.getenv("FAST_ROUTER_MIN_MARGIN", "0.1"))
+# Fraction of confident local answers that are also sent to the LLM router,
+# purely to keep measuring agreement.
+FAST_ROUTER_SHADOW_RATE = float(os.getenv("FAST_ROUTER_SHADOW_RATE", "0"))
+
+NGRAM_RANGE = (3, 5)
+ARTIFACT_VERSION = 1
+
+_NON_WORD = re.compile(r"[^a-z0-9 ]+")
+_WS = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    text = _NON_WORD.sub(" ", text.lower())
+    return _WS.sub(" ", text).strip()
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = NGRAM_RANGE) -> Counter:
+    """Character n-grams of each word, padded so word starts/ends are features too."""
+    grams: Counter = Counter()
+    lo, hi = ngram_range
+    for word in normalize(text).split():
+        padded = f" {word} "
+        for n in range(lo, hi + 1):
+            for i in range(len(padded) - n + 1):
+                grams[padded[i:i + n]] += 1
+    return grams
+
+
+def _l2_normalize(vec: Dict[str, float]) -> Dict[str, float]:
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    return {k: v / norm for k, v in vec.items()} if norm else vec
+
+
+def route_key(route: Dict[str, Any]) -> Tuple[Optional[str], Tuple[str, ...]]:
+    """What counts as 'the same route' for agreement: function + category set."""
+    args = route.get("arguments") or {}
+    return route.get("function"), tuple(sorted(args.get("categories") or []))
+
+
+@dataclass
+class FastPrediction:
+    route: Dict[str, Any]
+    confidence: float
+    confident: bool
+
+
+class FastRouter:
+    def __init__(
+        self,
+        idf: Dict[str, float],
+        labels: List[Dict[str, Any]],
+        exemplars: List[Dict[str, float]],
+        exemplar_labels: List[int],
+        ngram_range: Tuple[int, int] = NGRAM_RANGE,
+        threshold: float = FAST_ROUTER_THRESHOLD,
+        min_margin: float = FAST_ROUTER_MIN_MARGIN,
+    ):
+        self.idf = idf
+        self.labels = labels
+        self.ngram_range = tuple(ngram_range)
+        self.threshold = threshold
+        self.min_margin = min_margin
+        self._exemplars = exemplars
+        self._exemplar_labels = exemplar_labels
+        # invert the exemplars: gram -> [(exemplar index, weight)]
+        self._postings: Dict[str, List[Tuple[int, float]]] = {}
+        for i, vec in enumerate(exemplars):
+            for gram, w in vec.items():
+                self._postings.setdefault(gram, []).append((i, w))
+
+        self._lock = threading.Lock()
+        self._predictions = 0
+        self._hits = 0
+        self._fallbacks = 0
+        self._compared = 0
+        self._agreed = 0
+
+    # ---------- training / persistence ----------
+
+    @classmethod
+    def train(
+        cls,
+        examples: Iterable[Tuple[str, Dict[str, Any]]],
+        ngram_range: Tuple[int, int] = NGRAM_RANGE,
+    ) -> "FastRouter":
+        """examples: (prompt, route) pairs, route = {"function": ..., "arguments": {...}}."""
+        docs: List[Counter] = []
+        doc_labels: List[int] = []
+        labels: List[Dict[str, Any]] = []
+        label_index: Dict[Tuple, int] = {}
+        for prompt, route in examples:
+            key = route_key(route)
+            if key not in label_index:
+                label_index[key] = len(labels)
+                labels.append({"function": key[0], "categories": list(key[1])})
+            docs.append(char_ngrams(prompt, ngram_range))
+            doc_labels.append(label_index[key])
+        if not docs:
+            raise ValueError("No training examples for the fast router")
+
+        df: Counter = Counter()
+        for grams in docs:
+            df.update(grams.keys())
+        n_docs = len(docs)
+        idf = {g: math.log((1 + n_docs) / (1 + c)) + 1.0 for g, c in df.items()}
+
+        exemplars = [
+            _l2_normalize({g: (1 + math.log(c)) * idf[g] for g, c in grams.items()})
+            for grams in docs
+        ]
+        return cls(idf, labels, exemplars, doc_labels, ngram_range)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": ARTIFACT_VERSION,
+                "ngram_range": list(self.ngram_range),
+                "labels": self.labels,
+                "idf": {g: round(w, 5) for g, w in self.idf.items()},
+                "exemplars": [{g: round(w, 5) for g, w in v.items()} for v in self._exemplars],
+                "exemplar_labels": self._exemplar_labels,
+            }, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str, threshold: float = FAST_ROUTER_THRESHOLD) -> "FastRouter":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported fast router artifact version: {data.get('version')}")
+        return cls(
+            data["idf"], data["labels"], data["exemplars"], data["exemplar_labels"],
+            tuple(data["ngram_range"]), threshold,
+        )
+
+    # ---------- inference ----------
+
+    def scores(self, prompt: str) -> List[float]:
+        """Best cosine similarity to any training prompt, per label."""
+        grams = char_ngrams(prompt, self.ngram_range)
+        vec = _l2_normalize({
+            g: (1 + math.log(c)) * self.idf[g] for g, c in grams.items() if g in self.idf
+        })
+        sims: Dict[int, float] = {}
+        for g, w in vec.items():
+            for i, ew in self._postings.get(g, ()):
+                sims[i] = sims.get(i, 0.0) + w * ew
+        scores = [0.0] * len(self.labels)
+        for i, sim in sims.items():
+            label = self._exemplar_labels[i]
+            if sim > scores[label]:
+                scores[label] = sim
+        return scores
+
+    def predict(self, prompt: str, patient: str) -> Optional[FastPrediction]:
+        scores = self.scores(prompt)
+        if not scores:
+            return None
+        ranked = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+        best = ranked[0]
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else 0.0
+        label = self.labels[best]
+        route = {
+            "function": label["function"],
+            "arguments": {"patient": patient, "categories": list(label["categories"])},
+        }
+        confidence = scores[best]
+        confident = (
+            len(self.labels) >= 2
+            and confidence >= self.threshold
+            and confidence - runner_up >= self.min_margin
+        )
+        with self._lock:
+            self._predictions += 1
+        return FastPrediction(route, confidence, confident)
+
+    # ---------- metrics ----------
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._fallbacks += 1
+
+    def record_agreement(self, local: Dict[str, Any], llm: Dict[str, Any]) -> None:
+        with self._lock:
+            self._compared += 1
+            if route_key(local) == route_key(llm):
+                self._agreed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routed = self._hits + self._fallbacks
+            return {
+                "threshold": self.threshold,
+                "min_margin": self.min_margin,
+                "labels": len(self.labels),
+                "predictions": self._predictions,
+                "hits": self._hits,
+                "fallbacks": self._fallbacks,
+                "hit_rate": self._hits / routed if routed else 0.0,
+                "compared_with_llm": self._compared,
+                "agreement": self._agreed / self._compared if self._compared else None,
+            }
+
+
+# ---------- process-wide instance ----------
+
+_router: Optional[FastRouter] = None
+_loaded = False
+_load_lock = threading.Lock()
+
+
+def get_fast_router() -> Optional[FastRouter]:
+    """The loaded artifact, or None if disabled / not built yet."""
+    global _router, _loaded
+    if not _loaded:
+        with _load_lock:
+            if not _loaded:
+                if FAST_ROUTER_ENABLED and os.path.isfile(FAST_ROUTER_PATH):
+                    _router = FastRouter.load(FAST_ROUTER_PATH)
+                _loaded = True
+    return _router
@@ -4,20 +4,57 @@
 fhir_query_builder.py
 
 For local bundles: picks the correct patient file by ID (filters['patient'])
-and ignores resource_types entirely (you’ll filter within the bundle).
+and passes resource_types through as a projection, so large bundles can be
+parsed keeping only the resources the question needs.
 """
 
 import os
-from typing import List, Dict
+from typing import Iterable, List, Dict, NamedTuple, Optional, Tuple
 
 LOCAL_FHIR_DATA_DIR = os.getenv("LOCAL_FHIR_DATA_DIR", "./data/fhir")
 
+# Which FHIR resource types each router category reads
+CATEGORY_RESOURCE_TYPES: Dict[str, List[str]] = {
+    "generalInfo":        ["Patient"],
+    "allergies":          ["AllergyIntolerance"],
+    "conditions":         ["Condition"],
+    "currentMedications": ["MedicationStatement", "Medication"],
+    "observations":       ["Observation"],
+    "carePlan":           ["CarePlan"],
+}
+
+class FhirQuery(NamedTuple):
+    path: str
+    # None means "everything in the bundle"
+    resource_types: Optional[Tuple[str, ...]]
+
+
+def resource_types_for(categories: Iterable[str]) -> List[str]:
+    """Union of the resource types the given categories read, in a stable order."""
+    types: List[str] = []
+    for cat in categories:
+        for t in CATEGORY_RESOURCE_TYPES.get(cat, []):
+            if t not in types:
+                types.append(t)
+    return types
+
+
+def patient_ids() -> List[str]:
+    """Ids of the patients with a local bundle."""
+    try:
+        names = os.listdir(LOCAL_FHIR_DATA_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len(".json")] for name in names if name.endswith(".json"))
+
+
 def build_query(
     resource_types: List[str],
     filters: Dict[str, str]
-) -> str:
+) -> FhirQuery:
     """
-    Returns the filesystem path for the patient’s bundle JSON.
+    Returns the filesystem path for the patient’s bundle JSON, plus the
+    resource types to keep (empty list = no projection).
 
     Expects:
       filters['patient'] == patient_id  (e.g. 'emily')
@@ -29,4 +66,4 @@ def build_query(
     file_path = os.path.join(LOCAL_FHIR_DATA_DIR, f"{patient_id}.json")
     if not os.path.isfile(file_path):
         raise FileNotFoundError(f"No local FHIR file for patient '{patient_id}': {file_path}")
-    return file_path
+    return FhirQuery(file_path, tuple(resource_types) if resource_types else None)
@@ -1,22 +1,210 @@
 # src/core/memory.py
 
+"""
+memory.py
+
+Per-session conversation state.
+
+PromptMemory holds what we remember about one conversation: drugs we've
+already explained, the last turn, and whether Sally has introduced herself.
+SessionStore maps the session id sent to /ask onto a PromptMemory, with a
+per-session TTL, LRU eviction and caps on both the number of sessions and
+their approximate total size. A session held with acquire() (for the length
+of a request) is never evicted or expired until it is released. Everything
+lives in memory behind short critical sections, so it is safe to use from
+worker threads and the event loop alike.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+MAX_RECENT_DRUGS = int(os.getenv("SESSION_MAX_RECENT_DRUGS", "64"))
+DEFAULT_SESSION_ID = "default"
+# longer ids are rejected rather than stored (they're client-supplied)
+SESSION_ID_MAX_LEN = int(os.getenv("SESSION_ID_MAX_LEN", "128"))
+
+# rough fixed cost of an empty session (objects, dict slots, lock)
+_SESSION_OVERHEAD = 512
+
+
+def _text_size(s: Optional[str]) -> int:
+    return sys.getsizeof(s) if s is not None else 0
+
+
 class PromptMemory:
-    def __init__(self):
-        self.recent_drugs = set()
-        self.last_prompt = None
-        self.last_response = None
+    def __init__(self, max_drugs: int = MAX_RECENT_DRUGS):
+        self.max_drugs = max_drugs
+        self.recent_drugs: "OrderedDict[str, None]" = OrderedDict()
+        self.last_prompt: Optional[str] = None
+        self.last_response: Optional[str] = None
+        self.intro_shown = False
+        self.nbytes = _SESSION_OVERHEAD
+        self._lock = threading.Lock()
+        # set by SessionStore so it can keep its byte total current
+        self.on_resize: Optional[Callable[[int], None]] = None
+
+    def _resized(self) -> None:
+        size = (
+            _SESSION_OVERHEAD
+            + sum(_text_size(d) for d in self.recent_drugs)
+            + _text_size(self.last_prompt)
+            + _text_size(self.last_response)
+        )
+        delta, self.nbytes = size - self.nbytes, size
+        if delta and self.on_resize is not None:
+            self.on_resize(delta)
 
     def already_mentioned(self, drug_name: str) -> bool:
-        return drug_name.lower() in self.recent_drugs
+        with self._lock:
+            return drug_name.lower() in self.recent_drugs
 
     def remember_drug(self, drug_name: str):
-        self.recent_drugs.add(drug_name.lower())
+        with self._lock:
+            self.recent_drugs[drug_name.lower()] = None
+            self.recent_drugs.move_to_end(drug_name.lower())
+            while len(self.recent_drugs) > self.max_drugs:
+                self.recent_drugs.popitem(last=False)
+            self._resized()
+
+    def take_intro(self) -> bool:
+        """True exactly once per session: whether to include the introduction."""
+        with self._lock:
+            first = not self.intro_shown
+            self.intro_shown = True
+            return first
 
     def update(self, prompt: str, response: str):
-        self.last_prompt = prompt
-        self.last_response = response
+        with self._lock:
+            self.last_prompt = prompt
+            self.last_response = response
+            self._resized()
 
     def reset(self):
-        self.recent_drugs.clear()
-        self.last_prompt = None
-        self.last_response = None
+        with self._lock:
+            self.recent_drugs.clear()
+            self.last_prompt = None
+            self.last_response = None
+            self.intro_shown = False
+            self._resized()
+
+
+class SessionStore:
+    def __init__(
+        self,
+        ttl: float = SESSION_TTL_SECONDS,
+        max_sessions: int = SESSION_MAX,
+        max_bytes: int = SESSION_MAX_BYTES,
+    ):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # session id -> [memory, last access, requests holding it]
+        self._sessions: "OrderedDict[str, list]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._created = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _drop(self, session_id: str) -> None:
+        memory = self._sessions.pop(session_id)[0]
+        memory.on_resize = None
+        self._bytes -= memory.nbytes
+
+    def _expire(self, now: float) -> None:
+        # oldest access first, so stop at the first live one
+        while self._sessions:
+            session_id, (_, seen, refs) = next(iter(self._sessions.items()))
+            if now - seen < self.ttl or refs:
+                break
+            self._drop(session_id)
+            self._expirations += 1
+
+    def _enforce_caps(self, keep: Optional[str] = None) -> None:
+        """Evict least recently used sessions, never `keep` or one in use, until under the caps."""
+        while len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes:
+            victim = next(
+                (sid for sid, (_, _, refs) in self._sessions.items() if not refs and sid != keep), None
+            )
+            if victim is None:
+                break
+            self._drop(victim)
+            self._evictions += 1
+
+    def _on_resize(self, session_id: str, memory: PromptMemory, delta: int) -> None:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            # a session evicted and recreated under the same id is another object
+            if entry is not None and entry[0] is memory:
+                self._bytes += delta
+                self._enforce_caps(keep=session_id)
+
+    def _entry(self, session_id: str) -> list:
+        """The session's entry, created on first use; refreshes its TTL. Caller holds the lock."""
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            memory = PromptMemory()
+            memory.on_resize = partial(self._on_resize, session_id, memory)
+            entry = self._sessions[session_id] = [memory, now, 0]
+            self._bytes += memory.nbytes
+            self._created += 1
+            self._enforce_caps(keep=session_id)
+            return entry
+        entry[1] = now
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def get(self, session_id: str = DEFAULT_SESSION_ID) -> PromptMemory:
+        """The session's memory, created on first use; refreshes its TTL."""
+        with self._lock:
+            return self._entry(session_id)[0]
+
+    def acquire(self, session_id: str = DEFAULT_SESSION_ID) -> PromptMemory:
+        """Like get(), but the session stays put until release()."""
+        with self._lock:
+            entry = self._entry(session_id)
+            entry[2] += 1
+            return entry[0]
+
+    def release(self, session_id: str, memory: PromptMemory) -> None:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[0] is not memory:
+                return  # discarded or cleared meanwhile
+            entry[1] = time.monotonic()
+            entry[2] -= 1
+            self._sessions.move_to_end(session_id)
+            self._enforce_caps(keep=session_id)
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            for session_id in list(self._sessions):
+                self._drop(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "in_use": sum(1 for _, _, refs in self._sessions.values() if refs),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "created": self._created,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
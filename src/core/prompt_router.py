@@ -1,99 +1,97 @@
 import os
 import json
-import requests
-from typing import Dict, Any
+import random
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, FrozenSet, Optional, Tuple
 from dotenv import load_dotenv
-from .response_generator import generate_response
+
+from src.llm.function_schema import (
+    ALLOWED_CATEGORIES,
+    DRUG_FUNCTION_DEF,
+    FHIR_FUNCTION_DEF,
+    FUNCTION_DRUG,
+    FUNCTION_FHIR,
+)
+from src.llm.model_runner import OLLAMA_MODEL, get_client, response_text
+from src.llm.prompt_templates import router_system_prompt, router_user_message
+from src.core.fast_router import FAST_ROUTER_SHADOW_RATE, FastPrediction, get_fast_router
+from src.core.router_cache import RouterCache
+from src.core.fhir_query_builder import patient_ids
 
 
 load_dotenv()
 
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
 DEFAULT_PATIENT_ID = os.getenv("DEFAULT_PATIENT_ID", "emily")
 
 
-FUNCTION_FHIR = "get_fhir_resources"
-FUNCTION_DRUG = "get_drug_info"
-
-ALLOWED_CATEGORIES = [
-    "generalInfo",
-    "allergies",
-    "conditions",
-    "currentMedications",
-    "observations",
-    "carePlan",
-]
-
-FHIR_FUNCTION_DEF = json.dumps({
-    "name": FUNCTION_FHIR,
-    "description": "Fetch patient-specific FHIR data categories",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "patient": {"type": "string", "description": "The patient identifier"},
-            "categories": {
-                "type": "array",
-                "items": {"type": "string", "enum": ALLOWED_CATEGORIES},
-                "description": "Which FHIR categories to retrieve"
-            }
-        },
-        "required": ["patient", "categories"]
-    }
-}, indent=2)
-
-DRUG_FUNCTION_DEF = json.dumps({
-    "name": FUNCTION_DRUG,
-    "description": "Look up information for a given drug",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "drug_name": {"type": "string", "description": "Name of the drug to look up"}
-        },
-        "required": ["drug_name"]
-    }
-}, indent=2)
-
-def route_prompt(prompt: str) -> Dict[str, Any]:
-    system_instruction = (
-        "You are a clinical assistant. Based on the user's prompt, choose exactly ONE function:\n"
-        f"- {FUNCTION_FHIR}(patient, categories)\n"
-        f"- {FUNCTION_DRUG}(drug_name)\n\n"
-        "Respond ONLY with JSON in this exact format:\n"
-        "{\n"
-        '  "name": "<function name>",\n'
-        '  "arguments": {<arguments JSON>}\n'
-        "}\n"
-        "DO NOT provide any other explanation or text.\n\n"
-        f"Use '{DEFAULT_PATIENT_ID}' as the patient identifier by default.\n"
-        f"Allowed categories for FHIR are: {', '.join(ALLOWED_CATEGORIES)}.\n"
+# Word prefixes that pick the FHIR route's categories
+CATEGORY_TERMS = {
+    "allerg": "allergies",
+    "condition": "conditions",
+    "diagnos": "conditions",
+    "disease": "conditions",
+    "medic": "currentMedications",
+    "meds": "currentMedications",
+    "drug": "currentMedications",
+    "pill": "currentMedications",
+    "prescri": "currentMedications",
+    "taking": "currentMedications",
+    "observ": "observations",
+    "lab": "observations",
+    "vital": "observations",
+    "blood": "observations",
+    "result": "observations",
+    "test": "observations",
+    "weight": "observations",
+    "plan": "carePlan",
+    "goal": "carePlan",
+    "age": "generalInfo",
+    "birth": "generalInfo",
+    "born": "generalInfo",
+    "address": "generalInfo",
+    "gender": "generalInfo",
+}
+
+
+def route_terms(text: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """(categories, patients) a normalized prompt names; near-duplicates must name the same."""
+    words = text.split()
+    patients = set(patient_ids())
+    return (
+        frozenset(cat for w in words for stem, cat in CATEGORY_TERMS.items() if w.startswith(stem)),
+        frozenset(w for w in words if w in patients),
     )
 
-    full_prompt = (
-        f"{system_instruction}\n\n"
-        f"Available functions:\n{FHIR_FUNCTION_DEF}\n{DRUG_FUNCTION_DEF}\n\n"
-        f"User prompt: {prompt}\n\n"
-        "Respond with ONLY the JSON object specifying the chosen function and arguments."
+
+# Routing decisions for repeated prompts. Near-duplicate matching (opt-in) is
+# limited to the FHIR route and to prompts naming the same categories and patients.
+router_cache = RouterCache(near_dup_functions=(FUNCTION_FHIR,), near_dup_terms=route_terms)
+
+
+def router_system() -> str:
+    """The router's static prompt prefix; identical on every call."""
+    return router_system_prompt(
+        FUNCTION_FHIR, FUNCTION_DRUG, (FHIR_FUNCTION_DEF, DRUG_FUNCTION_DEF), DEFAULT_PATIENT_ID, ALLOWED_CATEGORIES
     )
 
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": full_prompt,
-        "format": "json",
-        "stream": False
-    }
 
-    resp = requests.post(OLLAMA_API_URL, json=payload)
-    resp.raise_for_status()
-    data = resp.json()
+def router_fingerprint() -> str:
+    """Changes whenever a cached routing decision could become stale."""
+    parts = [router_system(), json.dumps(ALLOWED_CATEGORIES), DEFAULT_PATIENT_ID, OLLAMA_MODEL]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
 
-    if 'response' not in data:
+
+def parse_router_response(data: Dict[str, Any]) -> Dict[str, Any]:
+    if "message" not in data and "response" not in data:
         raise RuntimeError(f"Ollama API returned unexpected response: {data}")
+    text = response_text(data)
 
     try:
-        response_json = json.loads(data["response"])
+        response_json = json.loads(text)
     except json.JSONDecodeError as e:
-        raise RuntimeError(f"Could not decode JSON from Ollama response: {data['response']}") from e
+        raise RuntimeError(f"Could not decode JSON from Ollama response: {text}") from e
 
     function_name = response_json.get("name")
     arguments = response_json.get("arguments", {})
@@ -105,3 +103,102 @@ def route_prompt(prompt: str) -> Dict[str, Any]:
         "function": function_name,
         "arguments": arguments
     }
+
+
+def route_with_llm(prompt: str, label: str = "router") -> Dict[str, Any]:
+    data = get_client().complete(router_system(), router_user_message(prompt), label=label, format="json")
+    return parse_router_response(data)
+
+
+async def aroute_with_llm(prompt: str, label: str = "router") -> Dict[str, Any]:
+    data = await get_client().acomplete(router_system(), router_user_message(prompt), label=label, format="json")
+    return parse_router_response(data)
+
+
+def _fast_prediction(prompt: str) -> Optional[FastPrediction]:
+    fast = get_fast_router()
+    if fast is None:
+        return None
+    pred = fast.predict(prompt, patient=DEFAULT_PATIENT_ID)
+    # Only FHIR routes can be answered locally: the drug route needs a drug_name argument
+    if pred and pred.confident and pred.route["function"] != FUNCTION_FHIR:
+        pred.confident = False
+    return pred
+
+
+def known_route(prompt: str) -> Optional[Dict[str, Any]]:
+    """The cached routing decision for `prompt`, if any, without counting a lookup."""
+    return router_cache.peek(prompt, DEFAULT_PATIENT_ID, router_fingerprint())
+
+
+# one worker: shadow calls are sampled, best effort and shed by the scheduler when the LLM is busy
+_shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow-route")
+
+
+def _shadow_route_sync(prompt: str, local: Dict[str, Any]) -> None:
+    try:
+        get_fast_router().record_agreement(local, route_with_llm(prompt, label="shadow"))
+    except Exception as e:
+        print(f"[fast_router] shadow routing failed: {e!r}")
+
+
+def route_prompt(prompt: str) -> Dict[str, Any]:
+    """
+    Cached decision if we've seen this prompt, else the fast router when it is
+    confident, else the LLM router.
+    """
+    fingerprint = router_fingerprint()
+    cached = router_cache.get(prompt, DEFAULT_PATIENT_ID, fingerprint)
+    if cached is not None:
+        return cached
+
+    pred = _fast_prediction(prompt)
+    if pred is not None:
+        get_fast_router().record(hit=pred.confident)
+        if pred.confident:
+            if random.random() < FAST_ROUTER_SHADOW_RATE:
+                # measure agreement off the critical path
+                _shadow_pool.submit(_shadow_route_sync, prompt, pred.route)
+            return pred.route
+
+    route = route_with_llm(prompt)
+    if pred is not None:
+        get_fast_router().record_agreement(pred.route, route)
+    if route.get("function"):
+        router_cache.put(prompt, DEFAULT_PATIENT_ID, fingerprint, route)
+    return route
+
+
+_shadow_tasks: set = set()
+
+
+async def _shadow_route(prompt: str, local: Dict[str, Any]) -> None:
+    try:
+        get_fast_router().record_agreement(local, await aroute_with_llm(prompt, label="shadow"))
+    except Exception as e:
+        print(f"[fast_router] shadow routing failed: {e!r}")
+
+
+async def aroute_prompt(prompt: str) -> Dict[str, Any]:
+    fingerprint = router_fingerprint()
+    cached = router_cache.get(prompt, DEFAULT_PATIENT_ID, fingerprint)
+    if cached is not None:
+        return cached
+
+    pred = _fast_prediction(prompt)
+    if pred is not None:
+        get_fast_router().record(hit=pred.confident)
+        if pred.confident:
+            if random.random() < FAST_ROUTER_SHADOW_RATE:
+                # measure agreement off the critical path
+                task = asyncio.get_running_loop().create_task(_shadow_route(prompt, pred.route))
+                _shadow_tasks.add(task)
+                task.add_done_callback(_shadow_tasks.discard)
+            return pred.route
+
+    route = await aroute_with_llm(prompt)
+    if pred is not None:
+        get_fast_router().record_agreement(pred.route, route)
+    if route.get("function"):
+        router_cache.put(prompt, DEFAULT_PATIENT_ID, fingerprint, route)
+    return route
@@ -1,100 +1,543 @@
+import asyncio
 import os
 import re
-from typing import Dict, Any
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, AsyncIterator, Iterator, List, NamedTuple, Optional, Tuple
 from functools import lru_cache
 
-import src.fhir.getters as getters
-from src.core.prompt_router import route_prompt, FUNCTION_FHIR, FUNCTION_DRUG
-from src.core.fhir_query_builder import build_query
-from src.fhir.client import fetch_fhir_resources
-from .response_generator import generate_response
+from src.core.prompt_router import route_prompt, aroute_prompt, known_route, FUNCTION_FHIR, FUNCTION_DRUG
+from src.core.fhir_query_builder import build_query, resource_types_for
+from src.fhir.bundle import CompiledBundle
+from src.fhir.client import fetch_projected_bundle, should_stream
+from src.core.summary_store import CATEGORY_GETTERS, summary_store
+from src.core.answer_cache import AnswerCache, answer_key
+from src.core.context_builder import ContextBuilder
+from src.llm.model_runner import OLLAMA_MODEL
+from src.llm.prompt_templates import sally_template_version
+from .response_generator import (
+    generate_response,
+    generate_response_stream,
+    agenerate_response,
+    agenerate_response_stream,
+)
 
-from src.drug_lookup.match_fhir_to_drugs import match_fhir_medication
+from src.drug_lookup.match_fhir_to_drugs import match_fhir_medication, match_fhir_medication_list
 from src.drug_lookup.query_drug_knowledge import get_drug_knowledge
-from src.core.memory import PromptMemory
+from src.drug_lookup.label_retriever import RETRIEVER_MAX_CHARS, get_retriever
+from src.drug_lookup.rxnorm_index import db_version
+from src.core.memory import DEFAULT_SESSION_ID, PromptMemory, SessionStore
 
-memory = PromptMemory()
+sessions = SessionStore()
+answer_cache = AnswerCache()
 DEFAULT_PATIENT_ID = os.getenv("DEFAULT_PATIENT_ID", "emily")
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") not in ("0", "false", "no")
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "4"))
 
-CATEGORY_GETTERS = {
-    "generalInfo":        getters.get_general_info,
-    "allergies":          getters.get_allergies,
-    "conditions":         getters.get_conditions,
-    "currentMedications": getters.get_current_medications,
-    "observations":       getters.get_observations,
-    "carePlan":           getters.get_carePlan,
-}
-
-# Cache drug knowledge lookups to avoid repeated SQLite hits
+# Cache drug knowledge lookups to avoid repeated SQLite hits; keyed on the
+# DB build so a rebuilt database isn't answered from stale entries
 @lru_cache(maxsize=128)
-def get_cached_drug_knowledge(slug_id: str) -> str:
+def _drug_knowledge(slug_id: str, version: Optional[str]) -> str:
     return get_drug_knowledge(slug_id)
 
+def get_cached_drug_knowledge(slug_id: str) -> str:
+    return _drug_knowledge(slug_id, drug_db_version())
+
 # Very basic keyword-based name extractor (optional to refine later)
 def extract_possible_drug_names(text: str) -> list:
     return re.findall(r"\b[A-Z][a-z]{2,}\b", text)  # Matches capitalized words like "Aspirin", "Ibuprofen"
 
+def _mentions(labels: List[str], mentioned: set) -> bool:
+    words = set(re.findall(r"[a-z]+", " ".join(labels).lower()))
+    return not words.isdisjoint(mentioned)
+
+def mentions_medication(med: Dict[str, Any], mentioned: set) -> bool:
+    """Does the Medication's code text/display contain a mentioned word?"""
+    code = med.get("code", {})
+    return _mentions([code.get("text") or ""] + [c.get("display") or "" for c in code.get("coding", [])], mentioned)
+
+def mentions_drug(match: Dict[str, Any], mentioned: set) -> bool:
+    """Does the matched drug's brand or generic name contain a mentioned word?"""
+    return _mentions([match.get("name") or "", match.get("generic_name") or ""], mentioned)
+
+
+def label_sections(user_prompt: str, med_names: List[str]) -> List[str]:
+    """Label passages (side effects, interactions, warnings) most relevant to the prompt, best first."""
+    retriever = get_retriever()
+    if retriever is None:
+        return []
+    drugs = retriever.drugs_in(med_names)
+    if not drugs:
+        return []
+    hits = retriever.search(user_prompt, drugs=drugs)
+    return [
+        f"• {h['drug']} ({h['section'].replace('_', ' ')}):\n{h['text'][:RETRIEVER_MAX_CHARS]}"
+        for h in hits
+    ]
+
+
+def is_medication_question(user_prompt: str) -> bool:
+    drug_keywords = ["drug", "med", "side effect", "dosage", "pill", "prescription"]
+    return any(kw in user_prompt.lower() for kw in drug_keywords)
+
+
+def medications_bundle(pid: str) -> CompiledBundle:
+    return fetch_projected_bundle(
+        build_query(resource_types_for(["currentMedications"]), {"patient": pid})
+    )
 
-def rag_inference(user_prompt: str) -> Dict[str, Any]:
-    route = route_prompt(user_prompt)
-    fn = route.get("function")
-    args = route.get("arguments", {})
-
-    if fn == FUNCTION_FHIR:
-        pid = args.get("patient", DEFAULT_PATIENT_ID)
-        categories = args.get("categories", [])
-        path = build_query([], {"patient": pid})
-        bundle_data = fetch_fhir_resources(path)
-        bundle = [entry["resource"] for entry in bundle_data.get("entry", [])]
-
-        parts = []
-        for cat in categories:
-            getter = CATEGORY_GETTERS.get(cat)
-            if getter:
-                parts.append(getter(bundle))
-
-        retrieved_data = "\n\n".join(parts) or "No data found."
-
-        # If the prompt suggests a medication-related query, extract possible drug names and filter accordingly
-        drug_keywords = ["drug", "med", "side effect", "dosage", "pill", "prescription"]
-        if any(kw in user_prompt.lower() for kw in drug_keywords):
-            mentioned_drugs = extract_possible_drug_names(user_prompt)
-            mentioned_drugs = [name.lower() for name in mentioned_drugs]
-
-            drug_facts = []
-            med_resources = [r for r in bundle if r.get("resourceType") == "Medication"]
-            for med in med_resources:
-                match = match_fhir_medication(med)
-                if match:
-                    name = match['name']
-                    if name.lower() in mentioned_drugs and not memory.already_mentioned(name):
-                        drug_info = get_cached_drug_knowledge(match["slug_id"])
-                        if drug_info:
-                            drug_facts.append(f"• {name}:\n{drug_info}")
-                            memory.remember_drug(name)
-
-            if drug_facts:
-                retrieved_data += "\n\n--- Drug Information ---\n" + "\n\n".join(drug_facts)
-
-        final_response = generate_response(user_prompt, retrieved_data)
-        memory.update(user_prompt, final_response)
-
-        return {"source": "fhir", "response": final_response}
-
-    elif fn == FUNCTION_DRUG:
-        drug = args.get("drug_name")
-        if drug:
-            match = match_fhir_medication({"name": drug})
+
+# ---------- speculative prefetch ----------
+# Routing is usually an LLM round trip and nearly every FHIR question is
+# about the default patient, so while the route is pending we already render
+# that patient's summaries, match their medications (warming the drug
+# knowledge cache) and, for medication questions, run the label search.
+# It is all read-only, so a prefetch the route doesn't need is just dropped.
+
+class Prefetched(NamedTuple):
+    patient: str
+    summaries: Optional[Dict[str, str]]      # None for bundles too big to render whole
+    medications: CompiledBundle
+    matches: Optional[Tuple[Optional[dict], ...]]  # aligned with medications.medications
+    label_sections: Optional[List[str]]      # None unless it was a medication question
+    seconds: float
+
+
+def prefetch_patient(user_prompt: str, pid: str = DEFAULT_PATIENT_ID) -> Prefetched:
+    start = time.perf_counter()
+    path = build_query([], {"patient": pid}).path
+    summaries = None if should_stream(path) else summary_store.summaries(pid)
+
+    bundle = medications_bundle(pid)
+    resources = [m.resource for m in bundle.medications]
+    try:
+        matches = tuple(match_fhir_medication_list(resources)) if resources else ()
+        for match in matches:
             if match:
-                drug_info = get_cached_drug_knowledge(match["slug_id"])
-                return {"source": "drug", "response": f"🧪 {match['name']}:\n{drug_info}"}
-            else:
-                return {"source": "drug", "response": f"Sorry, I couldn’t find info on '{drug}'."}
-        else:
-            return {"source": "drug", "response": "No drug name provided."}
+                get_cached_drug_knowledge(match["slug_id"])
+    except Exception:
+        matches = None  # e.g. no drug DB; the inline path deals with it if it's needed
+
+    sections = None
+    if is_medication_question(user_prompt):
+        sections = label_sections(user_prompt, [ms.name for ms in bundle.medication_statements])
+    return Prefetched(pid, summaries, bundle, matches, sections, time.perf_counter() - start)
+
+
+_prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+def start_prefetch(user_prompt: str) -> Optional[Future]:
+    if not PREFETCH_ENABLED:
+        return None
+    route = known_route(user_prompt)
+    if route is not None and (route.get("function") != FUNCTION_FHIR
+                              or route.get("arguments", {}).get("patient", DEFAULT_PATIENT_ID) != DEFAULT_PATIENT_ID):
+        return None  # already known not to need the default patient's data
+    return _prefetch_pool.submit(prefetch_patient, user_prompt)
+
+
+class PipelineStats:
+    """Average per-stage latency, context size and what happened to each prefetch."""
+
+    STAGES = ("route_ms", "retrieve_ms", "generate_ms", "prefetch_ms")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._totals = dict.fromkeys(self.STAGES, 0.0)
+        self._counts = dict.fromkeys(self.STAGES, 0)
+        self._prefetch: Dict[str, int] = {}
+        self._contexts = 0
+        self._context_tokens = 0
+        self._trimmed = 0
+
+    def record(self, timings: Dict[str, Any]) -> None:
+        with self._lock:
+            self._requests += 1
+            for stage in self.STAGES:
+                if stage in timings:
+                    self._totals[stage] += timings[stage]
+                    self._counts[stage] += 1
+            outcome = timings.get("prefetch", "off")
+            self._prefetch[outcome] = self._prefetch.get(outcome, 0) + 1
+            context = timings.get("context")
+            if context is not None:
+                self._contexts += 1
+                self._context_tokens += context["tokens"]
+                self._trimmed += bool(context["dropped"] or context["truncated"])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "avg_ms": {
+                    stage: round(self._totals[stage] / self._counts[stage], 3) if self._counts[stage] else None
+                    for stage in self.STAGES
+                },
+                "prefetch": dict(self._prefetch),
+                "context": {
+                    "avg_tokens": round(self._context_tokens / self._contexts, 1) if self._contexts else None,
+                    "trimmed": self._trimmed,
+                },
+            }
+
+
+pipeline_stats = PipelineStats()
+
+
+def _ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 3)
+
+
+def _settle(prefetched: Optional[Prefetched], error: bool, args: Dict[str, Any], timings: Dict[str, Any]) -> Optional[Prefetched]:
+    """Keep the prefetch only if it's for the routed patient; note the outcome."""
+    if error:
+        timings["prefetch"] = "failed"  # the inline path will raise the real error
+        return None
+    if prefetched is None:
+        timings.setdefault("prefetch", "off")
+        return None
+    timings["prefetch_ms"] = round(prefetched.seconds * 1000, 3)
+    if prefetched.patient != args.get("patient", DEFAULT_PATIENT_ID):
+        timings["prefetch"] = "wrong_patient"
+        return None
+    timings["prefetch"] = "used"
+    return prefetched
+
+
+def _discard(future: Optional[Future], timings: Dict[str, Any]) -> None:
+    if future is not None:
+        future.cancel()  # frees the pool if it hasn't started yet
+    timings["prefetch"] = "discarded" if future is not None else "off"
+
+
+def _skip_prefetch(future: Optional[Future], args: Dict[str, Any], timings: Dict[str, Any]) -> bool:
+    """
+    True when waiting for the prefetch can't pay off: it is for another
+    patient, or still queued behind other requests' prefetches (it is then
+    cancelled and retrieval runs inline).
+    """
+    if future is None:
+        return False
+    if args.get("patient", DEFAULT_PATIENT_ID) != DEFAULT_PATIENT_ID:
+        future.cancel()
+        timings["prefetch"] = "wrong_patient"
+        return True
+    if future.cancel():
+        timings["prefetch"] = "cancelled"
+        return True
+    return False
+
+
+def _retrieve(user_prompt: str, args: Dict[str, Any], memory: PromptMemory, prefetched: Optional[Prefetched],
+              error: bool, timings: Dict[str, Any], start: float) -> str:
+    data = build_fhir_context(user_prompt, args, memory, _settle(prefetched, error, args, timings), timings)
+    timings["retrieve_ms"] = _ms(start)
+    return data
+
+
+def retrieve(user_prompt: str, args: Dict[str, Any], memory: PromptMemory,
+             future: Optional[Future], timings: Dict[str, Any]) -> str:
+    start = time.perf_counter()
+    prefetched, error = None, False
+    if future is not None and not _skip_prefetch(future, args, timings):
+        try:
+            prefetched = future.result()
+        except Exception:
+            error = True
+    return _retrieve(user_prompt, args, memory, prefetched, error, timings, start)
+
+
+async def aretrieve(user_prompt: str, args: Dict[str, Any], memory: PromptMemory,
+                    future: Optional[Future], timings: Dict[str, Any]) -> str:
+    start = time.perf_counter()
+    prefetched, error = None, False
+    if future is not None and not _skip_prefetch(future, args, timings):
+        try:
+            prefetched = await asyncio.wrap_future(future)
+        except Exception:
+            error = True
+    # bundle parsing, SQLite and the label search block; keep them off the event loop
+    return await asyncio.to_thread(_retrieve, user_prompt, args, memory, prefetched, error, timings, start)
+
 
+def build_fhir_context(user_prompt: str, args: Dict[str, Any], memory: PromptMemory,
+                       prefetched: Optional[Prefetched] = None,
+                       timings: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Serve the requested category summaries for the patient (+ drug facts),
+    reusing whatever a prefetch for the same patient already computed, packed
+    into the context token budget (see context_builder.py).
+    """
+    pid = args.get("patient", DEFAULT_PATIENT_ID)
+    categories = args.get("categories", [])
+    if prefetched is not None and prefetched.patient != pid:
+        prefetched = None
+    if prefetched is not None and prefetched.summaries is not None:
+        summaries = {cat: prefetched.summaries[cat] for cat in categories if cat in prefetched.summaries}
     else:
-        return {"source": None, "response": "Sorry, I didn’t understand your request."}
+        summaries = dict(zip([c for c in categories if c in CATEGORY_GETTERS], summary_store.get_many(pid, categories)))
+
+    context = ContextBuilder()
+    for category, summary in summaries.items():
+        context.add_category(category, summary)
+    label_block: List[str] = []
+    drug_names: List[str] = []
+
+    # If the prompt suggests a medication-related query, add label sections and
+    # facts for the drugs it names; a plain medication list needs neither
+    if is_medication_question(user_prompt):
+        bundle = prefetched.medications if prefetched is not None else medications_bundle(pid)
+        sections = prefetched.label_sections if prefetched is not None else None
+        if sections is None:
+            sections = label_sections(user_prompt, [ms.name for ms in bundle.medication_statements])
+        label_block = sections
+
+        mentioned_drugs = extract_possible_drug_names(user_prompt)
+        mentioned_drugs = {name.lower() for name in mentioned_drugs}
+
+        drug_facts = []
+        if prefetched is not None and prefetched.matches is not None:
+            matches = prefetched.matches
+        else:
+            resources = [m.resource for m in bundle.medications]
+            matches = match_fhir_medication_list(resources) if resources else []
+        for m, match in zip(bundle.medications, matches):
+            # a brand-name question about a generic-coded entry (or the reverse)
+            # only lines up with the matched drug's names
+            if match and (mentions_drug(match, mentioned_drugs) or mentions_medication(m.resource, mentioned_drugs)):
+                name = match['name']
+                if not memory.already_mentioned(name):
+                    drug_info = get_cached_drug_knowledge(match["slug_id"])
+                    if drug_info and name not in drug_names:
+                        drug_facts.append(f"• {name}:\n{drug_info}")
+                        drug_names.append(name)
+
+        context.add("drug", drug_facts, title="--- Drug Information ---", sep="\n\n", keys=drug_names)
+
+    context.add("label", label_block, title="--- Relevant Label Sections ---", sep="\n\n")
+    result = context.build()
+    # only drugs whose facts made it into the prompt count as mentioned
+    for name in drug_names:
+        if name in result.kept_keys:
+            memory.remember_drug(name)
+    if timings is not None:
+        timings["context"] = result.report()
+    return result.text
+
+
+def drug_db_version() -> Optional[str]:
+    try:
+        return db_version()
+    except FileNotFoundError:
+        return None
+
+
+def cached_answer(user_prompt: str, route: Dict[str, Any], retrieved_data: str, show_intro: bool,
+                  timings: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """(cache key, cached answer); both None when the answer cache is off."""
+    if not answer_cache.enabled:
+        return None, None
+    key = answer_key(user_prompt, route, retrieved_data, show_intro,
+                     OLLAMA_MODEL, sally_template_version(), drug_db_version())
+    answer = answer_cache.get(key)
+    timings["answer_cache"] = "hit" if answer is not None else "miss"
+    return key, answer
+
+
+def answer_drug_question(args: Dict[str, Any]) -> str:
+    drug = args.get("drug_name")
+    if not drug:
+        return "No drug name provided."
+    match = match_fhir_medication({"name": drug})
+    if match:
+        drug_info = get_cached_drug_knowledge(match["slug_id"])
+        return f"🧪 {match['name']}:\n{drug_info}"
+    return f"Sorry, I couldn’t find info on '{drug}'."
+
+
+UNKNOWN_REQUEST = "Sorry, I didn’t understand your request."
+
+
+class Turn:
+    """
+    One question going through the pipeline: the session, the prefetch, the
+    route and the timings. The four entry points below (sync/async x
+    plain/streaming) only differ in how they route, retrieve and generate;
+    every other step lives here. Used as a context manager, it holds the
+    session for the length of the request so it can't be evicted mid-turn.
+    """
+
+    def __init__(self, user_prompt: str, session_id: str):
+        self.user_prompt = user_prompt
+        self.session_id = session_id
+        self.memory = sessions.acquire(session_id)
+        self.timings: Dict[str, Any] = {}
+        self.future = start_prefetch(user_prompt)
+        self.route: Dict[str, Any] = {}
+        self.show_intro = False
+        self._cache_key: Optional[str] = None
+
+    def __enter__(self) -> "Turn":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        sessions.release(self.session_id, self.memory)
+
+    @property
+    def function(self) -> Optional[str]:
+        return self.route.get("function")
+
+    @property
+    def args(self) -> Dict[str, Any]:
+        return self.route.get("arguments", {})
+
+    def routed(self, route: Dict[str, Any], start: float) -> None:
+        self.route = route
+        self.timings["route_ms"] = _ms(start)
+
+    def cached(self, retrieved_data: str) -> Optional[str]:
+        """The cached answer for this context, if any; decides the intro either way."""
+        self.show_intro = self.memory.take_intro()
+        self._cache_key, answer = cached_answer(
+            self.user_prompt, self.route, retrieved_data, self.show_intro, self.timings
+        )
+        return answer
+
+    def generated(self, response: str, start: float) -> None:
+        self.timings["generate_ms"] = _ms(start)
+        if self._cache_key:
+            answer_cache.put(self._cache_key, response)
+
+    def answered(self, response: str) -> None:
+        self.memory.update(self.user_prompt, response)
+
+    def non_fhir_answer(self) -> Tuple[Optional[str], str]:
+        """(source, response) for the drug and unknown routes."""
+        _discard(self.future, self.timings)
+        if self.function == FUNCTION_DRUG:
+            return "drug", answer_drug_question(self.args)
+        return None, UNKNOWN_REQUEST
+
+    def result(self, source: Optional[str], response: str) -> Dict[str, Any]:
+        pipeline_stats.record(self.timings)
+        return {"source": source, "response": response, "timings": self.timings}
+
+    def done(self, source: Optional[str], response: str) -> Dict[str, Any]:
+        pipeline_stats.record(self.timings)
+        return {"event": "done", "source": source, "response": response}
+
+
+def rag_inference(user_prompt: str, session_id: str = DEFAULT_SESSION_ID) -> Dict[str, Any]:
+    with Turn(user_prompt, session_id) as turn:
+        start = time.perf_counter()
+        turn.routed(route_prompt(user_prompt), start)
+        if turn.function != FUNCTION_FHIR:
+            return turn.result(*turn.non_fhir_answer())
+
+        retrieved_data = retrieve(user_prompt, turn.args, turn.memory, turn.future, turn.timings)
+        response = turn.cached(retrieved_data)
+        if response is None:
+            start = time.perf_counter()
+            response = generate_response(user_prompt, retrieved_data, turn.show_intro)
+            turn.generated(response, start)
+        turn.answered(response)
+        return turn.result("fhir", response)
+
+
+def rag_inference_stream(user_prompt: str, session_id: str = DEFAULT_SESSION_ID) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of rag_inference. Yields events:
+
+      {"event": "stage", "stage": "routing" | "retrieving" | "generating"}
+      {"event": "token", "text": "..."}
+      {"event": "done", "source": ..., "response": <full text>}
+    """
+    with Turn(user_prompt, session_id) as turn:
+        yield {"event": "stage", "stage": "routing"}
+        start = time.perf_counter()
+        turn.routed(route_prompt(user_prompt), start)
+        if turn.function != FUNCTION_FHIR:
+            if turn.function == FUNCTION_DRUG:
+                yield {"event": "stage", "stage": "retrieving"}
+            source, response = turn.non_fhir_answer()
+            yield {"event": "token", "text": response}
+            yield turn.done(source, response)
+            return
+
+        yield {"event": "stage", "stage": "retrieving"}
+        retrieved_data = retrieve(user_prompt, turn.args, turn.memory, turn.future, turn.timings)
+        yield {"event": "stage", "stage": "generating"}
+        response = turn.cached(retrieved_data)
+        if response is not None:
+            yield {"event": "token", "text": response}
+        else:
+            start = time.perf_counter()
+            chunks = []
+            for chunk in generate_response_stream(user_prompt, retrieved_data, turn.show_intro):
+                chunks.append(chunk)
+                yield {"event": "token", "text": chunk}
+            response = "".join(chunks).strip()
+            turn.generated(response, start)
+        turn.answered(response)
+        yield turn.done("fhir", response)
+
+
+# ---------- async pipeline ----------
+# Same flow as above, but the LLM calls are awaited on the shared pooled
+# client, so /ask doesn't need a worker thread per request. The prefetch runs
+# on its worker threads; the rest of retrieval (and the drug route's lookup)
+# runs in a thread via asyncio.to_thread so it never blocks the event loop.
+
+async def arag_inference(user_prompt: str, session_id: str = DEFAULT_SESSION_ID) -> Dict[str, Any]:
+    with Turn(user_prompt, session_id) as turn:
+        start = time.perf_counter()
+        turn.routed(await aroute_prompt(user_prompt), start)
+        if turn.function != FUNCTION_FHIR:
+            return turn.result(*await asyncio.to_thread(turn.non_fhir_answer))
+
+        retrieved_data = await aretrieve(user_prompt, turn.args, turn.memory, turn.future, turn.timings)
+        response = await asyncio.to_thread(turn.cached, retrieved_data)
+        if response is None:
+            start = time.perf_counter()
+            response = await agenerate_response(user_prompt, retrieved_data, turn.show_intro)
+            turn.generated(response, start)
+        turn.answered(response)
+        return turn.result("fhir", response)
+
+
+async def arag_inference_stream(user_prompt: str, session_id: str = DEFAULT_SESSION_ID) -> AsyncIterator[Dict[str, Any]]:
+    """Async variant of rag_inference_stream; yields the same events."""
+    with Turn(user_prompt, session_id) as turn:
+        yield {"event": "stage", "stage": "routing"}
+        start = time.perf_counter()
+        turn.routed(await aroute_prompt(user_prompt), start)
+        if turn.function != FUNCTION_FHIR:
+            if turn.function == FUNCTION_DRUG:
+                yield {"event": "stage", "stage": "retrieving"}
+            source, response = await asyncio.to_thread(turn.non_fhir_answer)
+            yield {"event": "token", "text": response}
+            yield turn.done(source, response)
+            return
+
+        yield {"event": "stage", "stage": "retrieving"}
+        retrieved_data = await aretrieve(user_prompt, turn.args, turn.memory, turn.future, turn.timings)
+        yield {"event": "stage", "stage": "generating"}
+        response = await asyncio.to_thread(turn.cached, retrieved_data)
+        if response is not None:
+            yield {"event": "token", "text": response}
+        else:
+            start = time.perf_counter()
+            chunks = []
+            async for chunk in agenerate_response_stream(user_prompt, retrieved_data, turn.show_intro):
+                chunks.append(chunk)
+                yield {"event": "token", "text": chunk}
+            response = "".join(chunks).strip()
+            turn.generated(response, start)
+        turn.answered(response)
+        yield turn.done("fhir", response)
 
 
 if __name__ == "__main__":
@@ -1,62 +1,45 @@
 # src/core/response_generator.py
 
-import requests, os
+from typing import AsyncIterator, Iterator
 from dotenv import load_dotenv
 
+from src.llm.model_runner import get_client, response_text
+from src.llm.prompt_templates import SALLY_SYSTEM_PROMPT, sally_user_message
+
 load_dotenv()
 
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/v1/completions")
-OLLAMA_MODEL   = os.getenv("OLLAMA_MODEL", "llama3")
-INTRO_SHOWN_FILE = ".intro_seen"
-
-def generate_response(user_prompt: str, retrieved_data: str) -> str:
-    # Determine whether to show intro
-    if not os.path.exists(INTRO_SHOWN_FILE):
-        intro = "Hi, I'm Sally — your AI pharmacist with 30 years of experience.\n\n"
-        with open(INTRO_SHOWN_FILE, "w") as f:
-            f.write("shown")
-    else:
-        intro = ""
-
-    system_prompt = (
-        "You are Sally, an experienced AI pharmacist with 30 years of clinical and community practice. "
-        "Your role is to assist patients with medication-related queries in a clear, empathetic manner.\n\n"
-
-        "Interaction Guidelines:\n"
-        "- Provide straightforward, empathetic, and patient-focused responses.\n"
-        "- Ask clarifying questions if needed.\n\n"
-
-        "Medication Safety & Information:\n"
-        "- Rely on provided patient-specific data (from RAG) and official drug information.\n"
-        "- Clearly state your sources when discussing side effects, dosages, or interactions.\n\n"
-
-        "Ethical & Safety Constraints:\n"
-        "- Never guess or hallucinate. If info is missing, say so.\n"
-        "- Do not diagnose or prescribe. Only offer info within a pharmacist's scope.\n\n"
-
-        "If the patient asks about diagnosis or treatment:\n"
-        "- 'I'm unable to diagnose or prescribe; please consult your healthcare provider.'\n"
-        "- 'That’s best discussed with your doctor.'"
-    )
 
-    full_prompt = (
-        f"{system_prompt}\n\n"
-        f"Patient question: \"{user_prompt}\"\n\n"
-        f"Patient-specific data:\n{retrieved_data}\n\n"
-        f"{intro}Please provide a concise, clinically accurate, and empathetic response following the above guidelines."
+def generate_response(user_prompt: str, retrieved_data: str, show_intro: bool = False) -> str:
+    data = get_client().complete(
+        SALLY_SYSTEM_PROMPT, sally_user_message(user_prompt, retrieved_data, show_intro), label="response"
     )
+    return response_text(data).strip()
+
 
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": full_prompt,
-        "stream": False
-    }
+def generate_response_stream(user_prompt: str, retrieved_data: str, show_intro: bool = False) -> Iterator[str]:
+    """
+    Same prompt as generate_response, but yields text chunks as Ollama
+    produces them.
+    """
+    for data in get_client().complete_stream(
+        SALLY_SYSTEM_PROMPT, sally_user_message(user_prompt, retrieved_data, show_intro), label="response"
+    ):
+        chunk = response_text(data)
+        if chunk:
+            yield chunk
 
-    response = requests.post(OLLAMA_API_URL, json=payload)
-    response.raise_for_status()
-    data = response.json()
 
-    #print("\n--- FULL RESPONSE JSON ---")
-    #print(data)
+async def agenerate_response(user_prompt: str, retrieved_data: str, show_intro: bool = False) -> str:
+    data = await get_client().acomplete(
+        SALLY_SYSTEM_PROMPT, sally_user_message(user_prompt, retrieved_data, show_intro), label="response"
+    )
+    return response_text(data).strip()
+
 
-    return data.get("response", "").strip()
+async def agenerate_response_stream(user_prompt: str, retrieved_data: str, show_intro: bool = False) -> AsyncIterator[str]:
+    async for data in get_client().acomplete_stream(
+        SALLY_SYSTEM_PROMPT, sally_user_message(user_prompt, retrieved_data, show_intro), label="response"
+    ):
+        chunk = response_text(data)
+        if chunk:
+            yield chunk
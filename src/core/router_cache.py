@@ -0,0 +1,231 @@
+# src/core/router_cache.py
+
+"""
+router_cache.py
+
+Bounded LRU + TTL cache of routing decisions, keyed by a normalized prompt
+(case, whitespace and punctuation folded) and the patient id.
+
+An opt-in near-duplicate tier (ROUTER_CACHE_NEAR_DUP=1) catches small
+rephrasings (an extra word, a trailing "please"). It compares MinHash
+signatures of character shingles and uses LSH banding to find candidates.
+Near-duplicate hits are limited to the given functions (the FHIR route, so a
+cached drug_name is never reused for a different question), and, since the
+route's arguments still come from the wording, to prompts whose
+`near_dup_terms` (e.g. the category and patient words they contain) are
+identical to the cached prompt's.
+
+Entries carry the router fingerprint (function definitions + allowed
+categories); if that changes, the whole cache is dropped.
+"""
+
+import copy
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "1024"))
+ROUTER_CACHE_TTL = float(os.getenv("ROUTER_CACHE_TTL", "3600"))
+ROUTER_CACHE_NEAR_DUP = os.getenv("ROUTER_CACHE_NEAR_DUP", "0") not in ("0", "false", "no")
+ROUTER_CACHE_NEAR_THRESHOLD = float(os.getenv("ROUTER_CACHE_NEAR_THRESHOLD", "0.8"))
+
+SHINGLE_SIZE = 4
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+_MERSENNE = (1 << 61) - 1
+# fixed seeds so signatures are stable across processes
+_PERMS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE)
+    for i in range(NUM_PERM)
+]
+
+_PUNCT = re.compile(r"[^\w\s]+")
+_WS = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    text = _PUNCT.sub(" ", prompt.lower())
+    return _WS.sub(" ", text).strip()
+
+
+def _shingle_hashes(text: str) -> Set[int]:
+    padded = f" {text} "
+    if len(padded) <= SHINGLE_SIZE:
+        grams = {padded}
+    else:
+        grams = {padded[i:i + SHINGLE_SIZE] for i in range(len(padded) - SHINGLE_SIZE + 1)}
+    return {
+        int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), "big")
+        for g in grams
+    }
+
+
+def minhash(text: str) -> Tuple[int, ...]:
+    hashes = _shingle_hashes(text)
+    return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in _PERMS)
+
+
+def _bands(sig: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [(i, sig[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS)]
+
+
+def _similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class RouterCache:
+    def __init__(
+        self,
+        maxsize: int = ROUTER_CACHE_SIZE,
+        ttl: float = ROUTER_CACHE_TTL,
+        near_dup: bool = ROUTER_CACHE_NEAR_DUP,
+        near_threshold: float = ROUTER_CACHE_NEAR_THRESHOLD,
+        near_dup_functions: Tuple[str, ...] = (),
+        near_dup_terms: Optional[Callable[[str], Hashable]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.near_dup = near_dup
+        self.near_threshold = near_threshold
+        self.near_dup_functions = set(near_dup_functions)
+        # normalized prompt -> what a near-duplicate must share with it
+        self.near_dup_terms = near_dup_terms or (lambda text: None)
+
+        # key -> (route, expires_at, signature or None, near_dup_terms)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], float, Optional[Tuple[int, ...]], Hashable]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[Tuple[str, str]]] = {}
+        self._fingerprint: Optional[str] = None
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._near_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    # ---------- internals (caller holds the lock) ----------
+
+    def _check_fingerprint(self, fingerprint: str) -> None:
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                self._invalidations += 1
+            self._entries.clear()
+            self._buckets.clear()
+            self._fingerprint = fingerprint
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        _, _, sig, _ = self._entries.pop(key)
+        if sig is not None:
+            for band in _bands(sig):
+                bucket_key = (key[0],) + band
+                bucket = self._buckets.get(bucket_key)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[bucket_key]
+
+    def _live(self, key: Tuple[str, str], now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            self._drop(key)
+            self._expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    # ---------- public API ----------
+
+    def get(self, prompt: str, patient: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        text = normalize_prompt(prompt)
+        key = (patient, text)
+        now = time.monotonic()
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            route = self._live(key, now)
+            if route is not None:
+                self._hits += 1
+                return copy.deepcopy(route)
+
+            if self.near_dup and text:
+                sig = minhash(text)
+                terms = self.near_dup_terms(text)
+                best, best_sim = None, 0.0
+                seen: Set[Tuple[str, str]] = set()
+                for band in _bands(sig):
+                    for cand in self._buckets.get((patient,) + band, ()):
+                        if cand in seen:
+                            continue
+                        seen.add(cand)
+                        _, _, cand_sig, cand_terms = self._entries[cand]
+                        if cand_terms != terms:
+                            continue
+                        sim = _similarity(sig, cand_sig)
+                        if sim > best_sim:
+                            best, best_sim = cand, sim
+                if best is not None and best_sim >= self.near_threshold:
+                    route = self._live(best, now)
+                    if route is not None:
+                        self._near_hits += 1
+                        return copy.deepcopy(route)
+
+            self._misses += 1
+            return None
+
+    def peek(self, prompt: str, patient: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """The exact-match route, if cached; not counted and doesn't touch the LRU order."""
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                return None
+            entry = self._entries.get((patient, normalize_prompt(prompt)))
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return copy.deepcopy(entry[0])
+
+    def put(self, prompt: str, patient: str, fingerprint: str, route: Dict[str, Any]) -> None:
+        text = normalize_prompt(prompt)
+        key = (patient, text)
+        sig = terms = None
+        if self.near_dup and text and route.get("function") in self.near_dup_functions:
+            sig = minhash(text)
+            terms = self.near_dup_terms(text)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (copy.deepcopy(route), time.monotonic() + self.ttl, sig, terms)
+            if sig is not None:
+                for band in _bands(sig):
+                    self._buckets.setdefault((patient,) + band, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._near_hits + self._misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self._hits,
+                "near_hits": self._near_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._near_hits) / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
@@ -0,0 +1,148 @@
+# src/core/summary_store.py
+
+"""
+summary_store.py
+
+Materialized per-patient category summaries.
+
+The text rendered for each router category only depends on the patient's
+bundle, so all six categories are rendered together on first access (or by
+warm()) and served from memory until the bundle's content hash changes.
+Bundles large enough to be streamed (FHIR_STREAM_MIN_BYTES) are the exception:
+only the categories asked for are rendered, from a projected parse.
+
+With FHIR_SUMMARY_DIR set, summaries are also written to
+<dir>/<patient>.json and reused after a restart as long as the bundle hash
+and SUMMARY_VERSION still match; the bundle itself isn't parsed in that case.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import src.fhir.getters as getters
+from src.core.fhir_query_builder import build_query, resource_types_for
+from src.fhir.client import fetch_projected_bundle, get_bundle_cache, should_stream
+
+FHIR_SUMMARY_DIR = os.getenv("FHIR_SUMMARY_DIR", "")
+
+# Bump when the getters' output format changes, to ignore stale files on disk
+SUMMARY_VERSION = 1
+
+CATEGORY_GETTERS = {
+    "generalInfo":        getters.get_general_info,
+    "allergies":          getters.get_allergies,
+    "conditions":         getters.get_conditions,
+    "currentMedications": getters.get_current_medications,
+    "observations":       getters.get_observations,
+    "carePlan":           getters.get_carePlan,
+}
+
+
+class SummaryStore:
+    def __init__(self, persist_dir: str = FHIR_SUMMARY_DIR):
+        self.persist_dir = persist_dir
+        # patient -> (bundle hash, {category: text})
+        self._summaries: Dict[str, Tuple[str, Dict[str, str]]] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._renders = 0
+        self._disk_loads = 0
+
+    # ---------- disk ----------
+
+    def _file(self, patient: str) -> str:
+        return os.path.join(self.persist_dir, f"{patient}.json")
+
+    def _load(self, patient: str, digest: str) -> Optional[Dict[str, str]]:
+        try:
+            with open(self._file(patient), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if data.get("version") != SUMMARY_VERSION or data.get("hash") != digest:
+            return None
+        summaries = data.get("summaries") or {}
+        if not set(summaries) <= set(CATEGORY_GETTERS):
+            return None
+        return summaries
+
+    def _save(self, patient: str, digest: str, summaries: Dict[str, str]) -> None:
+        os.makedirs(self.persist_dir, exist_ok=True)
+        path = self._file(patient)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": SUMMARY_VERSION, "hash": digest, "summaries": summaries}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    # ---------- lookups ----------
+
+    def _render(self, patient: str, path: str, categories: List[str]) -> Dict[str, str]:
+        if not should_stream(path):
+            categories = list(CATEGORY_GETTERS)  # cheap: render everything once
+        query = build_query(resource_types_for(categories), {"patient": patient})
+        bundle = fetch_projected_bundle(query)
+        return {cat: CATEGORY_GETTERS[cat](bundle) for cat in categories}
+
+    def get_many(self, patient: str, categories: Iterable[str]) -> List[str]:
+        """Texts for the known categories, in the order asked."""
+        wanted = [cat for cat in categories if cat in CATEGORY_GETTERS]
+        path = build_query([], {"patient": patient}).path
+        # Hashed before any parse: whatever gets rendered below is at least
+        # this version of the file, and a later change gets a new hash.
+        digest = get_bundle_cache().digest(path)
+
+        with self._lock:
+            cached = self._summaries.get(patient)
+            have = dict(cached[1]) if cached is not None and cached[0] == digest else {}
+            if all(cat in have for cat in wanted):
+                self._hits += 1
+                return [have[cat] for cat in wanted]
+
+        if not have and self.persist_dir:
+            have = self._load(patient, digest) or {}
+            if have:
+                with self._lock:
+                    self._disk_loads += 1
+
+        missing = [cat for cat in wanted if cat not in have]
+        if missing:
+            have.update(self._render(patient, path, missing))
+            with self._lock:
+                self._renders += 1
+            if self.persist_dir:
+                self._save(patient, digest, have)
+
+        with self._lock:
+            self._summaries[patient] = (digest, have)
+        return [have[cat] for cat in wanted]
+
+    def get(self, patient: str, category: str) -> Optional[str]:
+        texts = self.get_many(patient, [category])
+        return texts[0] if texts else None
+
+    def summaries(self, patient: str) -> Dict[str, str]:
+        """All six category texts for the patient."""
+        return dict(zip(CATEGORY_GETTERS, self.get_many(patient, CATEGORY_GETTERS)))
+
+    def warm(self, patients: Iterable[str]) -> None:
+        for patient in patients:
+            self.summaries(patient)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._summaries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "patients": len(self._summaries),
+                "hits": self._hits,
+                "renders": self._renders,
+                "disk_loads": self._disk_loads,
+                "persist_dir": self.persist_dir or None,
+            }
+
+
+summary_store = SummaryStore()
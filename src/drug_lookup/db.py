@@ -0,0 +1,217 @@
+"""
+db.py
+
+Shared, read-only access to the drug SQLite database.
+
+Connections are opened once and kept in a small thread-safe pool, so the
+lookup helpers don't pay for connect/schema parsing on every call. Each
+connection keeps its own prepared-statement cache, so callers should pass
+constant SQL strings and bind values as parameters.
+
+WAL mode is switched on by the ETL (a read-only connection can't change the
+journal mode); readers then never block on a rebuild in progress.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+DB_PATH = os.getenv("DRUG_DB_PATH", "data/drugs/drugs.db")
+POOL_SIZE = int(os.getenv("DRUG_DB_POOL_SIZE", "4"))
+POOL_TIMEOUT = float(os.getenv("DRUG_DB_POOL_TIMEOUT", "5"))
+MMAP_BYTES = int(os.getenv("DRUG_DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+CACHE_KIB = int(os.getenv("DRUG_DB_CACHE_KIB", "16384"))
+STATEMENT_CACHE_SIZE = 128
+
+
+class DrugDBPool:
+    """
+    Fixed-size pool of read-only SQLite connections.
+
+    Connections are created lazily up to `size`; when all of them are checked
+    out, callers wait (up to `timeout` seconds) for one to be returned.
+    """
+
+    def __init__(self, path: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT):
+        self.path = path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+        self._tables: Dict[str, bool] = {}
+
+        # counters
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._queries = 0
+        self._query_seconds = 0.0
+        self._max_query_seconds = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"Drug database not found: {self.path}")
+        uri = f"file:{os.path.abspath(self.path)}?mode=ro"
+        conn = sqlite3.connect(
+            uri,
+            uri=True,
+            check_same_thread=False,  # connections move between worker threads via the pool
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_BYTES}")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_KIB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Drug database pool is closed")
+            if self._opened < self.size:
+                self._opened += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(
+                f"Timed out after {self.timeout}s waiting for a drug database connection"
+            ) from None
+        finally:
+            waited = time.perf_counter() - start
+            with self._lock:
+                self._waits += 1
+                self._wait_seconds += waited
+        return conn
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            closed = self._closed
+        if closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _timed(self, fn, sql: str, params: Sequence[Any]):
+        with self.connection() as conn:
+            start = time.perf_counter()
+            try:
+                return fn(conn.execute(sql, params))
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self._queries += 1
+                    self._query_seconds += elapsed
+                    if elapsed > self._max_query_seconds:
+                        self._max_query_seconds = elapsed
+
+    def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+        return self._timed(lambda cur: cur.fetchone(), sql, params)
+
+    def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        return self._timed(lambda cur: cur.fetchall(), sql, params)
+
+    def has_table(self, name: str) -> bool:
+        """Whether `name` exists in the schema (cached for the pool's lifetime)."""
+        if name not in self._tables:
+            row = self.fetch_one(
+                "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,)
+            )
+            self._tables[name] = row is not None
+        return self._tables[name]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "path": self.path,
+                "size": self.size,
+                "open_connections": self._opened,
+                "idle_connections": self._idle.qsize(),
+                "pool_waits": self._waits,
+                "pool_wait_seconds": self._wait_seconds,
+                "queries": self._queries,
+                "query_seconds": self._query_seconds,
+                "avg_query_ms": (self._query_seconds / self._queries * 1000) if self._queries else 0.0,
+                "max_query_ms": self._max_query_seconds * 1000,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# ---------- module-level pool ----------
+
+_pool: Optional[DrugDBPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> DrugDBPool:
+    """Return the process-wide pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = DrugDBPool(DB_PATH)
+    return _pool
+
+
+def reset_pool() -> None:
+    """Close all pooled connections; the next query reopens against DB_PATH."""
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, None
+    if old is not None:
+        old.close()
+
+
+def fetch_one(sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+    return get_pool().fetch_one(sql, params)
+
+
+def fetch_all(sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+    return get_pool().fetch_all(sql, params)
+
+
+def has_table(name: str) -> bool:
+    return get_pool().has_table(name)
+
+
+def stats() -> Dict[str, Any]:
+    return get_pool().stats()
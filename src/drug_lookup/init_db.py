@@ -29,9 +29,18 @@ CREATE TABLE IF NOT EXISTS medication_knowledge (
     warnings TEXT,
     pharmacology TEXT,
     pregnancy_category TEXT,
-    source_url TEXT,
-    raw_text TEXT,
-    fhir_blob TEXT
+    source_url TEXT
+);
+""")
+
+# Compressed raw payloads, kept out of the knowledge table's pages
+cur.execute("""
+CREATE TABLE IF NOT EXISTS medication_raw (
+    medication_id TEXT PRIMARY KEY,
+    codec TEXT NOT NULL,
+    raw_size INTEGER,
+    raw BLOB,
+    fhir_blob BLOB
 );
 """)
 
@@ -0,0 +1,255 @@
+"""
+label_retriever.py
+
+Query-time semantic search over the drug-label FAISS index written by
+src/etl/build_faiss_index.py.
+
+The index is loaded once (memory-mapped where the index type allows it) and
+the MiniLM encoder is kept warm, so a request only pays for embedding the
+query and one search. The index and metadata files are re-checked at most
+every RETRIEVER_CHECK_SECONDS; when the ETL has rewritten them the index is
+reloaded (with the same encoder) and swapped in. Searches can be restricted to a set of drugs, e.g. the
+patient's medications; in that case only those drugs' section vectors are
+scored.
+
+Vector ids are the stable per-(medication, section) ids assigned by the
+builder; drug, section and text for each id come from its SQLite metadata
+database.
+
+faiss, numpy and sentence-transformers are optional: without them (or
+without a built index) the retriever reports itself unavailable and callers
+skip the semantic context.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from src.drug_lookup.match_fhir_to_drugs import normalize_drug_name
+
+try:
+    import faiss
+    import numpy as np
+except ImportError:  # semantic retrieval is optional
+    faiss = None
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "data/drugs/faiss_index.bin")
+FAISS_META_PATH = os.getenv("FAISS_META_PATH", "data/drugs/faiss_meta.db")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+RETRIEVER_ENABLED = os.getenv("RETRIEVER_ENABLED", "1") not in ("0", "false", "no")
+RETRIEVER_TOP_K = int(os.getenv("RETRIEVER_TOP_K", "3"))
+RETRIEVER_MIN_SCORE = float(os.getenv("RETRIEVER_MIN_SCORE", "0.3"))
+RETRIEVER_MAX_CHARS = int(os.getenv("RETRIEVER_MAX_CHARS", "600"))
+RETRIEVER_CHECK_SECONDS = float(os.getenv("RETRIEVER_CHECK_SECONDS", "2"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _file_signature(*paths: str) -> Tuple:
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+
+def _read_index(path: str):
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # not every index type can be mapped; fall back to reading it in
+        return faiss.read_index(path)
+
+
+class LabelRetriever:
+    def __init__(
+        self,
+        index_path: str = FAISS_INDEX_PATH,
+        meta_path: str = FAISS_META_PATH,
+        model_name: str = EMBED_MODEL,
+        encoder: Any = None,
+    ):
+        self.index_path = index_path
+        self.meta_path = meta_path
+        self.model_name = model_name
+        self.encoder = encoder
+        self.index = None
+        # vector id -> (drug, section, text)
+        self.sections: Dict[int, Tuple[str, str, str]] = {}
+        # normalized drug name -> vector ids of its sections
+        self._drug_ids: Dict[str, List[int]] = {}
+        # first word of a drug name -> [(normalized name, its words joined)]
+        self._by_first_word: Dict[str, List[Tuple[str, str]]] = {}
+
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._batches = 0
+        self._encode_seconds = 0.0
+        self._search_seconds = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.index is not None
+
+    def load(self) -> None:
+        if faiss is None or (self.encoder is None and SentenceTransformer is None):
+            raise RuntimeError("faiss / sentence-transformers are not installed")
+        index = _read_index(self.index_path)
+        conn = sqlite3.connect(f"file:{self.meta_path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT vector_id, drug, section, text FROM vectors").fetchall()
+        finally:
+            conn.close()
+        if self.encoder is None:
+            self.encoder = SentenceTransformer(self.model_name)
+            self.encoder.encode(["warm up"])  # first call pays for lazy init
+
+        sections: Dict[int, Tuple[str, str, str]] = {}
+        drug_ids: Dict[str, List[int]] = {}
+        for vid, drug, section, text in rows:
+            sections[vid] = (drug or "", section, text)
+            drug_ids.setdefault(normalize_drug_name(drug or ""), []).append(vid)
+        by_first_word: Dict[str, List[Tuple[str, str]]] = {}
+        for name in drug_ids:
+            words = _WORD.findall(name)
+            if words:
+                by_first_word.setdefault(words[0], []).append((name, " ".join(words)))
+
+        self.sections = sections
+        self._drug_ids = drug_ids
+        self._by_first_word = by_first_word
+        self.index = index
+
+    # ---------- drug filtering ----------
+
+    def drugs_in(self, texts: Iterable[str]) -> List[str]:
+        """Indexed drug names that appear (as whole words) in any of the texts."""
+        found: List[str] = []
+        for text in texts:
+            words = _WORD.findall(normalize_drug_name(text))
+            padded = f" {' '.join(words)} "
+            for word in set(words):
+                for name, phrase in self._by_first_word.get(word, ()):
+                    if name not in found and f" {phrase} " in padded:
+                        found.append(name)
+        return found
+
+    # ---------- search ----------
+
+    def _hit(self, i: int, score: float) -> Dict[str, Any]:
+        drug, section, text = self.sections[i]
+        return {"drug": drug, "section": section, "text": text, "score": float(score)}
+
+    def search_batch(
+        self,
+        queries: Sequence[str],
+        drugs: Optional[Iterable[str]] = None,
+        k: int = RETRIEVER_TOP_K,
+        min_score: float = RETRIEVER_MIN_SCORE,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Top-k label sections per query, best first. With `drugs`, only those
+        drugs' sections are considered (unknown names are ignored).
+        """
+        if not self.available:
+            raise RuntimeError("Label retriever is not loaded")
+        if not queries:
+            return []
+
+        start = time.perf_counter()
+        q = self.encoder.encode(list(queries), normalize_embeddings=True, convert_to_numpy=True)
+        q = np.ascontiguousarray(q, dtype="float32")
+        encoded = time.perf_counter()
+
+        results: List[List[Dict[str, Any]]] = []
+        if drugs is None:
+            scores, ids = self.index.search(q, k)
+            for row_scores, row_ids in zip(scores, ids):
+                results.append([
+                    self._hit(int(i), s) for s, i in zip(row_scores, row_ids)
+                    if i in self.sections and s >= min_score
+                ])
+        else:
+            ids = sorted({i for d in drugs for i in self._drug_ids.get(normalize_drug_name(d), ())})
+            if ids:
+                sims = q @ self.index.reconstruct_batch(np.asarray(ids, dtype="int64")).T
+            else:
+                sims = np.zeros((len(q), 0), dtype="float32")
+            for row in sims:
+                order = np.argsort(-row)[:k]
+                results.append([self._hit(ids[j], row[j]) for j in order if row[j] >= min_score])
+        done = time.perf_counter()
+
+        with self._lock:
+            self._queries += len(queries)
+            self._batches += 1
+            self._encode_seconds += encoded - start
+            self._search_seconds += done - encoded
+        return results
+
+    def search(self, query: str, drugs: Optional[Iterable[str]] = None, k: int = RETRIEVER_TOP_K) -> List[Dict[str, Any]]:
+        return self.search_batch([query], drugs, k)[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            batches = self._batches
+            return {
+                "available": self.available,
+                "vectors": self.index.ntotal if self.available else 0,
+                "queries": self._queries,
+                "batches": batches,
+                "avg_encode_ms": self._encode_seconds / batches * 1000 if batches else 0.0,
+                "avg_search_ms": self._search_seconds / batches * 1000 if batches else 0.0,
+            }
+
+
+# ---------- process-wide instance ----------
+
+_retriever: Optional[LabelRetriever] = None
+_signature: Optional[Tuple] = None
+_checked_at = 0.0
+_load_lock = threading.Lock()
+
+
+def get_retriever() -> Optional[LabelRetriever]:
+    """The loaded retriever, or None if disabled, not installed or not built.
+
+    Reloads the index when its files changed on disk since the last load.
+    """
+    global _retriever, _signature, _checked_at
+    now = time.monotonic()
+    if _signature is not None and now - _checked_at < RETRIEVER_CHECK_SECONDS:
+        return _retriever
+    with _load_lock:
+        if _signature is not None and now - _checked_at < RETRIEVER_CHECK_SECONDS:
+            return _retriever  # another thread checked while we waited
+        _checked_at = now
+        if not RETRIEVER_ENABLED or faiss is None or SentenceTransformer is None:
+            _signature = ()
+            return None
+        signature = _file_signature(FAISS_INDEX_PATH, FAISS_META_PATH)
+        if signature == _signature:
+            return _retriever
+        if None in signature:
+            # not built (yet), or mid-rewrite: keep whatever we have
+            if _retriever is None:
+                _signature = signature
+            return _retriever
+        encoder = _retriever.encoder if _retriever is not None else None
+        retriever = LabelRetriever(FAISS_INDEX_PATH, FAISS_META_PATH, encoder=encoder)
+        retriever.load()
+        _retriever = retriever
+        _signature = signature
+    return _retriever
@@ -1,50 +1,157 @@
+import re
 import sqlite3
-from typing import Optional
-
-DB_PATH = "data/drugs/drugs.db"
-
-def find_drug_by_rxnorm(rx_code: str) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM medication WHERE fhir_code = ?", (rx_code,))
-    row = cur.fetchone()
-    conn.close()
-
-    if row:
-        return {
-            "id": row[0],
-            "slug_id": row[1],
-            "name": row[3],
-            "manufacturer": row[4],
-            "strength": row[5],
-            "form": row[6],
-            "route": row[7],
-        }
-    return None
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.drug_lookup import db
+from src.drug_lookup.rxnorm_index import RXNORM_MAP_ENABLED, get_index
+
+FIND_BY_RXNORM_SQL = "SELECT * FROM medication WHERE fhir_code = ?"
+FIND_BY_RXNORM_IN_SQL = "SELECT * FROM medication WHERE fhir_code IN ({}) ORDER BY rowid"
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER on older builds
+IN_CHUNK_SIZE = 500
+
+# Trigram FTS lookup, ranked exact > prefix > substring, then insertion order.
+# `{column}` is name_norm first and generic_norm as a fallback.
+FIND_BY_NAME_FTS_SQL = """
+    SELECT m.* FROM medication_fts f
+    JOIN medication m ON m.id = f.medication_id
+    WHERE medication_fts MATCH ?
+    ORDER BY CASE
+        WHEN m.{column} = ? THEN 0
+        WHEN m.{column} LIKE ? ESCAPE '\\' THEN 1
+        ELSE 2
+    END, m.rowid
+    LIMIT 1
+"""
+FIND_BY_NAME_FTS = {
+    col: FIND_BY_NAME_FTS_SQL.format(column=col) for col in ("name_norm", "generic_norm")
+}
+# Trigrams need at least 3 characters; shorter names use a plain scan
+FIND_BY_NAME_SCAN_SQL = """
+    SELECT * FROM medication WHERE name_norm LIKE ? ESCAPE '\\'
+    ORDER BY CASE WHEN name_norm = ? THEN 0 WHEN name_norm LIKE ? ESCAPE '\\' THEN 1 ELSE 2 END, rowid
+    LIMIT 1
+"""
+# Databases built before name_norm/medication_fts existed
+FIND_BY_NAME_LEGACY_SQL = "SELECT * FROM medication WHERE LOWER(name) LIKE ?"
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_drug_name(name: Optional[str]) -> str:
+    """Lower-case and collapse whitespace; shared by the ETL and lookups."""
+    return _WS.sub(" ", (name or "").lower()).strip()
+
+def _like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _row_to_drug(row: sqlite3.Row) -> dict:
+    # `strength` only exists in the init_db.py schema, not the ETL one
+    keys = row.keys()
+    return {
+        "id": row["id"],
+        "slug_id": row["slug_id"],
+        "name": row["name"],
+        "generic_name": row["generic_name"] if "generic_name" in keys else None,
+        "manufacturer": row["manufacturer"],
+        "strength": row["strength"] if "strength" in keys else None,
+        "form": row["form"],
+        "route": row["route"],
+    }
+
+def find_drug_by_rxnorm(rx_code: str, use_map: bool = RXNORM_MAP_ENABLED) -> Optional[dict]:
+    if use_map:
+        row = get_index().get(rx_code)
+    else:
+        row = db.fetch_one(FIND_BY_RXNORM_SQL, (rx_code,))
+    return _row_to_drug(row) if row else None
 
 def find_drug_by_name(name: str) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM medication WHERE LOWER(name) LIKE ?", (f"%{name.lower()}%",))
-    row = cur.fetchone()
-    conn.close()
-
-    if row:
-        return {
-            "id": row[0],
-            "slug_id": row[1],
-            "name": row[3],
-            "manufacturer": row[4],
-            "strength": row[5],
-            "form": row[6],
-            "route": row[7],
-        }
+    query = normalize_drug_name(name)
+    if not query:
+        return None
+
+    if not db.has_table("medication_fts"):
+        row = db.fetch_one(FIND_BY_NAME_LEGACY_SQL, (f"%{name.lower()}%",))
+        return _row_to_drug(row) if row else None
+
+    escaped = _like_escape(query)
+    if len(query) < 3:
+        row = db.fetch_one(FIND_BY_NAME_SCAN_SQL, (f"%{escaped}%", query, f"{escaped}%"))
+        return _row_to_drug(row) if row else None
+
+    phrase = '"' + query.replace('"', '""') + '"'
+    for column, sql in FIND_BY_NAME_FTS.items():
+        row = db.fetch_one(sql, (f"{column} : {phrase}", query, f"{escaped}%"))
+        if row:
+            return _row_to_drug(row)
     return None
 
-def match_fhir_medication(med_fhir_entry: dict) -> Optional[dict]:
+def find_drugs_by_rxnorm(rx_codes: Iterable[str], use_map: bool = RXNORM_MAP_ENABLED) -> Dict[str, dict]:
+    """Resolve many RxNorm codes at once; codes without a match are left out."""
+    codes = list(dict.fromkeys(c for c in rx_codes if c))
+    found: Dict[str, dict] = {}
+    if use_map:
+        index = get_index()
+        for code in codes:
+            row = index.get(code)
+            if row:
+                found[code] = _row_to_drug(row)
+        return found
+
+    for i in range(0, len(codes), IN_CHUNK_SIZE):
+        chunk = codes[i:i + IN_CHUNK_SIZE]
+        sql = FIND_BY_RXNORM_IN_SQL.format(", ".join("?" * len(chunk)))
+        for row in db.fetch_all(sql, chunk):
+            # rows come back in rowid order, so the first one per code wins
+            found.setdefault(row["fhir_code"], _row_to_drug(row))
+    return found
+
+def _coding(med_fhir_entry: dict) -> Tuple[Optional[str], Optional[str]]:
     code_info = med_fhir_entry.get("code", {}).get("coding", [{}])[0]
-    rx_code = code_info.get("code")
-    name    = code_info.get("display")
+    return code_info.get("code"), code_info.get("display")
+
+def match_fhir_medication_list(
+    med_fhir_entries: Iterable[dict],
+    use_map: bool = RXNORM_MAP_ENABLED,
+) -> List[Optional[dict]]:
+    """
+    Batch version of match_fhir_medication.
+
+    All RxNorm codes are resolved together (in-memory map, or one IN query);
+    name matching only runs for the entries whose code didn't resolve, once
+    per distinct name. Returns one match (or None) per entry, in order.
+    """
+    entries: List[Tuple[Optional[str], Optional[str]]] = [_coding(med) for med in med_fhir_entries]
+
+    by_code = find_drugs_by_rxnorm((code for code, _ in entries), use_map=use_map)
+
+    by_name: Dict[str, Optional[dict]] = {}
+    results: List[Optional[dict]] = []
+    for rx_code, name in entries:
+        match = by_code.get(rx_code) if rx_code else None
+        if match is None and name:
+            if name not in by_name:
+                by_name[name] = find_drug_by_name(name)
+            match = by_name[name]
+        results.append(match)
+    return results
+
+def match_fhir_medications(
+    med_fhir_entries: Iterable[dict],
+    use_map: bool = RXNORM_MAP_ENABLED,
+) -> Dict[str, Optional[dict]]:
+    """
+    match_fhir_medication_list keyed by resource id; entries without an `id`
+    are keyed by their position.
+    """
+    entries = list(med_fhir_entries)
+    matches = match_fhir_medication_list(entries, use_map=use_map)
+    return {med.get("id") or str(i): match for i, (med, match) in enumerate(zip(entries, matches))}
+
+def match_fhir_medication(med_fhir_entry: dict) -> Optional[dict]:
+    rx_code, name = _coding(med_fhir_entry)
 
     if rx_code:
         result = find_drug_by_rxnorm(rx_code)
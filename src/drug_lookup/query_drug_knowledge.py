@@ -1,19 +1,14 @@
-import sqlite3
+from src.drug_lookup import db
 
-DB_PATH = "data/drugs/drugs.db"
+DRUG_KNOWLEDGE_SQL = """
+    SELECT indications, contraindications, side_effects, interactions, warnings
+    FROM medication_knowledge
+    JOIN medication ON medication.id = medication_knowledge.medication_id
+    WHERE medication.slug_id = ?
+"""
 
 def get_drug_knowledge(slug_id: str) -> str:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT indications, contraindications, side_effects, interactions, warnings
-        FROM medication_knowledge
-        JOIN medication ON medication.id = medication_knowledge.medication_id
-        WHERE medication.slug_id = ?
-    """, (slug_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = db.fetch_one(DRUG_KNOWLEDGE_SQL, (slug_id,))
 
     if not row:
         return "No detailed information found."
@@ -0,0 +1,70 @@
+"""
+raw_store.py
+
+Compressed storage for the full openFDA label JSON (and any FHIR blob).
+
+The raw payloads live in their own table, medication_raw, so their pages
+never mix with the medication_knowledge sections that the serving path
+reads. They are zstd-compressed when the zstandard package is installed and
+zlib-compressed otherwise; the codec is stored per row, so a database built
+with either can be read back as long as that codec is available.
+
+Nothing on the request path reads this table; use get_raw_label() when the
+original label is actually needed (debugging, re-processing).
+"""
+
+import json
+import os
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+from src.drug_lookup import db
+
+try:
+    import zstandard
+except ImportError:  # zlib is always available
+    zstandard = None
+
+RAW_CODEC = os.getenv("DRUG_RAW_CODEC", "zstd" if zstandard is not None else "zlib")
+ZSTD_LEVEL = int(os.getenv("DRUG_RAW_ZSTD_LEVEL", "10"))
+ZLIB_LEVEL = int(os.getenv("DRUG_RAW_ZLIB_LEVEL", "6"))
+
+RAW_LABEL_SQL = """
+    SELECT r.codec, r.raw
+    FROM medication_raw r
+    JOIN medication m ON m.id = r.medication_id
+    WHERE m.slug_id = ?
+"""
+
+
+def compress(text: Optional[str], codec: str = RAW_CODEC) -> Tuple[str, Optional[bytes]]:
+    if text is None:
+        return codec, None
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed; set DRUG_RAW_CODEC=zlib")
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if codec == "zlib":
+        return codec, zlib.compress(data, ZLIB_LEVEL)
+    raise ValueError(f"Unknown raw codec: {codec}")
+
+
+def decompress(codec: str, blob: Optional[bytes]) -> Optional[str]:
+    if blob is None:
+        return None
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read labels stored with zstd")
+        return zstandard.ZstdDecompressor().decompress(blob).decode("utf-8")
+    if codec == "zlib":
+        return zlib.decompress(blob).decode("utf-8")
+    raise ValueError(f"Unknown raw codec: {codec}")
+
+
+def get_raw_label(slug_id: str) -> Optional[Dict[str, Any]]:
+    """The original openFDA label for a medication, or None."""
+    row = db.fetch_one(RAW_LABEL_SQL, (slug_id,))
+    if row is None or row["raw"] is None:
+        return None
+    return json.loads(decompress(row["codec"], row["raw"]))
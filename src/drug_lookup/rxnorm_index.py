@@ -0,0 +1,160 @@
+"""
+rxnorm_index.py
+
+In-process RxNorm code -> medication row map, so coded FHIR medications can be
+resolved without a SQLite round trip.
+
+The map is rebuilt when the drug database changes on disk. We compare a cheap
+stat() signature of the DB file and its WAL (at most once every
+RXNORM_MAP_CHECK_SECONDS) and, on reload, record the build version the ETL
+writes into `etl_meta`. With the map disabled, db_version() still tracks that
+version (same stat() check) without loading the map.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from src.drug_lookup import db
+
+RXNORM_MAP_ENABLED = os.getenv("RXNORM_MAP_ENABLED", "1") not in ("0", "false", "no")
+CHECK_INTERVAL = float(os.getenv("RXNORM_MAP_CHECK_SECONDS", "2"))
+
+# Lowest rowid wins, matching what `WHERE fhir_code = ?` returned first
+LOAD_SQL = """
+    SELECT * FROM medication
+    WHERE fhir_code IS NOT NULL AND fhir_code != ''
+    ORDER BY rowid
+"""
+VERSION_SQL = "SELECT value FROM etl_meta WHERE key = 'version'"
+
+
+def _file_signature(path: str) -> Tuple:
+    sig = []
+    for p in (path, f"{path}-wal"):
+        try:
+            st = os.stat(p)
+            sig.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+
+def _read_version() -> Optional[str]:
+    if not db.has_table("etl_meta"):
+        return None
+    row = db.fetch_one(VERSION_SQL)
+    return row["value"] if row else None
+
+
+class RxNormIndex:
+    def __init__(self, check_interval: float = CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._codes: Dict[str, sqlite3.Row] = {}
+        self._path: Optional[str] = None
+        self._signature: Optional[Tuple] = None
+        self._checked_at = 0.0
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self._loads = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._signature is not None
+
+    def load(self, force: bool = True) -> None:
+        """(Re)build the map from the current database."""
+        with self._lock:
+            path = db.DB_PATH
+            signature = _file_signature(path)
+            if not force and path == self._path and signature == self._signature:
+                return  # another thread reloaded while we waited for the lock
+            if self._signature is not None and signature != self._signature:
+                # The file changed underneath the pool (rebuilt or replaced):
+                # drop pooled connections and cached schema info as well.
+                db.reset_pool()
+
+            codes: Dict[str, sqlite3.Row] = {}
+            for row in db.fetch_all(LOAD_SQL):
+                codes.setdefault(row["fhir_code"], row)
+
+            version = _read_version()
+
+            self._codes = codes
+            self._version = version
+            self._path = path
+            self._signature = signature
+            self._checked_at = time.monotonic()
+            self._loads += 1
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if (
+            self._signature is not None
+            and self._path == db.DB_PATH
+            and now - self._checked_at < self.check_interval
+        ):
+            return
+        self._checked_at = now
+        if self._path != db.DB_PATH or _file_signature(db.DB_PATH) != self._signature:
+            self.load(force=False)
+
+    def get(self, rx_code: str) -> Optional[sqlite3.Row]:
+        self._maybe_reload()
+        row = self._codes.get(rx_code)
+        if row is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return row
+
+    def version(self) -> Optional[str]:
+        """Build version of the drug DB currently on disk."""
+        self._maybe_reload()
+        return self._version
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": RXNORM_MAP_ENABLED,
+            "codes": len(self._codes),
+            "version": self._version,
+            "loads": self._loads,
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+
+_index = RxNormIndex()
+
+
+def get_index() -> RxNormIndex:
+    return _index
+
+
+_version: Optional[str] = None
+_version_key: Optional[Tuple] = None
+_version_checked_at = 0.0
+_version_lock = threading.Lock()
+
+
+def db_version() -> Optional[str]:
+    """Build version of the drug DB on disk, without loading the map when it's disabled."""
+    global _version, _version_key, _version_checked_at
+    if RXNORM_MAP_ENABLED:
+        return _index.version()
+    now = time.monotonic()
+    if _version_key is not None and now - _version_checked_at < CHECK_INTERVAL:
+        return _version
+    with _version_lock:
+        _version_checked_at = now
+        key = (db.DB_PATH, _file_signature(db.DB_PATH))
+        if key != _version_key:
+            if _version_key is not None:
+                db.reset_pool()  # as in RxNormIndex.load: the file may have been replaced
+            _version = _read_version()
+            _version_key = key
+    return _version
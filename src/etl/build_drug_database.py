@@ -1,7 +1,34 @@
-import os, json, re, sqlite3, uuid
+import os, sys, json, re, sqlite3, time, uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+# Add the project root to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.drug_lookup.match_fhir_to_drugs import normalize_drug_name
+from src.drug_lookup.raw_store import RAW_CODEC, compress
 
 RAW = 'data/drugs/raw'
 DB  = 'data/drugs/drugs.db'
+WORKERS = int(os.getenv('ETL_WORKERS', str(os.cpu_count() or 1)))
+BATCH_SIZE = 5000
+# How medication.id is derived; a database built under another scheme is reloaded
+ID_SCHEME = 'set_id'
+
+INGEST_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",  # 256 MB
+)
+# First build only: it goes into DB + ".tmp", which is renamed into place
+# once complete, so a crash mid-build costs a rerun and nobody reads it early.
+# Incremental builds update the live file and keep synchronous=NORMAL.
+FRESH_BUILD_PRAGMAS = ("PRAGMA synchronous=OFF",)
+# Created after the load: a fresh build loads without them, an incremental
+# one keeps them (readers of the live database still need them)
+SECONDARY_INDEXES = {
+    "idx_medication_name_norm": "CREATE INDEX IF NOT EXISTS idx_medication_name_norm ON medication(name_norm)",
+    "idx_medication_fhir_code": "CREATE INDEX IF NOT EXISTS idx_medication_fhir_code ON medication(fhir_code)",
+}
 
 def normalize(x):
     if isinstance(x, list):
@@ -13,13 +40,85 @@ def slugify(text: str) -> str:
     s = re.sub(r'[^a-z0-9]+', '-', s)
     return s.strip('-')
 
-def process(path):
-    with open(path) as f:
-        raw = json.load(f)
-    med_id = str(uuid.uuid4())
+def raw_files(raw_dir):
+    """NDJSON shards (fetch_openfda_labels) and legacy one-label .json files."""
+    return [
+        os.path.join(raw_dir, fname) for fname in sorted(os.listdir(raw_dir))
+        if fname.endswith(".ndjson") or (fname.endswith(".json") and fname != "checkpoint.json")
+    ]
+
+# Cheap look at a shard line before paying for json.loads; "spl_set_id"
+# and friends don't match because of the leading quote
+_SET_ID = re.compile(r'"set_id"\s*:\s*"([^"\\]+)"')
+_EFFECTIVE_TIME = re.compile(r'"effective_time"\s*:\s*"([^"\\]*)"')
+
+# set_id -> effective_time already in the database; set per worker process
+_known = {}
+
+def _init_worker(known):
+    global _known
+    _known = known
+
+def label_id(raw):
+    """Stable medication id: the openFDA set_id, which survives label revisions."""
+    key = raw.get('set_id') or raw.get('id')
+    if key:
+        return key
+    ofda = raw.get('openfda', {})
+    name = normalize(ofda.get('brand_name') or ofda.get('generic_name'))
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, slugify(f"{name} {normalize(ofda.get('manufacturer_name'))}")))
+
+def is_current(med_id, effective_time):
+    """True when the database already has this label at this revision or newer."""
+    have = _known.get(med_id)
+    return have is not None and bool(effective_time) and effective_time <= have
+
+def parse_file(path):
+    """
+    (rows, unchanged ids) for one raw file, where rows are (drug, knowledge,
+    raw) for new or revised labels. Runs in worker processes.
+    """
+    rows, unchanged = [], []
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".ndjson"):
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                set_id, effective = _SET_ID.search(line), _EFFECTIVE_TIME.search(line)
+                if set_id and effective and is_current(set_id.group(1), effective.group(1)):
+                    unchanged.append(set_id.group(1))
+                    continue
+                raw = json.loads(line)
+                if is_current(label_id(raw), raw.get('effective_time')):
+                    unchanged.append(label_id(raw))
+                else:
+                    # the shard line already is compact JSON; store it as-is
+                    rows.append(process(raw, line))
+        else:
+            raw = json.load(f)
+            if is_current(label_id(raw), raw.get('effective_time')):
+                unchanged.append(label_id(raw))
+            else:
+                rows.append(process(raw))
+    return rows, unchanged
+
+def iter_parsed(paths, known, workers=None):
+    workers = WORKERS if workers is None else workers
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(known,)) as pool:
+            # results come back in file order
+            yield from pool.map(parse_file, paths, chunksize=max(1, len(paths) // (workers * 8)))
+    else:
+        _init_worker(known)
+        yield from map(parse_file, paths)
+
+def process(raw, raw_text=None):
+    med_id = label_id(raw)
     ofda = raw.get('openfda', {})
 
     name = normalize(ofda.get('brand_name') or ofda.get('generic_name'))
+    generic_name = normalize(ofda.get('generic_name'))
     manufacturer = normalize(ofda.get('manufacturer_name'))
     slug_id = slugify(f"{name} {manufacturer}")
 
@@ -28,6 +127,9 @@ def process(path):
         'slug_id': slug_id,
         'fhir_code': ofda.get('rxcui', [''])[0] or ofda.get('rxnorm_code', [''])[0],
         'name': name,
+        'name_norm': normalize_drug_name(name),
+        'generic_name': generic_name,
+        'generic_norm': normalize_drug_name(generic_name),
         'manufacturer': manufacturer,
         'form': normalize(raw.get('dosage_form')),
         'route': normalize(ofda.get('route')),
@@ -41,15 +143,215 @@ def process(path):
         'side_effects': normalize(raw.get('adverse_reactions')),
         'interactions': normalize(raw.get('drug_interactions')),
         'warnings': normalize(raw.get('warnings_and_cautions')),
-        'raw_text': json.dumps(raw),
-        'fhir_blob': None
     }
 
-    return drug, knowledge
+    # compressed here, in the worker process, rather than in the writer
+    raw_text = raw_text or json.dumps(raw, separators=(',', ':'))
+    codec, blob = compress(raw_text)
+    stored = {
+        'medication_id': med_id,
+        'codec': codec,
+        'raw_size': len(raw_text.encode('utf-8')),
+        'raw': blob,
+        'fhir_blob': None,
+    }
+
+    return drug, knowledge, stored
 
-def main():
-    conn = sqlite3.connect(DB)
+def ensure_columns(cur, table, columns):
+    """Add columns introduced after a database was first built."""
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    for col, decl in columns:
+        if col not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+def migrate_raw_columns(cur):
+    """
+    Move raw_text / fhir_blob from a pre-medication_raw medication_knowledge
+    into medication_raw, compressing as we go, then drop the old columns.
+    Unchanged labels are never re-parsed, so this is their only way across.
+    Returns True if anything was dropped (the caller VACUUMs to reclaim it).
+    """
+    existing = {row[1] for row in cur.execute("PRAGMA table_info(medication_knowledge)")}
+    moved = [col for col in ("raw_text", "fhir_blob") if col in existing]
+    if not moved:
+        return False
+    raw_text = "k.raw_text" if "raw_text" in existing else "NULL"
+    fhir_blob = "k.fhir_blob" if "fhir_blob" in existing else "NULL"
+    rows = cur.connection.execute(f"""
+        SELECT k.medication_id, {raw_text}, {fhir_blob}
+        FROM medication_knowledge k
+        WHERE NOT EXISTS (SELECT 1 FROM medication_raw r WHERE r.medication_id = k.medication_id)
+    """)
+    while True:
+        batch = rows.fetchmany(BATCH_SIZE)
+        if not batch:
+            break
+        raws = []
+        for med_id, text, fhir in batch:
+            codec, blob = compress(text)
+            raws.append({
+                'medication_id': med_id,
+                'codec': codec,
+                'raw_size': len(text.encode('utf-8')) if text is not None else None,
+                'raw': blob,
+                'fhir_blob': compress(fhir, codec)[1],
+            })
+        cur.executemany(UPSERT_RAW, raws)
+    drop_columns(cur, "medication_knowledge", moved)
+    return True
+
+def drop_columns(cur, table, columns):
+    """Remove columns that have moved elsewhere (raw_text, fhir_blob -> medication_raw)."""
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    for col in columns:
+        if col in existing:
+            cur.execute(f"ALTER TABLE {table} DROP COLUMN {col}")
+
+def rebuild_name_index(cur):
+    """
+    (Re)build the trigram FTS5 index over brand and generic names used by
+    find_drug_by_name. Trigrams give substring matches without a table scan.
+    """
+    cur.execute("DROP TABLE IF EXISTS medication_fts")
+    cur.execute("""
+    CREATE VIRTUAL TABLE medication_fts USING fts5(
+        medication_id UNINDEXED,
+        name_norm,
+        generic_norm,
+        tokenize = 'trigram'
+    )""")
+    cur.execute("""
+    INSERT INTO medication_fts (medication_id, name_norm, generic_norm)
+    SELECT id, name_norm, generic_norm FROM medication
+    """)
+
+def write_version(cur):
+    """Stamp the build so the API's in-memory maps know to reload."""
+    cur.execute("CREATE TABLE IF NOT EXISTS etl_meta (key TEXT PRIMARY KEY, value TEXT)")
+    cur.execute(
+        "INSERT OR REPLACE INTO etl_meta (key, value) VALUES ('version', ?)",
+        (f"{datetime.now(timezone.utc).isoformat()}-{uuid.uuid4().hex[:8]}",),
+    )
+
+def size_report(cur):
+    """Print the size of each table (with its indexes) and the raw payload compression."""
+    try:
+        sizes = cur.execute("""
+            SELECT COALESCE(m.tbl_name, s.name) AS tbl, SUM(s.pgsize)
+            FROM dbstat s LEFT JOIN sqlite_master m ON m.name = s.name
+            GROUP BY tbl ORDER BY 2 DESC
+        """).fetchall()
+    except sqlite3.OperationalError:
+        sizes = []  # SQLite built without dbstat
+    for table, size in sizes:
+        print(f"  {table:<24} {size / 1e6:9.1f} MB")
+    raw_size, stored = cur.execute(
+        "SELECT COALESCE(SUM(raw_size), 0), COALESCE(SUM(LENGTH(raw)), 0) FROM medication_raw"
+    ).fetchone()
+    if raw_size:
+        print(f"  raw labels: {raw_size / 1e6:.1f} MB → {stored / 1e6:.1f} MB "
+              f"({RAW_CODEC}, {raw_size / max(stored, 1):.1f}x)")
+
+UPSERT_MEDICATION = """
+    INSERT INTO medication (id, slug_id, fhir_code, name, name_norm, generic_name, generic_norm, manufacturer, form, route, last_updated)
+    VALUES (:id, :slug_id, :fhir_code, :name, :name_norm, :generic_name, :generic_norm, :manufacturer, :form, :route, :last_updated)
+    ON CONFLICT(id) DO UPDATE SET
+        slug_id = excluded.slug_id, fhir_code = excluded.fhir_code, name = excluded.name,
+        name_norm = excluded.name_norm, generic_name = excluded.generic_name,
+        generic_norm = excluded.generic_norm, manufacturer = excluded.manufacturer,
+        form = excluded.form, route = excluded.route, last_updated = excluded.last_updated
+"""
+UPSERT_KNOWLEDGE = """
+    INSERT OR REPLACE INTO medication_knowledge (medication_id, indications, contraindications, side_effects, interactions, warnings)
+    VALUES (:medication_id, :indications, :contraindications, :side_effects, :interactions, :warnings)
+"""
+UPSERT_RAW = """
+    INSERT OR REPLACE INTO medication_raw (medication_id, codec, raw_size, raw, fhir_blob)
+    VALUES (:medication_id, :codec, :raw_size, :raw, :fhir_blob)
+"""
+
+def load(cur, paths, prune=False):
+    """
+    Upsert new and revised labels with executemany in BATCH_SIZE chunks.
+    Returns counts: inserted, updated, unchanged, duplicates (a different
+    set_id already owns the slug) and pruned (gone from RAW, with prune).
+    Each set_id is counted once, however many copies of it RAW holds.
+    """
+    known, slug_of = {}, {}
+    for med_id, slug_id, last_updated in cur.execute("SELECT id, slug_id, last_updated FROM medication"):
+        known[med_id] = last_updated or ''
+        slug_of[med_id] = slug_id
+    existing = set(known)
+    slugs = {slug_id: med_id for med_id, slug_id in slug_of.items()}
+    counts = dict.fromkeys(("inserted", "updated", "unchanged", "duplicates", "pruned"), 0)
+    seen = {}  # set_id -> what happened to it in this run
+    meds, know, raws = [], [], []
+
+    def tally(med_id, outcome):
+        prev = seen.get(med_id)
+        if prev == outcome or (prev is not None and outcome not in ("inserted", "updated")):
+            return  # an earlier copy of this set_id already counted
+        if prev is not None:
+            counts[prev] -= 1
+        seen[med_id] = outcome
+        counts[outcome] += 1
+
+    def flush():
+        cur.executemany(UPSERT_MEDICATION, meds)
+        cur.executemany(UPSERT_KNOWLEDGE, know)
+        cur.executemany(UPSERT_RAW, raws)
+        meds.clear()
+        know.clear()
+        raws.clear()
+
+    for rows, unchanged in iter_parsed(paths, known):
+        for med_id in unchanged:
+            tally(med_id, "unchanged")
+        for drug, k, r in rows:
+            med_id, slug_id, effective = drug['id'], drug['slug_id'], drug['last_updated']
+            # the same set_id can show up twice (API pages and bulk shards): newest wins
+            if known.get(med_id) and effective and effective <= known[med_id]:
+                tally(med_id, "unchanged")
+                continue
+            owner = slugs.get(slug_id)
+            if owner is not None and owner != med_id:
+                tally(med_id, "duplicates")
+                continue
+            tally(med_id, "updated" if med_id in existing else "inserted")
+            slugs.pop(slug_of.get(med_id), None)
+            known[med_id], slug_of[med_id], slugs[slug_id] = effective or '', slug_id, med_id
+            meds.append(drug)
+            know.append(k)
+            raws.append(r)
+        if len(meds) >= BATCH_SIZE:
+            flush()
+    flush()
+
+    if prune:
+        gone = [(med_id,) for med_id in known if med_id not in seen]
+        for table, column in (("medication_raw", "medication_id"), ("medication_knowledge", "medication_id"), ("medication", "id")):
+            cur.executemany(f"DELETE FROM {table} WHERE {column} = ?", gone)
+        counts["pruned"] = len(gone)
+    return counts
+
+def main(prune=False):
+    start = time.perf_counter()
+    fresh = not os.path.exists(DB)
+    path = DB + ".tmp" if fresh else DB
+    if fresh:
+        # leftovers of a build that crashed
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    conn = sqlite3.connect(path)
     cur = conn.cursor()
+    # WAL lets the API's read-only connections keep serving during a rebuild
+    cur.execute("PRAGMA journal_mode=WAL")
+    for pragma in FRESH_BUILD_PRAGMAS if fresh else ("PRAGMA synchronous=NORMAL",):
+        cur.execute(pragma)
+    for pragma in INGEST_PRAGMAS:
+        cur.execute(pragma)
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS medication (
@@ -57,11 +359,19 @@ def main():
         slug_id TEXT UNIQUE,
         fhir_code TEXT,
         name TEXT,
+        name_norm TEXT,
+        generic_name TEXT,
+        generic_norm TEXT,
         manufacturer TEXT,
         form TEXT,
         route TEXT,
         last_updated TEXT
     )""")
+    ensure_columns(cur, "medication", [
+        ("name_norm", "TEXT"),
+        ("generic_name", "TEXT"),
+        ("generic_norm", "TEXT"),
+    ])
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS medication_knowledge (
@@ -70,19 +380,70 @@ def main():
         contraindications TEXT,
         side_effects TEXT,
         interactions TEXT,
-        warnings TEXT,
-        raw_text TEXT,
-        fhir_blob TEXT
+        warnings TEXT
+    )""")
+
+    # Raw payloads live apart from the sections the API reads
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS medication_raw (
+        medication_id TEXT PRIMARY KEY,
+        codec TEXT NOT NULL,
+        raw_size INTEGER,
+        raw BLOB,
+        fhir_blob BLOB
     )""")
 
-    for fname in os.listdir(RAW):
-        if fname.endswith(".json"):
-            drug, know = process(os.path.join(RAW, fname))
-            cur.execute("""INSERT OR IGNORE INTO medication VALUES (:id, :slug_id, :fhir_code, :name, :manufacturer, :form, :route, :last_updated)""", drug)
-            cur.execute("""INSERT OR IGNORE INTO medication_knowledge VALUES (:medication_id, :indications, :contraindications, :side_effects, :interactions, :warnings, :raw_text, :fhir_blob)""", know)
+    cur.execute("CREATE TABLE IF NOT EXISTS etl_meta (key TEXT PRIMARY KEY, value TEXT)")
+    scheme = cur.execute("SELECT value FROM etl_meta WHERE key = 'id_scheme'").fetchone()
+    if scheme is None or scheme[0] != ID_SCHEME:
+        # rows keyed by the old random ids can't be matched to labels; start over
+        for table in ("medication_raw", "medication_knowledge", "medication"):
+            cur.execute(f"DELETE FROM {table}")
+        cur.execute("INSERT OR REPLACE INTO etl_meta (key, value) VALUES ('id_scheme', ?)", (ID_SCHEME,))
+    # after the reset: nothing left to move then, only the old columns to drop
+    migrated = migrate_raw_columns(cur)
+
+    # one transaction from the first write through the index rebuild
+    counts = load(cur, raw_files(RAW), prune=prune)
+    loaded = time.perf_counter()
+    labels = counts["inserted"] + counts["updated"] + counts["unchanged"] + counts["duplicates"]
+    changed = counts["inserted"] + counts["updated"] + counts["pruned"]
+
+    # Backfill rows written before name_norm existed, then index
+    for row_id, name, generic in cur.execute(
+        "SELECT id, name, generic_name FROM medication WHERE name_norm IS NULL"
+    ).fetchall():
+        cur.execute(
+            "UPDATE medication SET name_norm = ?, generic_norm = ? WHERE id = ?",
+            (normalize_drug_name(name), normalize_drug_name(generic), row_id),
+        )
+    if changed:
+        rebuild_name_index(cur)
+    for sql in SECONDARY_INDEXES.values():
+        cur.execute(sql)
+    if changed:
+        write_version(cur)
 
     conn.commit()
+    if migrated:
+        # DROP COLUMN only frees pages; hand them back so the file shrinks
+        conn.execute("VACUUM")
+    if fresh:
+        # make the build durable before it becomes visible under DB
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    if fresh:
+        os.replace(path, DB)
+    elapsed = time.perf_counter() - start
+    print(f"✓ Loaded {labels} labels in {loaded - start:.1f}s ({labels / max(loaded - start, 1e-9):,.0f} rows/sec), "
+          f"indexed in {elapsed - (loaded - start):.1f}s → {DB}")
+    print(f"  {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged, "
+          f"{counts['duplicates']} skipped (slug owned by another set_id), {counts['pruned']} pruned")
+    conn = sqlite3.connect(DB)
+    size_report(conn.cursor())
     conn.close()
+    return counts
 
 if __name__ == '__main__':
-    main()
+    main(prune="--prune" in sys.argv[1:])
@@ -1,39 +1,146 @@
-import sqlite3, faiss, json
-from sentence_transformers import SentenceTransformer
+"""
+build_faiss_index.py
+
+Incrementally maintains the drug-label FAISS index.
+
+Every (medication_id, section) pair gets a stable 63-bit vector id, and the
+index is an IndexIDMap2 over a flat inner-product index, so vectors can be
+replaced and removed in place. Per-vector metadata (drug, section, text and
+a hash of the text) lives in a small SQLite database next to the index.
+
+On each run only sections whose text hash changed are re-embedded, and
+vectors for sections or medications that disappeared are removed. A
+renamed medication with unchanged text only has its metadata updated. Pass
+--full to rebuild from scratch (e.g. after changing the embedding model).
+Embeddings go through the content-addressed cache in embedding_cache.py, so
+even a full rebuild only runs the model on text it hasn't seen before.
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+
+import faiss
+import numpy as np
+
+# Add the project root to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.etl.embedding_cache import EMBED_CACHE, EmbeddingCache, text_hash
 
 DB = 'data/drugs/drugs.db'
 INDEX = 'data/drugs/faiss_index.bin'
-META = 'data/drugs/faiss_metadata.json'
-
-def main():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT m.name, k.side_effects, k.interactions, k.warnings
-        FROM medication m JOIN medication_knowledge k ON m.id = k.medication_id
-    """)
-    rows = cur.fetchall()
-    conn.close()
-
-    texts, metadata = [], []
-    for name, side, inter, warn in rows:
-        for section, text in [('side_effects', side), ('interactions', inter), ('warnings', warn)]:
+META = 'data/drugs/faiss_meta.db'
+MODEL = 'all-MiniLM-L6-v2'
+SECTIONS = ('side_effects', 'interactions', 'warnings')
+BATCH_SIZE = 256
+
+def vector_id(medication_id: str, section: str) -> int:
+    digest = hashlib.blake2b(f"{medication_id}:{section}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 63) - 1)
+
+def open_meta(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vectors (
+        vector_id INTEGER PRIMARY KEY,
+        medication_id TEXT NOT NULL,
+        drug TEXT,
+        section TEXT NOT NULL,
+        text_hash TEXT NOT NULL,
+        text TEXT NOT NULL
+    )""")
+    conn.execute("CREATE TABLE IF NOT EXISTS build_meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def current_sections(db_path):
+    """vector_id -> (medication_id, drug, section, text) for every non-empty section."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("""
+            SELECT m.id, m.name, k.side_effects, k.interactions, k.warnings
+            FROM medication m JOIN medication_knowledge k ON m.id = k.medication_id
+        """).fetchall()
+    finally:
+        conn.close()
+
+    sections = {}
+    for med_id, name, *texts in rows:
+        for section, text in zip(SECTIONS, texts):
             if text:
-                texts.append(text)
-                metadata.append({'drug': name, 'section': section})
+                sections[vector_id(med_id, section)] = (med_id, name, section, text)
+    return sections
 
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    embs = model.encode(texts, show_progress_bar=True)
+def encode(cache, model, texts):
+    embs = np.ascontiguousarray(cache.encode(model, texts, batch_size=BATCH_SIZE), dtype="float32")
     faiss.normalize_L2(embs)
+    return embs
+
+def load_index(path, dim, full):
+    if not full and os.path.exists(path):
+        index = faiss.read_index(path)
+        if isinstance(index, faiss.IndexIDMap2):
+            return index
+        print("Existing index is not ID-mapped; rebuilding from scratch.")
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+def write_index(index, path):
+    tmp = f"{path}.tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, path)
+
+def main(full=False, db_path=DB, index_path=INDEX, meta_path=META, model=None, cache_path=EMBED_CACHE):
+    meta = open_meta(meta_path)
+    built_with = meta.execute("SELECT value FROM build_meta WHERE key = 'model'").fetchone()
+    if built_with and built_with[0] != MODEL:
+        full = True  # vectors from another model aren't comparable
+    if full:
+        meta.execute("DELETE FROM vectors")
+    known = {vid: (h, drug) for vid, h, drug in meta.execute("SELECT vector_id, text_hash, drug FROM vectors")}
+    sections = current_sections(db_path)
+
+    changed = [vid for vid, (_, _, _, text) in sections.items() if known.get(vid, (None,))[0] != text_hash(text)]
+    stale = [vid for vid in known if vid not in sections]
+    changed_ids = set(changed)
+    renamed = [
+        vid for vid, (_, drug, _, _) in sections.items()
+        if vid in known and vid not in changed_ids and known[vid][1] != drug
+    ]
+
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(MODEL)
+    dim = model.get_sentence_embedding_dimension()
+    index = load_index(index_path, dim, full)
+    cache = EmbeddingCache(cache_path, MODEL)
+
+    # Drop stale vectors and the old versions of changed ones. Changed ids
+    # are removed even when metadata doesn't know them: a crash between
+    # writing the index and committing metadata leaves them in the index.
+    if changed or stale:
+        index.remove_ids(np.asarray(changed + stale, dtype="int64"))
+    for start in range(0, len(changed), BATCH_SIZE * 16):
+        batch = changed[start:start + BATCH_SIZE * 16]
+        index.add_with_ids(encode(cache, model, [sections[vid][3] for vid in batch]), np.asarray(batch, dtype="int64"))
 
-    index = faiss.IndexFlatIP(embs.shape[1])
-    index.add(embs)
+    write_index(index, index_path)
 
-    faiss.write_index(index, INDEX)
-    with open(META, 'w') as f:
-        json.dump({'texts': texts, 'metadata': metadata}, f)
+    meta.executemany("DELETE FROM vectors WHERE vector_id = ?", [(vid,) for vid in stale])
+    meta.executemany(
+        "INSERT OR REPLACE INTO vectors (vector_id, medication_id, drug, section, text_hash, text) VALUES (?, ?, ?, ?, ?, ?)",
+        [(vid, *sections[vid][:3], text_hash(sections[vid][3]), sections[vid][3]) for vid in changed],
+    )
+    meta.executemany("UPDATE vectors SET drug = ? WHERE vector_id = ?", [(sections[vid][1], vid) for vid in renamed])
+    meta.execute("INSERT OR REPLACE INTO build_meta (key, value) VALUES ('model', ?)", (MODEL,))
+    meta.commit()
+    meta.close()
 
-    print(f"✓ Built FAISS index with {len(texts)} entries.")
+    print(f"✓ FAISS index: {index.ntotal} vectors "
+          f"({len(changed)} updated, {len(stale)} removed, {len(renamed)} renamed, "
+          f"{len(sections) - len(changed) - len(renamed)} unchanged).")
+    print(f"  embeddings: {cache.encoded} encoded, {cache.reused} reused from cache")
+    cache.close()
 
 if __name__ == "__main__":
-    main()
+    main(full="--full" in sys.argv[1:])
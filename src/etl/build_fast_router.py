@@ -0,0 +1,59 @@
+import os, sys, json
+
+# Add the project root to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.core.fast_router import FastRouter, FAST_ROUTER_PATH, FAST_ROUTER_THRESHOLD, route_key
+from src.core.fhir_query_builder import CATEGORY_RESOURCE_TYPES
+from src.core.prompt_router import ALLOWED_CATEGORIES, FUNCTION_FHIR, FUNCTION_DRUG
+
+DATASET = 'router_dataset.jsonl'
+
+# The dataset predates router categories and labels FHIR calls with resource types
+TYPE_TO_CATEGORY = {}
+for category, types in CATEGORY_RESOURCE_TYPES.items():
+    TYPE_TO_CATEGORY.setdefault(types[0], category)
+
+def to_route(completion: dict) -> dict:
+    fn = completion.get("function") or completion.get("name")
+    args = completion.get("arguments") or {}
+    if fn == FUNCTION_FHIR:
+        cats = args.get("categories")
+        if cats is None:
+            cats = [TYPE_TO_CATEGORY[t] for t in args.get("resource_types", []) if t in TYPE_TO_CATEGORY]
+        unknown = set(cats) - set(ALLOWED_CATEGORIES)
+        if unknown:
+            raise ValueError(f"Unknown categories in dataset: {sorted(unknown)}")
+        return {"function": fn, "arguments": {"categories": sorted(set(cats))}}
+    if fn == FUNCTION_DRUG:
+        return {"function": fn, "arguments": {}}
+    raise ValueError(f"Unknown function in dataset: {fn}")
+
+def load_examples(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                yield row["prompt"], to_route(json.loads(row["completion"]))
+
+def main(dataset=DATASET, out=FAST_ROUTER_PATH):
+    examples = list(load_examples(dataset))
+    labels = {route_key(route) for _, route in examples}
+    if len(labels) < 2:
+        # checked up front: the classifier can't fit one class, and with a single
+        # label every prompt would be answered locally with that route anyway
+        raise ValueError(f"{dataset} has only {len(labels)} distinct route(s); need at least 2 to build a fast router")
+    router = FastRouter.train(examples)
+    router.save(out)
+
+    # Resubstitution check: how many training prompts clear the threshold
+    confident = correct = 0
+    for prompt, route in examples:
+        pred = router.predict(prompt, patient="")
+        confident += pred.confident
+        correct += route_key(pred.route) == route_key(route)
+    print(f"✓ Built fast router with {len(examples)} examples, {len(router.labels)} labels → {out}")
+    print(f"  training accuracy {correct}/{len(examples)}, above threshold {FAST_ROUTER_THRESHOLD}: {confident}/{len(examples)}")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
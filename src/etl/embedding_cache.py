@@ -0,0 +1,101 @@
+"""
+embedding_cache.py
+
+Content-addressed cache of sentence embeddings for the ETL.
+
+Vectors are keyed by (model name, sha1 of the text) and stored as float16
+BLOBs in a SQLite table, so an unchanged label section is never embedded
+twice, even across --full rebuilds or a fresh openFDA pull. Reads go through
+SQLite's memory-mapped I/O and the BLOBs are viewed with np.frombuffer
+rather than copied element by element.
+
+Every vector handed out, fresh or cached, has been round-tripped through
+float16, so an index built from cache hits is identical to one built from
+scratch.
+"""
+
+import hashlib
+import sqlite3
+from typing import Dict, Sequence
+
+import numpy as np
+
+EMBED_CACHE = 'data/drugs/embedding_cache.db'
+
+# stay well under SQLite's bound-parameter limit
+_LOOKUP_CHUNK = 500
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, path: str = EMBED_CACHE, model_name: str = ""):
+        self.path = path
+        self.model_name = model_name
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA mmap_size={1 << 30}")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (model, text_hash)
+        ) WITHOUT ROWID""")
+        self.encoded = 0
+        self.reused = 0
+
+    def lookup(self, hashes: Sequence[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(hashes), _LOOKUP_CHUNK):
+            chunk = hashes[start:start + _LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT text_hash, dim, vector FROM embeddings WHERE model = ? AND text_hash IN ({marks})",
+                (self.model_name, *chunk),
+            )
+            for h, dim, blob in rows:
+                vec = np.frombuffer(blob, dtype="float16")
+                if vec.shape[0] == dim:
+                    found[h] = vec
+        return found
+
+    def store(self, vectors: Dict[str, np.ndarray]) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+            [(self.model_name, h, vec.shape[0], vec.tobytes()) for h, vec in vectors.items()],
+        )
+        self.conn.commit()
+
+    def encode(self, model, texts: Sequence[str], batch_size: int = 256) -> np.ndarray:
+        """float32 embeddings for `texts`, encoding only the ones not cached yet."""
+        hashes = [text_hash(t) for t in texts]
+        vectors = self.lookup(list(dict.fromkeys(hashes)))
+
+        # one encode call for all (deduplicated) misses
+        misses: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in vectors:
+                misses.setdefault(h, t)
+        if misses:
+            embs = model.encode(list(misses.values()), batch_size=batch_size,
+                                show_progress_bar=len(misses) > batch_size, convert_to_numpy=True)
+            fresh = {h: vec for h, vec in zip(misses, np.asarray(embs, dtype="float16"))}
+            self.store(fresh)
+            vectors.update(fresh)
+
+        self.encoded += len(misses)
+        self.reused += len(texts) - len(misses)
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        return np.stack([vectors[h] for h in hashes]).astype("float32")
+
+    def stats(self) -> Dict[str, int]:
+        (entries,) = self.conn.execute(
+            "SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model_name,)
+        ).fetchone()
+        return {"entries": entries, "encoded": self.encoded, "reused": self.reused}
+
+    def close(self) -> None:
+        self.conn.close()
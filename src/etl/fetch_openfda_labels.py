@@ -1,48 +1,407 @@
+"""
+fetch_openfda_labels.py
+
+Downloads openFDA drug labels into compact NDJSON shards under OUT_DIR.
+
+Two sources:
+
+* the label API (default): pages are fetched by a bounded worker pool that
+  shares one rate limiter, retries timeouts, 429s and 5xx with exponential
+  backoff (honouring Retry-After), and writes one shard per page. The API
+  only pages up to skip=25000, which is as far as this mode goes.
+* the bulk download (--bulk): every partition zip listed in download.json
+  (or zips/URLs given on the command line) is downloaded and its "results"
+  array is streamed straight into shards, one label at a time.
+
+Finished pages and partitions are recorded in OUT_DIR/checkpoint.json, and
+shards are only renamed into place once complete, so an interrupted run
+picks up where it stopped. The checkpoint belongs to one openFDA release
+(the API's meta.last_updated, download.json's export_date): when a newer one
+is published everything is fetched again, and --refresh forces that.
+Bulk shards are named after their partition file, so a rerun overwrites
+the same shards.
+
+    python src/etl/fetch_openfda_labels.py [--refresh]
+    python src/etl/fetch_openfda_labels.py [--refresh] --bulk [zip-or-url ...]
+"""
+
+import io
+import json
 import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
 import requests
-import json
-from requests.exceptions import HTTPError
 from dotenv import load_dotenv
 
+# Add the project root to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.utils.json_stream import iter_array_items
+
 load_dotenv()
 API_KEY = os.getenv('OPENFDA_API_KEY', "")
-BASE_URL = 'https://api.fda.gov/drug/label.json'
+BASE_URL = os.getenv('OPENFDA_LABEL_URL', 'https://api.fda.gov/drug/label.json')
+DOWNLOAD_URL = os.getenv('OPENFDA_DOWNLOAD_URL', 'https://api.fda.gov/download.json')
 OUT_DIR = 'data/drugs/raw'
 
-os.makedirs(OUT_DIR, exist_ok=True)
+PAGE_SIZE = int(os.getenv('OPENFDA_PAGE_SIZE', "1000"))      # API maximum
+MAX_SKIP = 25000                                             # API paging limit
+WORKERS = int(os.getenv('OPENFDA_WORKERS', "4"))
+RATE_LIMIT = float(os.getenv('OPENFDA_RATE_LIMIT', "4"))     # requests/second, all workers
+MAX_RETRIES = int(os.getenv('OPENFDA_MAX_RETRIES', "5"))
+BACKOFF = float(os.getenv('OPENFDA_BACKOFF', "1.0"))         # seconds, doubled per retry
+TIMEOUT = float(os.getenv('OPENFDA_TIMEOUT', "60"))
+SHARD_SIZE = int(os.getenv('OPENFDA_SHARD_SIZE', "5000"))     # labels per bulk shard
+DOWNLOAD_CHUNK = 1024 * 1024
+
+CHECKPOINT = 'checkpoint.json'
+
+
+class RateLimiter:
+    """Spaces request starts at least 1/rate apart across all threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every worker back, e.g. after a 429."""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self.release: Optional[str] = data.get("release")
+        self.total: Optional[int] = data.get("total")
+        self.pages = set(data.get("pages", []))
+        self.partitions = set(data.get("partitions", []))
+
+    def _save(self) -> None:
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "release": self.release,
+                "total": self.total,
+                "pages": sorted(self.pages),
+                "partitions": sorted(self.partitions),
+            }, f)
+        os.replace(tmp, self.path)
+
+    def reset(self, release: Optional[str] = None) -> None:
+        """Forget every finished page and partition, e.g. for a new openFDA release."""
+        with self._lock:
+            self.release = release
+            self.total = None
+            self.pages.clear()
+            self.partitions.clear()
+            self._save()
+
+    def set_release(self, release: Optional[str]) -> None:
+        """Start over if `release` isn't the one the checkpoint was made for."""
+        if release != self.release:
+            self.reset(release)
+
+    def set_total(self, total: int) -> None:
+        with self._lock:
+            self.total = total
+            self._save()
+
+    def page_done(self, skip: int) -> None:
+        with self._lock:
+            self.pages.add(skip)
+            self._save()
+
+    def partition_done(self, source: str) -> None:
+        with self._lock:
+            self.partitions.add(source)
+            self._save()
+
+
+class ShardWriter:
+    """Writes labels as NDJSON, rolling to a new shard every `shard_size` lines."""
+
+    def __init__(self, out_dir: str, prefix: str, shard_size: int = SHARD_SIZE):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shards = 0
+        self.records = 0
+        self._f = None
+        self._path = ""
+        self._lines = 0
+
+    def _shard_path(self, n: int) -> str:
+        return os.path.join(self.out_dir, f"{self.prefix}-{n:05d}.ndjson")
+
+    def write(self, label: Dict[str, Any]) -> None:
+        if self._f is None:
+            self._path = self._shard_path(self.shards)
+            self._f = open(f"{self._path}.tmp", "w", encoding="utf-8")
+        self._f.write(json.dumps(label, separators=(",", ":"), ensure_ascii=False))
+        self._f.write("\n")
+        self._lines += 1
+        self.records += 1
+        if self._lines >= self.shard_size:
+            self._finish()
 
-def fetch_openfda(limit=100, skip=0):
-    params = {'limit': limit, 'skip': skip}
-    if API_KEY:
-        params['api_key'] = API_KEY
-    r = requests.get(BASE_URL, params=params)
+    def _finish(self) -> None:
+        self._f.close()
+        os.replace(f"{self._path}.tmp", self._path)
+        self._f = None
+        self._lines = 0
+        self.shards += 1
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._finish()
+        # shards past the end, left by an earlier, larger run under this prefix
+        n = self.shards
+        while os.path.exists(self._shard_path(n)):
+            os.remove(self._shard_path(n))
+            n += 1
+
+
+def partition_prefix(source: str) -> str:
+    """Shard prefix for a bulk partition: bulk-drug-label-0001-of-0013 for .../drug-label-0001-of-0013.json.zip."""
+    name = os.path.basename(urlparse(source).path)
+    for ext in (".zip", ".json"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return f"bulk-{name}"
+
+
+def _retry_after(r: requests.Response) -> Optional[float]:
     try:
+        return max(0.0, float(r.headers.get("Retry-After", "")))
+    except ValueError:
+        return None  # HTTP-date form; fall back to our own backoff
+
+
+class OpenFDAFetcher:
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        download_url: str = DOWNLOAD_URL,
+        out_dir: str = OUT_DIR,
+        api_key: str = API_KEY,
+        workers: int = WORKERS,
+        rate: float = RATE_LIMIT,
+        page_size: int = PAGE_SIZE,
+        max_retries: int = MAX_RETRIES,
+        backoff: float = BACKOFF,
+        timeout: float = TIMEOUT,
+        shard_size: int = SHARD_SIZE,
+    ):
+        self.base_url = base_url
+        self.download_url = download_url
+        self.out_dir = out_dir
+        self.api_key = api_key
+        self.workers = max(1, workers)
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.shard_size = shard_size
+        self.limiter = RateLimiter(rate)
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.checkpoint = Checkpoint(os.path.join(out_dir, CHECKPOINT))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.labels = 0
+
+    # ---------- HTTP ----------
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _count(self, **deltas: int) -> None:
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, stream: bool = False) -> requests.Response:
+        """
+        GET with rate limiting and retries. Timeouts, connection errors, 429
+        and 5xx are retried; any other response is returned to the caller.
+        """
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            self._count(requests=1)
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+            try:
+                r = self._session().get(url, params=params, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if r.status_code != 429 and r.status_code < 500:
+                    return r
+                if attempt >= self.max_retries:
+                    r.raise_for_status()
+                if r.status_code == 429:
+                    wait = _retry_after(r)
+                    delay = delay if wait is None else wait
+                    self.limiter.pause(delay)
+                    self._count(throttled=1)
+                r.close()
+            attempt += 1
+            self._count(retries=1)
+            time.sleep(delay)
+
+    # ---------- label API ----------
+
+    def fetch_page(self, skip: int) -> Dict[str, Any]:
+        params = {'limit': self.page_size, 'skip': skip}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        r = self.get(self.base_url, params)
+        # 400: skip past the end / paging limit; 404: no matches
+        if r.status_code in (400, 404):
+            return {}
         r.raise_for_status()
-    except HTTPError as e:
-        if r.status_code == 400:
-            return []
-        else:
+        return r.json()
+
+    def _save_page(self, skip: int, results: List[Dict[str, Any]]) -> None:
+        writer = ShardWriter(self.out_dir, f"labels-{skip:08d}", shard_size=len(results) or 1)
+        for label in results:
+            writer.write(label)
+        writer.close()
+        self._count(labels=len(results))
+        self.checkpoint.page_done(skip)
+
+    def _fetch_and_save(self, skip: int) -> None:
+        self._save_page(skip, self.fetch_page(skip).get("results", []))
+
+    def fetch_all(self) -> Dict[str, Any]:
+        cp = self.checkpoint
+        # page 0 is always fetched: its meta says which release we're on
+        first = self.fetch_page(0)
+        meta = first.get("meta", {})
+        cp.set_release(meta.get("last_updated"))
+        if cp.total is None:
+            cp.set_total(meta.get("results", {}).get("total", 0))
+        if 0 not in cp.pages:
+            self._save_page(0, first.get("results", []))
+
+        last = min(cp.total, MAX_SKIP + self.page_size)
+        todo = [s for s in range(0, last, self.page_size) if s <= MAX_SKIP and s not in cp.pages]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self._fetch_and_save, todo))
+
+        if cp.total > MAX_SKIP + self.page_size:
+            print(f"  API paging stops at skip={MAX_SKIP}; use --bulk for all {cp.total} labels")
+        return self.stats()
+
+    # ---------- bulk download ----------
+
+    def bulk_partitions(self) -> Tuple[Optional[str], List[str]]:
+        """(export_date, partition URLs) from download.json."""
+        r = self.get(self.download_url)
+        r.raise_for_status()
+        label = r.json()["results"]["drug"]["label"]
+        return label.get("export_date"), [p["file"] for p in label["partitions"]]
+
+    def _download(self, url: str) -> str:
+        fd, path = tempfile.mkstemp(suffix=".zip", dir=self.out_dir)
+        try:
+            with os.fdopen(fd, "wb") as f, self.get(url, stream=True) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
             raise
-    return r.json().get('results', [])
-
-def save_raw(data):
-    for entry in data:
-        rxnorm = entry.get('openfda', {}).get('rxnorm_code', ['unknown'])[0]
-        set_id = entry.get('set_id', 'unknown')
-        filename = f"{rxnorm}_{set_id}.json"
-        path = os.path.join(OUT_DIR, filename)
-        with open(path, 'w') as f:
-            json.dump(entry, f, indent=2)
-
-def main():
-    skip = 0
-    batch = 100
-    while True:
-        results = fetch_openfda(limit=batch, skip=skip)
-        if not results:
-            break
-        save_raw(results)
-        skip += len(results)
+        return path
+
+    def _ingest_partition(self, source: str) -> None:
+        is_url = source.startswith(("http://", "https://"))
+        path = self._download(source) if is_url else source
+        writer = ShardWriter(self.out_dir, partition_prefix(source), self.shard_size)
+        try:
+            with zipfile.ZipFile(path) as z:
+                for member in z.namelist():
+                    if not member.endswith(".json"):
+                        continue
+                    with z.open(member) as raw:
+                        for label in iter_array_items(io.TextIOWrapper(raw, encoding="utf-8"), "results"):
+                            writer.write(label)
+            writer.close()
+        finally:
+            if is_url:
+                os.remove(path)
+        self._count(labels=writer.records)
+        self.checkpoint.partition_done(source)
+
+    def ingest_bulk(self, sources: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        if sources:
+            sources = list(sources)
+        else:
+            export_date, sources = self.bulk_partitions()
+            self.checkpoint.set_release(export_date)
+        todo = [s for s in sources if s not in self.checkpoint.partitions]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self._ingest_partition, todo))
+        return self.stats()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "labels": self.labels,
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "pages_done": len(self.checkpoint.pages),
+                "partitions_done": len(self.checkpoint.partitions),
+            }
+
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    fetcher = OpenFDAFetcher()
+    if argv and argv[0] == "--refresh":
+        fetcher.checkpoint.reset()
+        argv = argv[1:]
+    start = time.perf_counter()
+    if argv and argv[0] == "--bulk":
+        stats = fetcher.ingest_bulk(argv[1:])
+    else:
+        stats = fetcher.fetch_all()
+    elapsed = time.perf_counter() - start
+    print(f"✓ Fetched {stats['labels']} labels in {elapsed:.1f}s → {fetcher.out_dir} "
+          f"({stats['requests']} requests, {stats['retries']} retries, {stats['throttled']} throttled)")
 
 if __name__ == '__main__':
     main()
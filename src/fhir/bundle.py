@@ -0,0 +1,260 @@
+"""
+bundle.py
+
+Compiled, read-only view of a FHIR bundle.
+
+compile_bundle walks the resource list once and buckets compact records by
+type (Patient, AllergyIntolerance, Condition, Observation, Medication,
+MedicationStatement, CarePlan). Medication references on statements are
+resolved at compile time against an index of every form we see in the wild
+("ibuprofen", "Medication/ibuprofen", "urn:uuid:ibuprofen",
+"urn:uuid:med-ibuprofen"). The getters and the summarizer only read these
+records, so rendering N categories doesn't rescan the bundle N times.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+
+def codeable_text(obj: Dict[str, Any]) -> Optional[str]:
+    """Return the best human-readable text from a FHIR CodeableConcept-like dict."""
+    if not obj:
+        return None
+    if isinstance(obj, dict):
+        if obj.get("text"):
+            return obj["text"]
+        codings = obj.get("coding") or []
+        for c in codings:
+            if c.get("display"):
+                return c["display"]
+            if c.get("code"):
+                return c["code"]
+    return None
+
+
+# ---------- records ----------
+
+@dataclass(frozen=True, slots=True)
+class PatientRecord:
+    name: str
+    gender: str
+    birth_date: str
+
+
+@dataclass(frozen=True, slots=True)
+class AllergyRecord:
+    substance: Optional[str]
+    reactions: Tuple[str, ...]
+    status: str
+
+
+@dataclass(frozen=True, slots=True)
+class ConditionRecord:
+    description: str
+    onset: str
+
+
+@dataclass(frozen=True, slots=True)
+class Quantity:
+    name: str
+    value: Any
+    unit: str
+
+
+@dataclass(frozen=True, slots=True)
+class ObservationRecord:
+    when: str
+    values: Tuple[Quantity, ...]
+
+
+@dataclass(frozen=True, slots=True)
+class MedicationRecord:
+    id: str
+    name: str
+    resource: Dict[str, Any]  # kept for drug matching (codings)
+
+
+@dataclass(frozen=True, slots=True)
+class MedicationStatementRecord:
+    name: str
+    status: str
+    start: str
+    medication: Optional[MedicationRecord]
+
+
+@dataclass(frozen=True, slots=True)
+class CarePlanActivity:
+    description: str
+    period: Optional[Tuple[str, str]]
+
+
+@dataclass(frozen=True, slots=True)
+class CarePlanRecord:
+    title: Optional[str]
+    activities: Tuple[CarePlanActivity, ...]
+
+
+# ---------- per-type compilers ----------
+
+def _patient(r: Dict[str, Any]) -> PatientRecord:
+    name_part = (r.get("name") or [{}])[0]
+    given = " ".join(name_part.get("given", []))
+    family = name_part.get("family", "")
+    full = (given + " " + family).strip() or name_part.get("text", "Unknown")
+    return PatientRecord(full, r.get("gender", "unknown"), r.get("birthDate", "unknown"))
+
+
+def _allergy(r: Dict[str, Any]) -> AllergyRecord:
+    # R4 uses 'code', older examples may use 'substance'
+    substance = codeable_text(r.get("code")) or codeable_text(r.get("substance"))
+    reactions = []
+    for react in r.get("reaction", []):
+        for m in react.get("manifestation", []):
+            t = codeable_text(m) or m.get("text")
+            if t:
+                reactions.append(t)
+    return AllergyRecord(substance, tuple(reactions), r.get("status", ""))
+
+
+def _condition(r: Dict[str, Any]) -> ConditionRecord:
+    description = codeable_text(r.get("code")) or "(no description)"
+    onset = r.get("onsetDateTime") or r.get("recordedDate") or "unknown date"
+    return ConditionRecord(description, onset)
+
+
+def _observation(r: Dict[str, Any]) -> ObservationRecord:
+    when = (
+        r.get("effectiveDateTime")
+        or r.get("effectivePeriod", {}).get("start")
+        or r.get("issued")
+        or ""
+    )
+    # Some observations have a single value, not component
+    if r.get("component"):
+        comps = r["component"]
+    else:
+        comps = [{"code": r.get("code", {}), "valueQuantity": r.get("valueQuantity")}]
+    values = []
+    for c in comps:
+        name = codeable_text(c.get("code"))
+        vq = c.get("valueQuantity") or {}
+        if name and vq.get("value") is not None:
+            values.append(Quantity(name, vq["value"], vq.get("unit", "")))
+    return ObservationRecord(when, tuple(values))
+
+
+def _care_plan(r: Dict[str, Any]) -> CarePlanRecord:
+    activities = []
+    for act in r.get("activity", []):
+        detail = act.get("detail", {})
+        txt = codeable_text(detail.get("code")) or detail.get("description")
+        if not txt:
+            continue
+        sched = detail.get("scheduledPeriod", {})
+        period = (sched.get("start", ""), sched.get("end", "")) if sched else None
+        activities.append(CarePlanActivity(txt, period))
+    return CarePlanRecord(r.get("title"), tuple(activities))
+
+
+def _reference_keys(ref: str) -> List[str]:
+    """Candidate Medication ids for a reference, most specific first."""
+    keys = [ref, ref.split("/")[-1]]
+    if ref.startswith("urn:uuid:"):
+        uuid_part = ref[len("urn:uuid:"):]
+        keys.append(uuid_part)
+        # Emily-style "urn:uuid:med-ibuprofen" pointing at Medication "ibuprofen"
+        if uuid_part.startswith("med-"):
+            keys.append(uuid_part[len("med-"):])
+    return keys
+
+
+# ---------- compiled bundle ----------
+
+class CompiledBundle:
+    __slots__ = (
+        "patients", "allergies", "conditions", "observations", "medications",
+        "medication_statements", "care_plans", "timeline", "_med_index",
+    )
+
+    def __init__(self, resources: Iterable[Dict[str, Any]]):
+        patients: List[PatientRecord] = []
+        allergies: List[AllergyRecord] = []
+        conditions: List[ConditionRecord] = []
+        observations: List[ObservationRecord] = []
+        medications: List[MedicationRecord] = []
+        care_plans: List[CarePlanRecord] = []
+        statements: List[Dict[str, Any]] = []
+        # observations and statements in bundle order, for the summarizer
+        order: List[Tuple[str, int]] = []
+
+        for r in resources:
+            rtype = r.get("resourceType")
+            if rtype == "Patient":
+                patients.append(_patient(r))
+            elif rtype == "AllergyIntolerance":
+                allergies.append(_allergy(r))
+            elif rtype == "Condition":
+                conditions.append(_condition(r))
+            elif rtype == "Observation":
+                order.append(("obs", len(observations)))
+                observations.append(_observation(r))
+            elif rtype == "Medication":
+                rid = r.get("id", "unknown-id")
+                medications.append(MedicationRecord(rid, codeable_text(r.get("code")) or rid, r))
+            elif rtype == "MedicationStatement":
+                order.append(("ms", len(statements)))
+                statements.append(r)
+            elif rtype == "CarePlan":
+                care_plans.append(_care_plan(r))
+
+        self._med_index: Dict[str, MedicationRecord] = {}
+        for med in medications:
+            for key in (med.id, f"Medication/{med.id}", f"urn:uuid:{med.id}"):
+                self._med_index.setdefault(key, med)
+
+        self.patients = tuple(patients)
+        self.allergies = tuple(allergies)
+        self.conditions = tuple(conditions)
+        self.observations = tuple(observations)
+        self.medications = tuple(medications)
+        self.medication_statements = tuple(self._statement(r) for r in statements)
+        self.care_plans = tuple(care_plans)
+        self.timeline = tuple(
+            self.observations[i] if kind == "obs" else self.medication_statements[i]
+            for kind, i in order
+        )
+
+    def resolve_medication(self, ref: str) -> Optional[MedicationRecord]:
+        for key in _reference_keys(ref):
+            med = self._med_index.get(key)
+            if med is not None:
+                return med
+        return None
+
+    def _statement(self, r: Dict[str, Any]) -> MedicationStatementRecord:
+        med = None
+        # 1) Inline CodeableConcept (Mary style)
+        name = codeable_text(r.get("medicationCodeableConcept"))
+        # 2) Reference (Emily style)
+        ref = (r.get("medicationReference") or {}).get("reference")
+        if ref:
+            med = self.resolve_medication(ref)
+            if not name:
+                name = med.name if med else _reference_keys(ref)[-1]
+        status = r.get("status")
+        start = (r.get("effectivePeriod") or {}).get("start") or ""
+        return MedicationStatementRecord(
+            name or "Unknown medication", "" if status is None else status, start, med,
+        )
+
+
+BundleLike = Union[CompiledBundle, Dict[str, Any], Iterable[Dict[str, Any]]]
+
+
+def compile_bundle(bundle: BundleLike) -> CompiledBundle:
+    """Accepts a compiled bundle, a Bundle dict, or a list of resources."""
+    if isinstance(bundle, CompiledBundle):
+        return bundle
+    if isinstance(bundle, dict):
+        return CompiledBundle(e["resource"] for e in bundle.get("entry", []) if "resource" in e)
+    return CompiledBundle(bundle)
@@ -3,9 +3,160 @@ client.py
 
 Loads FHIR data exclusively from local JSON files. Always treats the provided
 path as a filesystem path and returns its parsed JSON content.
+
+Parsed bundles are kept in a per-file LRU cache, so repeated requests for the
+same patient skip the JSON parse. An entry is reused only while the file's
+mtime/size/inode are unchanged, and the cache is bounded by the total size of
+the source files it holds (FHIR_CACHE_MAX_BYTES). orjson is used for parsing
+when installed. Each entry also holds the compiled view of the bundle
+(src/fhir/bundle.py), built once per file version.
+
+Cached bundles are shared between requests: callers must treat the returned
+dicts as read-only.
+
+Bundles of FHIR_STREAM_MIN_BYTES or more can instead be read with a projection
+(fetch_projected_bundle): the `entry` array is scanned incrementally and only
+entries of the requested resource types are decoded, so memory and parse time
+follow what the question needs rather than the size of the patient history.
 """
+import hashlib
 import json
-from typing import Dict, Any
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from src.fhir.bundle import CompiledBundle
+from src.utils.json_stream import iter_array_items
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+FHIR_CACHE_MAX_BYTES = int(os.getenv("FHIR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+FHIR_STREAM_MIN_BYTES = int(os.getenv("FHIR_STREAM_MIN_BYTES", str(8 * 1024 * 1024)))
+
+
+def _parse(raw: bytes) -> Dict[str, Any]:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def content_hash(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _file_signature(path: str) -> Tuple[int, int, int]:
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class CachedBundle(NamedTuple):
+    signature: Tuple[int, int, int]
+    digest: str
+    bundle: Dict[str, Any]
+    resources: Tuple[Dict[str, Any], ...]
+    compiled: CompiledBundle
+
+
+class BundleCache:
+    def __init__(self, max_bytes: int = FHIR_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedBundle]" = OrderedDict()
+        # path -> (signature, digest) for files hashed without parsing
+        self._digests: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._reloads = 0
+        self._evictions = 0
+
+    def _drop(self, path: str) -> None:
+        self._bytes -= self._entries.pop(path).signature[2]
+
+    def get(self, file_path: str) -> CachedBundle:
+        path = os.path.abspath(file_path)
+        signature = _file_signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.signature == signature:
+                self._entries.move_to_end(path)
+                self._hits += 1
+                return entry
+            self._misses += 1
+
+        # parse outside the lock; a concurrent miss on the same file just
+        # parses it twice. The signature is the one taken before reading, so a
+        # write racing with us is picked up on the next call.
+        with open(path, "rb") as f:
+            raw = f.read()
+        bundle = _parse(raw)
+        resources = tuple(e["resource"] for e in bundle.get("entry", []) if "resource" in e)
+        entry = CachedBundle(signature, content_hash(raw), bundle, resources, CompiledBundle(resources))
+
+        with self._lock:
+            if path in self._entries:
+                self._drop(path)
+                self._reloads += 1
+            if signature[2] <= self.max_bytes:
+                self._entries[path] = entry
+                self._bytes += signature[2]
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._entries)))
+                    self._evictions += 1
+        return entry
+
+    def digest(self, file_path: str) -> str:
+        """Content hash of the file, without parsing it if we can avoid it."""
+        path = os.path.abspath(file_path)
+        signature = _file_signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.signature == signature:
+                return entry.digest
+            known = self._digests.get(path)
+            if known is not None and known[0] == signature:
+                return known[1]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self._digests[path] = (signature, digest)
+        return digest
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "parser": "orjson" if orjson is not None else "json",
+                "bundles": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "reloads": self._reloads,
+                "evictions": self._evictions,
+            }
+
+
+_cache = BundleCache()
+
+
+def get_bundle_cache() -> BundleCache:
+    return _cache
+
 
 def fetch_fhir_resources(file_path: str) -> Dict[str, Any]:
     """
@@ -15,7 +166,45 @@ def fetch_fhir_resources(file_path: str) -> Dict[str, Any]:
         file_path: Path to a local FHIR JSON file.
 
     Returns:
-        Parsed JSON as a Python dict.
+        Parsed JSON as a Python dict (shared, do not mutate).
     """
+    return _cache.get(file_path).bundle
+
+
+def fetch_bundle_resources(file_path: str) -> Tuple[Dict[str, Any], ...]:
+    """The `resource` of every bundle entry, in order (shared, do not mutate)."""
+    return _cache.get(file_path).resources
+
+
+def fetch_compiled_bundle(file_path: str) -> CompiledBundle:
+    return _cache.get(file_path).compiled
+
+
+# ---------- streaming, projected reads ----------
+
+def iter_bundle_resources(file_path: str, resource_types: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+    """Stream entry resources from a bundle file, keeping only the wanted types."""
+    wanted = set(resource_types) if resource_types else None
     with open(file_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        for entry in iter_array_items(f, "entry"):
+            resource = entry.get("resource") if isinstance(entry, dict) else None
+            if resource is None:
+                continue
+            if wanted is None or resource.get("resourceType") in wanted:
+                yield resource
+
+
+def should_stream(file_path: str) -> bool:
+    return os.path.getsize(file_path) >= FHIR_STREAM_MIN_BYTES
+
+
+def fetch_projected_bundle(query: Tuple[str, Optional[Tuple[str, ...]]]) -> CompiledBundle:
+    """
+    Compiled bundle for a FhirQuery (path, resource_types). Large files with a
+    projection are streamed and not cached; everything else goes through the
+    bundle cache.
+    """
+    path, resource_types = query
+    if resource_types and should_stream(path):
+        return CompiledBundle(iter_bundle_resources(path, resource_types))
+    return _cache.get(path).compiled
@@ -0,0 +1,50 @@
+"""
+function_schema.py
+
+The two functions the router can choose between, and their JSON schemas as
+shown to the model. The serialized definitions are part of the router's
+static prompt prefix, so they are built once, deterministically.
+"""
+
+import json
+
+FUNCTION_FHIR = "get_fhir_resources"
+FUNCTION_DRUG = "get_drug_info"
+
+ALLOWED_CATEGORIES = [
+    "generalInfo",
+    "allergies",
+    "conditions",
+    "currentMedications",
+    "observations",
+    "carePlan",
+]
+
+FHIR_FUNCTION_DEF = json.dumps({
+    "name": FUNCTION_FHIR,
+    "description": "Fetch patient-specific FHIR data categories",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "patient": {"type": "string", "description": "The patient identifier"},
+            "categories": {
+                "type": "array",
+                "items": {"type": "string", "enum": ALLOWED_CATEGORIES},
+                "description": "Which FHIR categories to retrieve"
+            }
+        },
+        "required": ["patient", "categories"]
+    }
+}, indent=2)
+
+DRUG_FUNCTION_DEF = json.dumps({
+    "name": FUNCTION_DRUG,
+    "description": "Look up information for a given drug",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "drug_name": {"type": "string", "description": "Name of the drug to look up"}
+        },
+        "required": ["drug_name"]
+    }
+}, indent=2)
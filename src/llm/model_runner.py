@@ -0,0 +1,436 @@
+"""
+model_runner.py
+
+Shared HTTP client for the Ollama API, used by both the prompt router and the
+response generator.
+
+Connections are pooled and kept alive (a requests.Session for sync callers,
+an httpx.AsyncClient per event loop for async ones). Timeouts and retries are
+configured from the environment. Retries cover connection errors and
+429/5xx responses; streaming calls are only retried before the first chunk
+arrives.
+
+complete()/acomplete() (and their streaming variants) take a prompt as a
+static system prefix plus a per-request user message and send it the way
+OLLAMA_PROMPT_MODE says:
+
+  chat     /api/chat with the prefix as the system message (default). Ollama
+           keeps the model loaded for OLLAMA_KEEP_ALIVE and reuses its KV
+           cache for the unchanged prefix, so only the suffix is prefilled.
+  context  /api/generate, passing the `context` returned by a one-off raw
+           call that only evaluates the prefix (num_predict 0, no template);
+           falls back to chat if the server returns none.
+  generate /api/generate with prefix and suffix concatenated (the old way).
+
+Sampling settings go in `options` (Ollama's own options object) and
+structured output in `format`, e.g. format="json".
+
+Prompt-eval and eval token counts/durations reported by Ollama are
+aggregated per call label (e.g. "router", "response") in stats().
+
+Every call goes through an LLMScheduler (see scheduler.py), which limits
+concurrent generations, queues the rest by label priority and collapses
+identical in-flight requests.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+from src.llm.scheduler import LLMScheduler, priority_for
+
+load_dotenv()
+
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+OLLAMA_CHAT_URL = os.getenv("OLLAMA_CHAT_URL", OLLAMA_API_URL.replace("/api/generate", "/api/chat"))
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_PROMPT_MODE = os.getenv("OLLAMA_PROMPT_MODE", "chat")
+CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "300"))
+MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.5"))
+POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "16"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+PROMPT_MODES = ("chat", "context", "generate")
+
+# Ollama reports durations in nanoseconds
+_USAGE_FIELDS = (
+    ("prompt_eval_count", "prompt_eval_tokens", 1),
+    ("prompt_eval_duration", "prompt_eval_ms", 1e-6),
+    ("eval_count", "eval_tokens", 1),
+    ("eval_duration", "eval_ms", 1e-6),
+    ("load_duration", "load_ms", 1e-6),
+)
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+def response_text(data: Dict[str, Any]) -> str:
+    """Generated text from a /api/generate or /api/chat response (or stream chunk)."""
+    if "message" in data:
+        return (data.get("message") or {}).get("content", "")
+    return data.get("response", "")
+
+
+class OllamaClient:
+    def __init__(
+        self,
+        url: str = OLLAMA_API_URL,
+        chat_url: str = OLLAMA_CHAT_URL,
+        prompt_mode: str = OLLAMA_PROMPT_MODE,
+        keep_alive: str = OLLAMA_KEEP_ALIVE,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        retry_backoff: float = RETRY_BACKOFF,
+        pool_size: int = POOL_SIZE,
+        scheduler: Optional[LLMScheduler] = None,
+    ):
+        if prompt_mode not in PROMPT_MODES:
+            raise ValueError(f"Unknown OLLAMA_PROMPT_MODE {prompt_mode!r}; expected one of {PROMPT_MODES}")
+        self.url = url
+        self.chat_url = chat_url
+        self.prompt_mode = prompt_mode
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.pool_size = pool_size
+        self.scheduler = scheduler or LLMScheduler()
+
+        self._session: Optional[requests.Session] = None
+        self._async_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+
+        self._requests = 0
+        self._retries = 0
+        self._errors = 0
+        self._seconds = 0.0
+        # label -> summed usage fields, plus "calls"
+        self._usage: Dict[str, Dict[str, float]] = {}
+        # (model, prefix hash) -> context tokens, or None if the server has none
+        self._contexts: Dict[Tuple[str, str], Optional[List[int]]] = {}
+
+    # ---------- pooled transports ----------
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def _async_client(self) -> httpx.AsyncClient:
+        # httpx connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            for old in [l for l in self._async_clients if l.is_closed()]:
+                del self._async_clients[old]
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+            self._async_clients[loop] = client
+        return client
+
+    def _backoff(self, attempt: int) -> float:
+        return self.retry_backoff * (2 ** attempt)
+
+    def _record(self, start: float, ok: bool) -> None:
+        with self._lock:
+            self._requests += 1
+            self._seconds += time.perf_counter() - start
+            if not ok:
+                self._errors += 1
+
+    def _count_retry(self) -> None:
+        with self._lock:
+            self._retries += 1
+
+    def _record_usage(self, label: Optional[str], data: Dict[str, Any]) -> None:
+        if label is None or "prompt_eval_count" not in data and "eval_count" not in data:
+            return
+        with self._lock:
+            usage = self._usage.setdefault(label, {"calls": 0})
+            usage["calls"] += 1
+            for field, name, scale in _USAGE_FIELDS:
+                usage[name] = usage.get(name, 0) + (data.get(field) or 0) * scale
+
+    # ---------- prompt layout ----------
+
+    def _payload(self, model: str, system: str, user: str, options: Optional[Dict[str, Any]] = None,
+                 format: Optional[str] = None, context: Optional[List[int]] = None) -> Tuple[str, Dict[str, Any]]:
+        """(url, payload) for a static-prefix + suffix prompt in the configured mode."""
+        base: Dict[str, Any] = {"model": model, "keep_alive": self.keep_alive}
+        if options:
+            base["options"] = options
+        if format:
+            base["format"] = format
+        if self.prompt_mode == "generate":
+            return self.url, {**base, "prompt": f"{system}\n\n{user}"}
+        if self.prompt_mode == "context" and context is not None:
+            return self.url, {**base, "prompt": user, "context": context}
+        return self.chat_url, {
+            **base,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": user},
+            ],
+        }
+
+    def _flight_key(self, url: Optional[str], payload: Dict[str, Any]) -> str:
+        body = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(f"{url or self.url}\x1f{body}".encode("utf-8")).hexdigest()
+
+    def _context_key(self, model: str, system: str) -> Tuple[str, str]:
+        return model, hashlib.sha1(system.encode("utf-8")).hexdigest()
+
+    def _prefix_payload(self, model: str, system: str) -> Dict[str, Any]:
+        # raw: the prefix as-is, not wrapped in a user turn; num_predict 0:
+        # the returned `context` holds only the prefix, no generated token
+        return {"model": model, "prompt": system, "raw": True, "keep_alive": self.keep_alive,
+                "options": {"num_predict": 0}}
+
+    def _prefix_context(self, model: str, system: str) -> Optional[List[int]]:
+        if self.prompt_mode != "context":
+            return None
+        key = self._context_key(model, system)
+        if key not in self._contexts:
+            data = self.generate(self._prefix_payload(model, system), label="prefix")
+            self._contexts[key] = data.get("context")
+        return self._contexts[key]
+
+    async def _aprefix_context(self, model: str, system: str) -> Optional[List[int]]:
+        if self.prompt_mode != "context":
+            return None
+        key = self._context_key(model, system)
+        if key not in self._contexts:
+            data = await self.agenerate(self._prefix_payload(model, system), label="prefix")
+            self._contexts[key] = data.get("context")
+        return self._contexts[key]
+
+    # ---------- sync ----------
+
+    def _post(self, payload: Dict[str, Any], stream: bool, url: Optional[str] = None) -> requests.Response:
+        attempt = 0
+        while True:
+            try:
+                resp = self.session.post(
+                    url or self.url,
+                    json=payload,
+                    stream=stream,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                )
+                if resp.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    resp.close()
+                else:
+                    resp.raise_for_status()
+                    return resp
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            self._count_retry()
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def generate(self, payload: Dict[str, Any], url: Optional[str] = None, label: Optional[str] = None) -> Dict[str, Any]:
+        return self.scheduler.run(
+            lambda: self._generate(payload, url, label), priority_for(label), self._flight_key(url, payload)
+        )
+
+    def _generate(self, payload: Dict[str, Any], url: Optional[str], label: Optional[str]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        ok = False
+        try:
+            resp = self._post({**payload, "stream": False}, stream=False, url=url)
+            data = resp.json()
+            ok = True
+            self._record_usage(label, data)
+            return data
+        finally:
+            self._record(start, ok)
+
+    def stream(self, payload: Dict[str, Any], url: Optional[str] = None, label: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield each JSON object from Ollama's line-delimited streaming response."""
+        with self.scheduler.slot(priority_for(label)):
+            yield from self._stream(payload, url, label)
+
+    def _stream(self, payload: Dict[str, Any], url: Optional[str], label: Optional[str]) -> Iterator[Dict[str, Any]]:
+        start = time.perf_counter()
+        ok = False
+        try:
+            with self._post({**payload, "stream": True}, stream=True, url=url) as resp:
+                for line in resp.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise OllamaError(f"Ollama streaming error: {data['error']}")
+                    yield data
+                    if data.get("done"):
+                        self._record_usage(label, data)
+                        break
+            ok = True
+        finally:
+            self._record(start, ok)
+
+    def complete(self, system: str, user: str, label: Optional[str] = None, model: str = OLLAMA_MODEL,
+                 options: Optional[Dict[str, Any]] = None, format: Optional[str] = None) -> Dict[str, Any]:
+        """One non-streaming call for a static-prefix prompt; see response_text()."""
+        url, payload = self._payload(model, system, user, options, format, self._prefix_context(model, system))
+        return self.generate(payload, url=url, label=label)
+
+    def complete_stream(self, system: str, user: str, label: Optional[str] = None, model: str = OLLAMA_MODEL,
+                        options: Optional[Dict[str, Any]] = None, format: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        url, payload = self._payload(model, system, user, options, format, self._prefix_context(model, system))
+        return self.stream(payload, url=url, label=label)
+
+    # ---------- async ----------
+
+    async def _apost(self, payload: Dict[str, Any], url: Optional[str] = None) -> httpx.Response:
+        client = self._async_client()
+        attempt = 0
+        while True:
+            try:
+                request = client.build_request("POST", url or self.url, json=payload)
+                resp = await client.send(request, stream=True)
+                if resp.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    await resp.aclose()
+                else:
+                    if resp.is_error:
+                        await resp.aread()
+                        await resp.aclose()
+                        resp.raise_for_status()
+                    return resp
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+            self._count_retry()
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+
+    async def agenerate(self, payload: Dict[str, Any], url: Optional[str] = None, label: Optional[str] = None) -> Dict[str, Any]:
+        return await self.scheduler.arun(
+            lambda: self._agenerate(payload, url, label), priority_for(label), self._flight_key(url, payload)
+        )
+
+    async def _agenerate(self, payload: Dict[str, Any], url: Optional[str], label: Optional[str]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        ok = False
+        try:
+            resp = await self._apost({**payload, "stream": False}, url=url)
+            try:
+                await resp.aread()
+            finally:
+                await resp.aclose()
+            data = resp.json()
+            ok = True
+            self._record_usage(label, data)
+            return data
+        finally:
+            self._record(start, ok)
+
+    async def astream(self, payload: Dict[str, Any], url: Optional[str] = None, label: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        async with self.scheduler.aslot(priority_for(label)):
+            async for data in self._astream(payload, url, label):
+                yield data
+
+    async def _astream(self, payload: Dict[str, Any], url: Optional[str], label: Optional[str]) -> AsyncIterator[Dict[str, Any]]:
+        start = time.perf_counter()
+        ok = False
+        try:
+            resp = await self._apost({**payload, "stream": True}, url=url)
+            try:
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise OllamaError(f"Ollama streaming error: {data['error']}")
+                    yield data
+                    if data.get("done"):
+                        self._record_usage(label, data)
+                        break
+            finally:
+                await resp.aclose()
+            ok = True
+        finally:
+            self._record(start, ok)
+
+    async def acomplete(self, system: str, user: str, label: Optional[str] = None, model: str = OLLAMA_MODEL,
+                        options: Optional[Dict[str, Any]] = None, format: Optional[str] = None) -> Dict[str, Any]:
+        context = await self._aprefix_context(model, system)
+        url, payload = self._payload(model, system, user, options, format, context)
+        return await self.agenerate(payload, url=url, label=label)
+
+    async def acomplete_stream(self, system: str, user: str, label: Optional[str] = None, model: str = OLLAMA_MODEL,
+                               options: Optional[Dict[str, Any]] = None,
+                               format: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        context = await self._aprefix_context(model, system)
+        url, payload = self._payload(model, system, user, options, format, context)
+        async for data in self.astream(payload, url=url, label=label):
+            yield data
+
+    # ---------- lifecycle / metrics ----------
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            usage = {}
+            for label, totals in self._usage.items():
+                calls = totals["calls"]
+                usage[label] = {"calls": calls, **{
+                    f"avg_{name}": round(totals.get(name, 0) / calls, 3) for _, name, _ in _USAGE_FIELDS
+                }}
+            return {
+                "url": self.url,
+                "prompt_mode": self.prompt_mode,
+                "requests": self._requests,
+                "retries": self._retries,
+                "errors": self._errors,
+                "avg_ms": (self._seconds / self._requests * 1000) if self._requests else 0.0,
+                "usage": usage,
+                "scheduler": self.scheduler.stats(),
+            }
+
+
+_client = OllamaClient()
+
+
+def get_client() -> OllamaClient:
+    return _client
@@ -0,0 +1,88 @@
+"""
+prompt_templates.py
+
+Prompt layouts for the router and for Sally.
+
+Every prompt is split into a static prefix (the system message) and a short
+per-request suffix (the user message). The prefix comes first and is
+byte-identical on every call for a given configuration, so the model server
+can keep it in its KV cache and only prefill the suffix. Anything that
+varies per request (the question, patient data, whether Sally introduces
+herself) belongs in the user message.
+"""
+
+import hashlib
+from typing import Iterable
+
+# Bump when sally_user_message's layout changes; edits to the system prompt
+# are picked up by sally_template_version() on their own.
+SALLY_TEMPLATE_VERSION = 1
+
+INTRO = "Hi, I'm Sally — your AI pharmacist with 30 years of experience.\n\n"
+
+SALLY_SYSTEM_PROMPT = (
+    "You are Sally, an experienced AI pharmacist with 30 years of clinical and community practice. "
+    "Your role is to assist patients with medication-related queries in a clear, empathetic manner.\n\n"
+
+    "Interaction Guidelines:\n"
+    "- Provide straightforward, empathetic, and patient-focused responses.\n"
+    "- Ask clarifying questions if needed.\n\n"
+
+    "Medication Safety & Information:\n"
+    "- Rely on provided patient-specific data (from RAG) and official drug information.\n"
+    "- Clearly state your sources when discussing side effects, dosages, or interactions.\n\n"
+
+    "Ethical & Safety Constraints:\n"
+    "- Never guess or hallucinate. If info is missing, say so.\n"
+    "- Do not diagnose or prescribe. Only offer info within a pharmacist's scope.\n\n"
+
+    "If the patient asks about diagnosis or treatment:\n"
+    "- 'I'm unable to diagnose or prescribe; please consult your healthcare provider.'\n"
+    "- 'That’s best discussed with your doctor.'"
+)
+
+
+def sally_template_version() -> str:
+    """Identifies the Sally prompt layout, for caches of generated answers."""
+    digest = hashlib.sha1(f"{INTRO}\x1f{SALLY_SYSTEM_PROMPT}".encode("utf-8")).hexdigest()[:12]
+    return f"{SALLY_TEMPLATE_VERSION}-{digest}"
+
+
+def sally_user_message(user_prompt: str, retrieved_data: str, show_intro: bool = False) -> str:
+    # The session decides whether Sally still has to introduce herself
+    intro = INTRO if show_intro else ""
+    return (
+        f"Patient question: \"{user_prompt}\"\n\n"
+        f"Patient-specific data:\n{retrieved_data}\n\n"
+        f"{intro}Please provide a concise, clinically accurate, and empathetic response following the above guidelines."
+    )
+
+
+def router_system_prompt(
+    fhir_function: str,
+    drug_function: str,
+    function_defs: Iterable[str],
+    default_patient: str,
+    categories: Iterable[str],
+) -> str:
+    return (
+        "You are a clinical assistant. Based on the user's prompt, choose exactly ONE function:\n"
+        f"- {fhir_function}(patient, categories)\n"
+        f"- {drug_function}(drug_name)\n\n"
+        "Respond ONLY with JSON in this exact format:\n"
+        "{\n"
+        '  "name": "<function name>",\n'
+        '  "arguments": {<arguments JSON>}\n'
+        "}\n"
+        "DO NOT provide any other explanation or text.\n\n"
+        f"Use '{default_patient}' as the patient identifier by default.\n"
+        f"Allowed categories for FHIR are: {', '.join(categories)}.\n\n"
+        f"Available functions:\n{chr(10).join(function_defs)}"
+    )
+
+
+def router_user_message(prompt: str) -> str:
+    return (
+        f"User prompt: {prompt}\n\n"
+        "Respond with ONLY the JSON object specifying the chosen function and arguments."
+    )
@@ -0,0 +1,309 @@
+"""
+scheduler.py
+
+Admission control in front of the Ollama client.
+
+A single local model serves every request, so a burst of /ask calls slows all
+of them down together until clients time out. The scheduler caps the number
+of generations in flight (LLM_MAX_INFLIGHT) and parks the rest in a bounded
+priority queue: router calls, which are short and gate everything else, are
+admitted ahead of long answer generations, FIFO within a priority.
+
+Best-effort calls (priority SHED_PRIORITY and up, e.g. the fast router's
+shadow LLM calls) never queue: they run only if a slot is free right now and
+are shed otherwise, so they can't delay users or push the queue to 429s.
+
+When the queue is full, or a request has waited longer than
+LLM_QUEUE_TIMEOUT, it fails fast with SchedulerBusy, which carries the HTTP
+status (429 / 503) and a Retry-After estimate for the API layer.
+
+Identical non-streaming calls that are in flight at the same time are
+collapsed (single-flight): followers wait for the leader's result instead of
+queueing a second generation. If the leader gives up for reasons of its own
+(cancelled, e.g. its client went away, or timed out in the queue), followers
+aren't failed with it: they start over, and one of them leads.
+
+Sync callers (threads) and async callers (any event loop) share one
+scheduler; waiters are woken with threading.Event or
+loop.call_soon_threadsafe respectively.
+"""
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "1") not in ("0", "false", "no")
+
+# lower runs first; unknown labels get DEFAULT_PRIORITY
+PRIORITIES = {"router": 0, "prefix": 0, "response": 1, "shadow": 2}
+DEFAULT_PRIORITY = 1
+# calls at this priority or lower are shed instead of queued
+SHED_PRIORITY = 2
+
+
+# what an abandoned flight resolves to: followers retry instead
+_RETRY = object()
+
+
+def priority_for(label: Optional[str]) -> int:
+    return PRIORITIES.get(label or "", DEFAULT_PRIORITY)
+
+
+class SchedulerBusy(RuntimeError):
+    """The LLM is saturated; retry after `retry_after` seconds."""
+
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("wake", "admitted", "cancelled")
+
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.admitted = False
+        self.cancelled = False
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        max_inflight: int = LLM_MAX_INFLIGHT,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        single_flight: bool = LLM_SINGLE_FLIGHT,
+    ):
+        if max_inflight < 1:
+            raise ValueError("LLM_MAX_INFLIGHT must be at least 1")
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.single_flight = single_flight
+
+        self._lock = threading.Lock()
+        self._inflight = 0
+        # (priority, sequence, waiter)
+        self._queue: List[Any] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        # single-flight key -> result shared with followers
+        self._flights: Dict[str, concurrent.futures.Future] = {}
+
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._deduped = 0
+        self._shed = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._run_seconds = 0.0
+        self._completed = 0
+
+    # ---------- admission ----------
+
+    def retry_after(self) -> int:
+        """Rough seconds until a queued request would be admitted."""
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self) -> int:
+        avg_run = self._run_seconds / self._completed if self._completed else 1.0
+        backlog = (self._queued + 1) / self.max_inflight
+        return max(1, math.ceil(avg_run * backlog))
+
+    def saturated(self) -> bool:
+        """True when a new request would be rejected rather than queued."""
+        with self._lock:
+            return self._inflight >= self.max_inflight and self._queued >= self.max_queue
+
+    def _enqueue(self, priority: int, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """Take a slot now (returns None) or queue a waiter; raises when full."""
+        with self._lock:
+            if self._inflight < self.max_inflight and not self._queued:
+                self._inflight += 1
+                self._admitted += 1
+                return None
+            if priority >= SHED_PRIORITY:
+                self._shed += 1
+                raise SchedulerBusy("LLM busy; best-effort call shed", 503, self._retry_after())
+            if self._queued >= self.max_queue:
+                self._rejected += 1
+                raise SchedulerBusy("LLM queue is full", 429, self._retry_after())
+            waiter = _Waiter(wake)
+            heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+            self._queued += 1
+            return waiter
+
+    def _abandon(self, waiter: _Waiter, timed_out: bool = True) -> bool:
+        """Give up waiting; False if the slot was granted meanwhile."""
+        with self._lock:
+            if waiter.admitted:
+                return False
+            waiter.cancelled = True
+            self._queued -= 1
+            self._timed_out += timed_out
+            return True
+
+    def _release(self, seconds: float) -> None:
+        with self._lock:
+            self._completed += 1
+            self._run_seconds += seconds
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                # hand the slot straight to the next waiter
+                waiter.admitted = True
+                self._queued -= 1
+                self._admitted += 1
+                waiter.wake()
+                return
+            self._inflight -= 1
+
+    def _waited(self, seconds: float) -> None:
+        with self._lock:
+            self._wait_seconds += seconds
+            self._max_wait = max(self._max_wait, seconds)
+
+    def _timeout(self) -> SchedulerBusy:
+        return SchedulerBusy(f"Waited {self.queue_timeout:g}s for the LLM", 503, self.retry_after())
+
+    @contextmanager
+    def slot(self, priority: int = DEFAULT_PRIORITY) -> Iterator[None]:
+        start = time.perf_counter()
+        event = threading.Event()
+        waiter = self._enqueue(priority, event.set)
+        if waiter is not None and not event.wait(self.queue_timeout) and self._abandon(waiter):
+            raise self._timeout()
+        admitted = time.perf_counter()
+        self._waited(admitted - start)
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - admitted)
+
+    @asynccontextmanager
+    async def aslot(self, priority: int = DEFAULT_PRIORITY) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+        waiter = self._enqueue(priority, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(waiter):
+                    raise self._timeout()
+            except asyncio.CancelledError:
+                if not self._abandon(waiter, timed_out=False):
+                    self._release(0.0)
+                raise
+        admitted = time.perf_counter()
+        self._waited(admitted - start)
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - admitted)
+
+    # ---------- single-flight ----------
+
+    def _join(self, key: Optional[str]):
+        """(future, leader?) for `key`; (None, True) when dedupe is off."""
+        if key is None or not self.single_flight:
+            return None, True
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._deduped += 1
+                return flight, False
+            flight = self._flights[key] = concurrent.futures.Future()
+            return flight, True
+
+    def _land(self, key: str, flight: concurrent.futures.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self._flights.pop(key, None)
+        if flight.done():
+            return
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(result)
+
+    def _fail(self, key: str, flight: concurrent.futures.Future, error: BaseException) -> None:
+        if isinstance(error, (asyncio.CancelledError, SchedulerBusy)):
+            self._land(key, flight, _RETRY)  # the leader's own problem, not the call's
+        else:
+            self._land(key, flight, error=error)
+
+    def run(self, fn: Callable[[], Any], priority: int = DEFAULT_PRIORITY, key: Optional[str] = None) -> Any:
+        while True:
+            flight, leader = self._join(key)
+            if not leader:
+                result = flight.result()
+                if result is _RETRY:
+                    continue
+                return result
+            try:
+                with self.slot(priority):
+                    result = fn()
+            except BaseException as e:
+                if flight is not None:
+                    self._fail(key, flight, e)
+                raise
+            if flight is not None:
+                self._land(key, flight, result)
+            return result
+
+    async def arun(self, fn: Callable[[], Awaitable[Any]], priority: int = DEFAULT_PRIORITY, key: Optional[str] = None) -> Any:
+        while True:
+            flight, leader = self._join(key)
+            if not leader:
+                # shielded: a cancelled follower must not cancel the shared flight
+                result = await asyncio.shield(asyncio.wrap_future(flight))
+                if result is _RETRY:
+                    continue
+                return result
+            try:
+                async with self.aslot(priority):
+                    result = await fn()
+            except BaseException as e:
+                if flight is not None:
+                    self._fail(key, flight, e)
+                raise
+            if flight is not None:
+                self._land(key, flight, result)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            admitted = self._admitted
+            return {
+                "max_inflight": self.max_inflight,
+                "max_queue": self.max_queue,
+                "inflight": self._inflight,
+                "queued": self._queued,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "deduped": self._deduped,
+                "shed": self._shed,
+                "avg_wait_ms": self._wait_seconds / admitted * 1000 if admitted else 0.0,
+                "max_wait_ms": self._max_wait * 1000,
+                "avg_run_ms": self._run_seconds / self._completed * 1000 if self._completed else 0.0,
+            }
@@ -0,0 +1,91 @@
+"""
+json_stream.py
+
+Incremental decoding of one large top-level JSON array (a FHIR bundle's
+`entry`, an openFDA bulk file's `results`), shared by the FHIR client and
+the ETL.
+"""
+
+import json
+import re
+from typing import Any, Iterator, TextIO
+
+STREAM_CHUNK_SIZE = 1 << 16
+
+# A complete string, a bracket, or (at a chunk boundary) an unterminated string
+_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]|"')
+_SEPARATORS = re.compile(r"[\s,]*")
+_DECODER = json.JSONDecoder()
+
+
+def iter_array_items(f: TextIO, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Decode the elements of the top-level array `key` one at a time, reading
+    f incrementally. Only the part of the document before the array is
+    tokenized in Python; each element is decoded by the C scanner once it is
+    complete in the buffer, so at most one element is alive at a time.
+    """
+    buf = ""
+    pos = 0
+    eof = False
+    read_size = chunk_size
+
+    def refill() -> None:
+        nonlocal buf, pos, eof
+        chunk = f.read(read_size)
+        if chunk:
+            buf = buf[pos:] + chunk
+            pos = 0
+        else:
+            eof = True
+
+    # 1) find `"key": [` at depth 1
+    want_key = f'"{key}"'
+    depth = 0
+    key_seen = False
+    while True:
+        m = _TOKEN.search(buf, pos)
+        if m is None or m.group() == '"':
+            if eof:
+                if m is not None:
+                    raise ValueError("Truncated JSON while streaming")
+                return
+            refill()
+            continue
+        tok = m.group()
+        if tok[0] == '"':
+            pos = m.end()
+            if depth == 1:
+                key_seen = tok == want_key
+            continue
+        if tok == "[" and depth == 1 and key_seen and buf[pos:m.start()].strip() == ":":
+            pos = m.end()
+            break
+        pos = m.end()
+        depth += 1 if tok in "{[" else -1
+        key_seen = False
+
+    # 2) decode elements until the closing bracket
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Truncated JSON while streaming")
+            refill()
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            item, end = _DECODER.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_size *= 2  # element larger than a chunk
+            refill()
+            continue
+        if end == len(buf) and not eof:
+            refill()  # a trailing number may have been cut short
+            continue
+        read_size = chunk_size
+        pos = end
+        yield item
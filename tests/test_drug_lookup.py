@@ -0,0 +1,714 @@
+# tests/test_drug_lookup.py
+
+import sys, os, json, sqlite3, threading
+import pytest
+
+# ensure project root is on PYTHONPATH
+sys.path.insert(0, os.path.abspath(os.getcwd()))
+
+from src.drug_lookup import db
+from src.drug_lookup.match_fhir_to_drugs import (
+    find_drug_by_rxnorm,
+    find_drug_by_name,
+    match_fhir_medication,
+    match_fhir_medications,
+)
+from src.drug_lookup.query_drug_knowledge import get_drug_knowledge
+from src.drug_lookup.rxnorm_index import get_index
+
+from src.etl import build_drug_database
+
+LABELS = [
+    # file, brand, generic, manufacturer, rxcui
+    ("a.json", "Ibuprofen", "IBUPROFEN", "Acme", "5640"),
+    ("b.json", "Metformin ER", "METFORMIN HYDROCHLORIDE", "Beta", "6809"),
+    ("c.json", "Advil", "IBUPROFEN", "Pfizer", ""),
+    ("d.json", "Glumetza", "METFORMIN HYDROCHLORIDE", "Santarus", ""),
+    ("e.json", "Children's Metformin", "METFORMIN", "Gamma", ""),
+    ("f.json", "Metformin", "METFORMIN", "Delta", ""),
+]
+
+
+def _label(brand, generic, manufacturer, rxcui):
+    openfda = {
+        "brand_name": [brand],
+        "generic_name": [generic],
+        "manufacturer_name": [manufacturer],
+    }
+    if rxcui:
+        openfda["rxcui"] = [rxcui]
+    return {
+        "effective_time": "20240101",
+        "openfda": openfda,
+        "dosage_form": "TABLET",
+        "indications_and_usage": [f"Pain relief ({brand})"],
+        "adverse_reactions": [f"Nausea ({brand})"],
+    }
+
+
+@pytest.fixture
+def drug_db_path(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    for fname, brand, generic, manufacturer, rxcui in LABELS:
+        (raw / fname).write_text(json.dumps(_label(brand, generic, manufacturer, rxcui)))
+
+    path = tmp_path / "drugs.db"
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(path))
+    build_drug_database.main()
+
+    monkeypatch.setattr(db, "DB_PATH", str(path))
+    db.reset_pool()
+    yield str(path)
+    db.reset_pool()
+
+
+def _slug(name):
+    return find_drug_by_name(name)["slug_id"]
+
+
+def test_lookup_by_rxnorm(drug_db_path):
+    hit = find_drug_by_rxnorm("5640")
+    assert hit["slug_id"] == "ibuprofen-acme"
+    assert hit["form"] == "TABLET"
+    assert find_drug_by_rxnorm("0000") is None
+
+
+def test_rxnorm_map_serves_codes_without_sqlite(drug_db_path):
+    index = get_index()
+    index.load()
+    queries = db.stats()["queries"]
+    assert find_drug_by_rxnorm("6809")["slug_id"] == "metformin-er-beta"
+    assert find_drug_by_rxnorm("0000") is None
+    assert db.stats()["queries"] == queries
+    assert index.stats()["version"]
+    assert find_drug_by_rxnorm("6809", use_map=False)["slug_id"] == "metformin-er-beta"
+
+
+def test_rxnorm_map_reloads_when_db_changes(drug_db_path, monkeypatch):
+    index = get_index()
+    monkeypatch.setattr(index, "check_interval", 0)
+    assert find_drug_by_rxnorm("1111") is None
+
+    conn = sqlite3.connect(drug_db_path)
+    conn.execute("UPDATE medication SET fhir_code = '1111' WHERE slug_id = 'advil-pfizer'")
+    conn.commit()
+    conn.close()
+
+    assert find_drug_by_rxnorm("1111")["slug_id"] == "advil-pfizer"
+
+
+def test_db_version_without_the_map(drug_db_path, monkeypatch):
+    from src.drug_lookup import rxnorm_index
+
+    monkeypatch.setattr(rxnorm_index, "RXNORM_MAP_ENABLED", False)
+    monkeypatch.setattr(rxnorm_index, "CHECK_INTERVAL", 0)
+    monkeypatch.setattr(rxnorm_index, "_version_key", None)
+    loads = get_index().stats()["loads"]
+    version = rxnorm_index.db_version()
+    assert version
+
+    conn = sqlite3.connect(drug_db_path)
+    build_drug_database.write_version(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    assert rxnorm_index.db_version() not in (None, version)
+    assert get_index().stats()["loads"] == loads   # the map was never loaded
+
+
+def test_name_lookup_ranks_exact_then_prefix_then_substring(drug_db_path):
+    assert _slug("Metformin") == "metformin-delta"
+    assert _slug("  METFORMIN   er ") == "metformin-er-beta"
+    assert _slug("metf") == "metformin-er-beta"
+    assert _slug("formin") == "metformin-er-beta"
+    assert _slug("children's") == "children-s-metformin-gamma"
+
+
+def test_name_lookup_falls_back_to_generic_names(drug_db_path):
+    assert _slug("hydrochloride") == "metformin-er-beta"
+    assert find_drug_by_name("zzzz") is None
+
+
+def test_name_lookup_short_and_wildcard_queries(drug_db_path):
+    assert _slug("ad") == "advil-pfizer"
+    assert find_drug_by_name("%") is None
+
+
+def test_name_lookup_on_legacy_schema(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE medication (id TEXT PRIMARY KEY, slug_id TEXT, fhir_code TEXT, name TEXT,"
+                 " manufacturer TEXT, form TEXT, route TEXT, last_updated TEXT)")
+    conn.execute("INSERT INTO medication VALUES ('m1', 'advil', '', 'Advil', 'Pfizer', 'TABLET', 'ORAL', NULL)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(db, "DB_PATH", str(path))
+    db.reset_pool()
+    try:
+        assert find_drug_by_name("dvi")["id"] == "m1"
+    finally:
+        db.reset_pool()
+
+
+def test_match_fhir_medication_falls_back_to_name(drug_db_path):
+    med = {"code": {"coding": [{"code": "999", "display": "Advil"}]}}
+    assert match_fhir_medication(med)["slug_id"] == "advil-pfizer"
+
+
+@pytest.mark.parametrize("use_map", [True, False])
+def test_match_fhir_medications_batches_lookups(drug_db_path, use_map):
+    get_index().load()
+    db.has_table("medication_fts")
+
+    meds = [
+        {"id": "ibu", "code": {"coding": [{"code": "5640", "display": "whatever"}]}},
+        {"id": "met", "code": {"coding": [{"code": "6809"}]}},
+        {"id": "adv1", "code": {"coding": [{"code": "123", "display": "Advil"}]}},
+        {"id": "adv2", "code": {"coding": [{"display": "Advil"}]}},
+        {"id": "none", "code": {"text": "Unknown"}},
+    ]
+    queries = db.stats()["queries"]
+    result = match_fhir_medications(meds, use_map=use_map)
+
+    assert {k: (v or {}).get("slug_id") for k, v in result.items()} == {
+        "ibu": "ibuprofen-acme",
+        "met": "metformin-er-beta",
+        "adv1": "advil-pfizer",
+        "adv2": "advil-pfizer",
+        "none": None,
+    }
+    # one IN query (unless the map answered), plus one name lookup for "Advil"
+    assert db.stats()["queries"] - queries <= (1 if use_map else 2)
+    for med in meds:
+        assert result[med["id"]] == match_fhir_medication(med)
+
+
+def test_get_drug_knowledge(drug_db_path):
+    text = get_drug_knowledge("ibuprofen-acme")
+    assert "Indications: Pain relief (Ibuprofen)" in text
+    assert "Side Effects: Nausea (Ibuprofen)" in text
+    assert get_drug_knowledge("nope") == "No detailed information found."
+
+
+def test_pool_reuses_connections_and_counts(drug_db_path):
+    for _ in range(20):
+        get_drug_knowledge("ibuprofen-acme")
+    stats = db.stats()
+    assert stats["open_connections"] == 1
+    assert stats["queries"] == 20
+
+
+def test_pool_is_read_only(drug_db_path):
+    with pytest.raises(sqlite3.OperationalError):
+        db.fetch_one("DELETE FROM medication")
+
+
+def test_pool_bounds_concurrent_connections(drug_db_path):
+    pool = db.DrugDBPool(drug_db_path, size=2, timeout=5)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(50):
+                assert pool.fetch_one("SELECT * FROM medication WHERE fhir_code = ?", ("5640",))["slug_id"] == "ibuprofen-acme"
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close()
+
+    assert not errors
+    stats = pool.stats()
+    assert stats["open_connections"] <= 2
+    assert stats["queries"] == 400
+
+
+# ---------- semantic label retrieval (needs faiss + numpy) ----------
+
+class WordEncoder:
+    """Stand-in for MiniLM: one dimension per vocabulary word."""
+    VOCAB = ["nausea", "bleeding", "warfarin", "dizziness", "liver", "rash"]
+
+    def __init__(self):
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return len(self.VOCAB)
+
+    def encode(self, texts, **kwargs):
+        import numpy as np
+        self.encoded.extend(texts)
+        out = np.zeros((len(texts), len(self.VOCAB)), dtype="float32")
+        for row, text in enumerate(texts):
+            for col, word in enumerate(self.VOCAB):
+                out[row, col] = text.lower().count(word)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.where(norms == 0, 1, norms)
+
+
+KNOWLEDGE = {
+    # medication id: (name, side_effects, interactions, warnings)
+    "m1": ("Ibuprofen", "Nausea and dizziness.", "Bleeding risk with warfarin.", None),
+    "m2": ("Acetaminophen", None, None, "Liver injury, rash."),
+    "m3": ("Ondansetron", "Nausea.", None, None),
+}
+
+
+def _knowledge_db(path, knowledge):
+    conn = sqlite3.connect(path)
+    conn.execute("DROP TABLE IF EXISTS medication")
+    conn.execute("DROP TABLE IF EXISTS medication_knowledge")
+    conn.execute("CREATE TABLE medication (id TEXT PRIMARY KEY, name TEXT)")
+    conn.execute("CREATE TABLE medication_knowledge (medication_id TEXT, side_effects TEXT, interactions TEXT, warnings TEXT)")
+    for med_id, (name, *sections) in knowledge.items():
+        conn.execute("INSERT INTO medication VALUES (?, ?)", (med_id, name))
+        conn.execute("INSERT INTO medication_knowledge VALUES (?, ?, ?, ?)", (med_id, *sections))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def label_index(tmp_path):
+    pytest.importorskip("faiss")
+    from src.etl import build_faiss_index
+
+    paths = {
+        "db_path": str(tmp_path / "drugs.db"),
+        "index_path": str(tmp_path / "index.bin"),
+        "meta_path": str(tmp_path / "meta.db"),
+        "cache_path": str(tmp_path / "embeddings.db"),
+    }
+
+    def build(knowledge=KNOWLEDGE, **kwargs):
+        _knowledge_db(paths["db_path"], knowledge)
+        encoder = WordEncoder()
+        build_faiss_index.main(model=encoder, **paths, **kwargs)
+        return encoder
+
+    build.paths = paths
+    return build
+
+
+def test_label_retriever_filters_to_patient_drugs(label_index):
+    from src.drug_lookup.label_retriever import LabelRetriever
+
+    label_index()
+    retriever = LabelRetriever(label_index.paths["index_path"], label_index.paths["meta_path"], encoder=WordEncoder())
+    retriever.load()
+
+    drugs = retriever.drugs_in(["Ibuprofen 200 mg tablet", "Acetaminophen (Tylenol) 325 mg"])
+    assert drugs == ["ibuprofen", "acetaminophen"]
+
+    hits = retriever.search("does it interact with warfarin? bleeding", drugs=drugs)
+    assert hits[0]["drug"] == "Ibuprofen" and hits[0]["section"] == "interactions"
+
+    batch = retriever.search_batch(["nausea", "liver"], drugs=drugs, k=1)
+    assert [h[0]["text"] for h in batch] == ["Nausea and dizziness.", "Liver injury, rash."]
+    assert retriever.search("nausea", drugs=["unknown"]) == []
+    assert {h["drug"] for h in retriever.search("nausea", k=4)} == {"Ibuprofen", "Ondansetron"}
+    assert retriever.stats()["queries"] == 5
+
+
+def test_faiss_index_updates_incrementally(label_index):
+    from src.drug_lookup.label_retriever import LabelRetriever
+
+    assert len(label_index().encoded) == 4
+    assert label_index().encoded == []  # nothing changed
+
+    knowledge = dict(KNOWLEDGE)
+    knowledge["m1"] = ("Ibuprofen", "Nausea and dizziness.", "Bleeding risk with warfarin.", "Rash.")
+    del knowledge["m3"]
+    assert label_index(knowledge).encoded == ["Rash."]
+
+    retriever = LabelRetriever(label_index.paths["index_path"], label_index.paths["meta_path"], encoder=WordEncoder())
+    retriever.load()
+    assert retriever.stats()["vectors"] == 4
+    assert {h["drug"] for h in retriever.search("nausea", k=4)} == {"Ibuprofen"}
+
+    # a full rebuild re-adds every vector but embeds nothing new
+    assert label_index(knowledge, full=True).encoded == []
+    retriever.load()
+    assert retriever.stats()["vectors"] == 4
+
+    # a renamed drug with the same text: nothing to embed, but the name is updated
+    knowledge["m2"] = ("Paracetamol",) + knowledge["m2"][1:]
+    assert label_index(knowledge).encoded == []
+    retriever.load()
+    assert retriever.drugs_in(["Paracetamol 500 mg"]) == ["paracetamol"]
+    assert retriever.search("liver", drugs=["paracetamol"])[0]["drug"] == "Paracetamol"
+
+
+def test_get_retriever_reloads_a_rebuilt_index(label_index, monkeypatch):
+    from src.drug_lookup import label_retriever
+
+    label_index()
+    monkeypatch.setattr(label_retriever, "FAISS_INDEX_PATH", label_index.paths["index_path"])
+    monkeypatch.setattr(label_retriever, "FAISS_META_PATH", label_index.paths["meta_path"])
+    monkeypatch.setattr(label_retriever, "SentenceTransformer", lambda name: WordEncoder())
+    monkeypatch.setattr(label_retriever, "RETRIEVER_CHECK_SECONDS", 0)
+    monkeypatch.setattr(label_retriever, "_retriever", None)
+    monkeypatch.setattr(label_retriever, "_signature", None)
+
+    first = label_retriever.get_retriever()
+    assert first.stats()["vectors"] == 4
+    assert label_retriever.get_retriever() is first  # unchanged files: no reload
+
+    knowledge = dict(KNOWLEDGE)
+    del knowledge["m3"]
+    label_index(knowledge)
+    second = label_retriever.get_retriever()
+    assert second is not first and second.encoder is first.encoder
+    assert {h["drug"] for h in second.search("nausea", k=4)} == {"Ibuprofen"}
+
+
+def test_embedding_cache_encodes_only_misses(tmp_path):
+    pytest.importorskip("numpy")
+    from src.etl.embedding_cache import EmbeddingCache
+
+    encoder = WordEncoder()
+    cache = EmbeddingCache(str(tmp_path / "embeddings.db"), "word")
+    first = cache.encode(encoder, ["Nausea.", "Rash.", "Nausea."])
+    assert encoder.encoded == ["Nausea.", "Rash."]
+    assert (first[0] == first[2]).all() and first.dtype == "float32"
+
+    again = cache.encode(encoder, ["Rash.", "Liver injury."])
+    assert encoder.encoded[2:] == ["Liver injury."]
+    assert (again[0] == first[1]).all()
+    assert cache.stats() == {"entries": 3, "encoded": 3, "reused": 2}
+
+    # other models don't share vectors
+    assert EmbeddingCache(str(tmp_path / "embeddings.db"), "other").stats()["entries"] == 0
+
+
+# ---------- openFDA fetcher (against a local stub server) ----------
+
+class StubOpenFDA:
+    """Serves /label.json pages, /download.json and one bulk zip; can inject failures."""
+
+    def __init__(self, labels):
+        import io, zipfile
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import urlparse, parse_qs
+
+        self.labels = labels
+        self.failures = {}  # skip -> list of status codes to return first
+        self.last_updated = None
+        self.log = []
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("drug-label-0001-of-0001.json", json.dumps({"meta": {}, "results": labels}, indent=1))
+        self.zip_bytes = buf.getvalue()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b"", headers=()):
+                self.send_response(status)
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                stub.log.append(self.path)
+                if url.path == "/label.json":
+                    q = parse_qs(url.query)
+                    skip, limit = int(q["skip"][0]), int(q["limit"][0])
+                    pending = stub.failures.get(skip)
+                    if pending:
+                        status = pending.pop(0)
+                        return self._send(status, headers=[("Retry-After", "0")] if status == 429 else ())
+                    if skip >= len(stub.labels):
+                        return self._send(400)
+                    page = {"meta": {"last_updated": stub.last_updated, "results": {"total": len(stub.labels)}}, "results": stub.labels[skip:skip + limit]}
+                    return self._send(200, json.dumps(page).encode())
+                if url.path == "/download.json":
+                    listing = {"results": {"drug": {"label": {"partitions": [{"file": stub.url("/bulk/part1.zip")}]}}}}
+                    return self._send(200, json.dumps(listing).encode())
+                if url.path == "/bulk/part1.zip":
+                    return self._send(200, stub.zip_bytes)
+                self._send(404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def openfda(tmp_path):
+    labels = [
+        {"set_id": f"set-{i}", "effective_time": "20240101",
+         "openfda": {"brand_name": [f"Drug {i}"], "manufacturer_name": ["Acme"]}}
+        for i in range(25)
+    ]
+    stub = StubOpenFDA(labels)
+    yield stub
+    stub.close()
+
+
+def _fetcher(stub, out_dir, **kwargs):
+    from src.etl.fetch_openfda_labels import OpenFDAFetcher
+    opts = dict(base_url=stub.url("/label.json"), download_url=stub.url("/download.json"),
+                out_dir=str(out_dir), api_key="", workers=3, rate=0, page_size=10, backoff=0.01, timeout=5)
+    opts.update(kwargs)
+    return OpenFDAFetcher(**opts)
+
+
+def _shard_labels(out_dir):
+    labels = []
+    for path in sorted(out_dir.glob("*.ndjson")):
+        labels += [json.loads(line) for line in path.read_text().splitlines()]
+    return labels
+
+
+def test_openfda_fetcher_retries_and_writes_shards(openfda, tmp_path, monkeypatch):
+    openfda.failures = {10: [429], 20: [503]}
+    out = tmp_path / "raw"
+    stats = _fetcher(openfda, out).fetch_all()
+
+    assert stats["labels"] == 25 and stats["retries"] == 2 and stats["throttled"] == 1
+    assert sorted(l["set_id"] for l in _shard_labels(out)) == sorted(l["set_id"] for l in openfda.labels)
+    assert len(list(out.glob("*.ndjson"))) == 3
+    assert json.loads((out / "checkpoint.json").read_text())["pages"] == [0, 10, 20]
+
+    # the shards feed straight into the drug database build
+    monkeypatch.setattr(build_drug_database, "RAW", str(out))
+    monkeypatch.setattr(build_drug_database, "DB", str(tmp_path / "drugs.db"))
+    build_drug_database.main()
+    conn = sqlite3.connect(str(tmp_path / "drugs.db"))
+    assert conn.execute("SELECT COUNT(*) FROM medication").fetchone()[0] == 25
+    conn.close()
+
+
+def test_build_parses_in_worker_processes(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    labels = [_label(brand, generic, manufacturer, rxcui) for _, brand, generic, manufacturer, rxcui in LABELS]
+    (raw / "labels-0.ndjson").write_text("".join(json.dumps(l, separators=(",", ":")) + "\n" for l in labels[:3]))
+    (raw / "labels-1.ndjson").write_text("".join(json.dumps(l, separators=(",", ":")) + "\n" for l in labels[3:]))
+    (raw / "legacy.json").write_text(json.dumps(_label("Tylenol", "ACETAMINOPHEN", "McNeil", ""), indent=2))
+
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(tmp_path / "drugs.db"))
+    monkeypatch.setattr(build_drug_database, "WORKERS", 2)
+    monkeypatch.setattr(build_drug_database, "BATCH_SIZE", 2)
+    build_drug_database.main()
+
+    conn = sqlite3.connect(str(tmp_path / "drugs.db"))
+    names = [r[0] for r in conn.execute("SELECT name FROM medication")]
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    conn.close()
+    assert sorted(names) == sorted([l[1] for l in LABELS] + ["Tylenol"])
+    assert {"idx_medication_name_norm", "idx_medication_fhir_code"} <= indexes
+
+
+def test_raw_labels_are_stored_compressed_apart_from_knowledge(drug_db_path):
+    from src.drug_lookup.raw_store import decompress, get_raw_label
+
+    conn = sqlite3.connect(drug_db_path)
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(medication_knowledge)")}
+    codec, size, blob = conn.execute("SELECT codec, raw_size, raw FROM medication_raw LIMIT 1").fetchone()
+    conn.close()
+    assert not {"raw_text", "fhir_blob"} & columns
+    assert isinstance(blob, bytes) and len(decompress(codec, blob).encode()) == size
+
+    label = get_raw_label("ibuprofen-acme")
+    assert label["openfda"]["manufacturer_name"] == ["Acme"]
+    assert get_raw_label("no-such-drug") is None
+    # the serving query doesn't touch the raw table
+    assert "Nausea (Ibuprofen)" in get_drug_knowledge("ibuprofen-acme")
+
+
+def test_build_upserts_by_set_id(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+
+    def label(set_id, brand, effective, reaction="Nausea"):
+        l = _label(brand, brand.upper(), "Acme", "")
+        l.update(set_id=set_id, effective_time=effective, adverse_reactions=[reaction])
+        return l
+
+    def write(labels):
+        (raw / "labels-0.ndjson").write_text("".join(json.dumps(l) + "\n" for l in labels))
+
+    def table_counts():
+        conn = sqlite3.connect(str(tmp_path / "drugs.db"))
+        counts = [conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                  for t in ("medication", "medication_knowledge", "medication_raw")]
+        conn.close()
+        return counts
+
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(tmp_path / "drugs.db"))
+
+    # two copies of a new set_id count once
+    write([label("s1", "Advil", "20231201"), label("s1", "Advil", "20240101"), label("s2", "Motrin", "20240101")])
+    counts = build_drug_database.main()
+    assert (counts["inserted"], counts["updated"], counts["unchanged"]) == (2, 0, 0)
+
+    counts = build_drug_database.main()
+    assert (counts["inserted"], counts["updated"], counts["unchanged"]) == (0, 0, 2)
+
+    # a revised label replaces its row; an older copy of it and another set_id with the same slug don't
+    write([
+        label("s1", "Advil", "20240301", reaction="Rash"),
+        label("s1", "Advil", "20240101"),
+        label("s2", "Motrin", "20240101"),
+        label("s3", "Advil", "20240401"),
+        label("s4", "Aleve", "20240101"),
+    ])
+    counts = build_drug_database.main()
+    assert counts == {"inserted": 1, "updated": 1, "unchanged": 1, "duplicates": 1, "pruned": 0}
+    assert table_counts() == [3, 3, 3]
+    conn = sqlite3.connect(str(tmp_path / "drugs.db"))
+    assert conn.execute("SELECT side_effects FROM medication_knowledge WHERE medication_id = 's1'").fetchone() == ("Rash",)
+    conn.close()
+
+    write([label("s1", "Advil", "20240301", reaction="Rash")])
+    assert build_drug_database.main(prune=True)["pruned"] == 2
+    assert table_counts() == [1, 1, 1]
+
+
+def test_first_build_is_renamed_into_place(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    (raw / "a.json").write_text(json.dumps(_label("Advil", "IBUPROFEN", "Pfizer", "")))
+    (tmp_path / "drugs.db.tmp").write_bytes(b"left over from a crashed build")
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(tmp_path / "drugs.db"))
+    build_drug_database.main()
+    assert sorted(p.name for p in tmp_path.glob("drugs.db*")) == ["drugs.db"]
+
+    # an incremental build updates the live file in place and keeps its indexes
+    (raw / "b.json").write_text(json.dumps(_label("Motrin", "IBUPROFEN", "J&J", "")))
+    assert build_drug_database.main()["inserted"] == 1
+    assert not (tmp_path / "drugs.db.tmp").exists()
+    conn = sqlite3.connect(str(tmp_path / "drugs.db"))
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    conn.close()
+    assert set(build_drug_database.SECONDARY_INDEXES) <= indexes
+
+
+def test_build_moves_raw_text_out_of_existing_database(tmp_path, monkeypatch):
+    path = tmp_path / "drugs.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("""CREATE TABLE medication_knowledge (medication_id TEXT PRIMARY KEY, indications TEXT,
+        contraindications TEXT, side_effects TEXT, interactions TEXT, warnings TEXT, raw_text TEXT, fhir_blob TEXT)""")
+    conn.commit()
+    conn.close()
+
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    (raw / "a.json").write_text(json.dumps(_label("Advil", "IBUPROFEN", "Pfizer", "")))
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(path))
+    build_drug_database.main()
+
+    conn = sqlite3.connect(str(path))
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(medication_knowledge)")}
+    assert conn.execute("SELECT COUNT(*) FROM medication_raw").fetchone()[0] == 1
+    conn.close()
+    assert "raw_text" not in columns
+
+
+def test_build_migrates_raw_text_of_unchanged_labels(tmp_path, monkeypatch):
+    from src.drug_lookup.raw_store import decompress
+    path = tmp_path / "drugs.db"
+    label = _label("Advil", "IBUPROFEN", "Pfizer", "")
+    label["set_id"] = "s1"
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE medication (id TEXT PRIMARY KEY, slug_id TEXT UNIQUE, fhir_code TEXT, name TEXT, "
+                 "manufacturer TEXT, form TEXT, route TEXT, last_updated TEXT)")
+    conn.execute("""CREATE TABLE medication_knowledge (medication_id TEXT PRIMARY KEY, indications TEXT,
+        contraindications TEXT, side_effects TEXT, interactions TEXT, warnings TEXT, raw_text TEXT, fhir_blob TEXT)""")
+    conn.execute("CREATE TABLE etl_meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT INTO etl_meta VALUES ('id_scheme', ?)", (build_drug_database.ID_SCHEME,))
+    conn.execute("INSERT INTO medication (id, slug_id, name, last_updated) VALUES ('s1', 'advil', 'Advil', '20240101')")
+    conn.execute("INSERT INTO medication_knowledge (medication_id, raw_text, fhir_blob) VALUES ('s1', ?, '{}')",
+                 (json.dumps(label),))
+    conn.commit()
+    conn.close()
+
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    (raw / "labels-0.ndjson").write_text(json.dumps(label) + "\n")
+    monkeypatch.setattr(build_drug_database, "RAW", str(raw))
+    monkeypatch.setattr(build_drug_database, "DB", str(path))
+    assert build_drug_database.main()["unchanged"] == 1
+
+    conn = sqlite3.connect(str(path))
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(medication_knowledge)")}
+    codec, size, blob, fhir = conn.execute(
+        "SELECT codec, raw_size, raw, fhir_blob FROM medication_raw WHERE medication_id = 's1'"
+    ).fetchone()
+    conn.close()
+    assert not columns & {"raw_text", "fhir_blob"}
+    assert json.loads(decompress(codec, blob)) == label and size == len(json.dumps(label))
+    assert decompress(codec, fhir) == "{}"
+
+
+def test_openfda_fetcher_resumes_from_checkpoint(openfda, tmp_path):
+    import requests
+    openfda.failures = {20: [500, 500]}
+    out = tmp_path / "raw"
+    with pytest.raises(requests.HTTPError):
+        _fetcher(openfda, out, max_retries=1).fetch_all()
+    assert json.loads((out / "checkpoint.json").read_text())["pages"] == [0, 10]
+    assert not list(out.glob("*.tmp"))
+
+    openfda.log.clear()
+    stats = _fetcher(openfda, out).fetch_all()
+    # page 0 again for the release check, then only the missing page
+    assert [p.split("?")[0] for p in openfda.log] == ["/label.json"] * 2
+    assert "skip=0" in openfda.log[0] and "skip=20" in openfda.log[1]
+    assert stats["labels"] == 5
+    assert len(_shard_labels(out)) == 25
+
+
+def test_openfda_fetcher_starts_over_for_a_new_release(openfda, tmp_path):
+    out = tmp_path / "raw"
+    openfda.last_updated = "2024-01-01"
+    assert _fetcher(openfda, out).fetch_all()["labels"] == 25
+    assert _fetcher(openfda, out).fetch_all()["labels"] == 0
+
+    openfda.last_updated = "2024-02-01"
+    assert _fetcher(openfda, out).fetch_all()["labels"] == 25
+    assert json.loads((out / "checkpoint.json").read_text())["release"] == "2024-02-01"
+
+
+def test_openfda_bulk_download_streams_into_shards(openfda, tmp_path):
+    out = tmp_path / "raw"
+    stats = _fetcher(openfda, out, shard_size=10).ingest_bulk()
+    assert stats["labels"] == 25 and stats["partitions_done"] == 1
+    assert [p.name for p in sorted(out.glob("*"))] == [
+        "bulk-part1-00000.ndjson", "bulk-part1-00001.ndjson", "bulk-part1-00002.ndjson", "checkpoint.json",
+    ]
+    assert [l["set_id"] for l in _shard_labels(out)] == [l["set_id"] for l in openfda.labels]
+
+    openfda.log.clear()
+    assert _fetcher(openfda, out).ingest_bulk()["labels"] == 0
+    assert openfda.log == ["/download.json"]
+
+    # a forced rerun overwrites the partition's shards and removes the ones it no longer fills
+    fetcher = _fetcher(openfda, out, shard_size=20)
+    fetcher.checkpoint.reset()
+    assert fetcher.ingest_bulk()["labels"] == 25
+    assert sorted(p.name for p in out.glob("*.ndjson")) == ["bulk-part1-00000.ndjson", "bulk-part1-00001.ndjson"]
+    assert len(_shard_labels(out)) == 25
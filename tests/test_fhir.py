@@ -0,0 +1,208 @@
+# tests/test_fhir.py
+
+import sys, os, json
+import pytest
+
+# ensure project root is on PYTHONPATH
+sys.path.insert(0, os.path.abspath(os.getcwd()))
+
+import src.fhir.client as client
+from src.fhir.client import BundleCache
+from src.utils.json_stream import iter_array_items
+
+EMILY = "data/fhir/emily.json"
+
+
+def write_bundle(path, *resources):
+    path.write_text(json.dumps({
+        "resourceType": "Bundle",
+        "entry": [{"resource": r} for r in resources],
+    }))
+
+
+def test_bundle_cache_reuses_parse_until_file_changes(tmp_path):
+    path = tmp_path / "p.json"
+    write_bundle(path, {"resourceType": "Patient", "id": "a"})
+    cache = BundleCache()
+
+    first = cache.get(str(path)).resources
+    again = cache.get(str(path)).resources
+    assert again is first and isinstance(first, tuple)
+    assert cache.stats()["hits"] == 1
+
+    write_bundle(path, {"resourceType": "Patient", "id": "a"}, {"resourceType": "Condition", "id": "c"})
+    changed = cache.get(str(path)).resources
+    assert [r["id"] for r in changed] == ["a", "c"]
+    assert cache.stats()["reloads"] == 1
+
+
+def test_bundle_cache_evicts_lru_by_bytes(tmp_path):
+    paths = []
+    for name in ("a", "b", "c"):
+        p = tmp_path / f"{name}.json"
+        write_bundle(p, {"resourceType": "Patient", "id": name})
+        paths.append(str(p))
+    size = os.path.getsize(paths[0])
+    cache = BundleCache(max_bytes=2 * size)
+
+    cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])          # a is now most recently used
+    cache.get(paths[2])          # evicts b
+    stats = cache.stats()
+    assert stats["bundles"] == 2 and stats["evictions"] == 1
+    assert stats["bytes"] <= cache.max_bytes
+
+    cache.get(paths[0])
+    assert cache.stats()["hits"] == 2
+
+
+def test_json_and_orjson_parse_identically(monkeypatch):
+    pytest.importorskip("orjson")
+    fast = BundleCache().get(EMILY).bundle
+    monkeypatch.setattr(client, "orjson", None)
+    slow = BundleCache().get(EMILY).bundle
+    assert fast == slow
+
+
+# ---------- compiled bundle ----------
+
+from src.fhir.bundle import compile_bundle
+from src.fhir import getters
+from src.core.summarizer import summarize_fhir_bundle
+
+
+@pytest.mark.parametrize("ref", [
+    "ibuprofen", "Medication/ibuprofen", "urn:uuid:ibuprofen", "urn:uuid:med-ibuprofen",
+])
+def test_compiled_bundle_resolves_medication_references(ref):
+    compiled = compile_bundle([
+        {"resourceType": "MedicationStatement", "status": "active", "medicationReference": {"reference": ref}},
+        {"resourceType": "Medication", "id": "ibuprofen", "code": {"text": "Ibuprofen 200 mg tablet"}},
+    ])
+    (ms,) = compiled.medication_statements
+    assert ms.name == "Ibuprofen 200 mg tablet"
+    assert ms.medication is compiled.medications[0]
+
+
+def test_getters_read_compiled_bundle():
+    bundle = client.fetch_fhir_resources(EMILY)
+    compiled = client.fetch_compiled_bundle(EMILY)
+    assert compiled is client.fetch_compiled_bundle(EMILY)
+    resources = list(client.fetch_bundle_resources(EMILY))
+    for getter in (getters.get_general_info, getters.get_allergies, getters.get_conditions,
+                   getters.get_current_medications, getters.get_observations, getters.get_carePlan):
+        assert getter(compiled) == getter(resources) == getter(bundle)
+    assert "Letrozole 2.5 mg tablet (status: active)" in getters.get_current_medications(compiled)
+
+
+def test_summarizer_keeps_bundle_order():
+    summary = summarize_fhir_bundle({"entry": [
+        {"resource": {"resourceType": "Observation", "effectiveDateTime": "2024-01-01",
+                      "code": {"text": "Weight"}, "valueQuantity": {"value": 70, "unit": "kg"}}},
+        {"resource": {"resourceType": "MedicationStatement", "status": "active",
+                      "effectivePeriod": {"start": "2024-02-01"},
+                      "medicationCodeableConcept": {"text": "Metformin"}}},
+        {"resource": {"resourceType": "Observation", "issued": "2024-03-01",
+                      "component": [{"code": {"text": "HbA1c"}, "valueQuantity": {"value": 7, "unit": "%"}}]}},
+    ]})
+    assert summary.splitlines() == [
+        "2024-01-01: Weight = 70kg",
+        "2024-02-01: Metformin (status: active)",
+        "2024-03-01: HbA1c = 7%",
+    ]
+
+
+# ---------- materialized category summaries ----------
+
+import src.core.fhir_query_builder as fhir_query_builder
+from src.core.summary_store import CATEGORY_GETTERS, SummaryStore
+
+
+@pytest.fixture
+def patient_dir(tmp_path, monkeypatch):
+    data = tmp_path / "fhir"
+    data.mkdir()
+    write_bundle(data / "p1.json",
+                 {"resourceType": "Patient", "name": [{"given": ["Ann"], "family": "Lee"}]},
+                 {"resourceType": "Condition", "code": {"text": "Asthma"}, "onsetDateTime": "2020"})
+    monkeypatch.setattr(fhir_query_builder, "LOCAL_FHIR_DATA_DIR", str(data))
+    return data
+
+
+def test_summary_store_renders_once_until_bundle_changes(patient_dir):
+    store = SummaryStore(persist_dir="")
+    assert store.get("p1", "conditions") == "2020: Asthma"
+    assert store.get_many("p1", ["generalInfo", "bogus"]) == ["Patient: Ann Lee, Gender: unknown, DOB: unknown"]
+    assert store.stats()["renders"] == 1 and store.stats()["hits"] == 1
+
+    write_bundle(patient_dir / "p1.json", {"resourceType": "Condition", "code": {"text": "Gout"}, "onsetDateTime": "2021"})
+    assert store.get("p1", "conditions") == "2021: Gout"
+    assert store.stats()["renders"] == 2
+
+
+def test_summary_store_persists_across_restarts(patient_dir, tmp_path, monkeypatch):
+    persist = tmp_path / "summaries"
+    SummaryStore(persist_dir=str(persist)).warm(["p1"])
+    assert (persist / "p1.json").exists()
+
+    def no_render(self, *args):
+        raise AssertionError("should have been served from disk")
+
+    monkeypatch.setattr(SummaryStore, "_render", no_render)
+    restarted = SummaryStore(persist_dir=str(persist))
+    assert set(restarted.summaries("p1")) == set(CATEGORY_GETTERS)
+    assert restarted.stats()["disk_loads"] == 1
+
+
+# ---------- streaming, projected parse ----------
+
+import io
+from src.core.fhir_query_builder import build_query
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_iter_array_items_matches_full_parse(chunk_size):
+    doc = {
+        "meta": {"entry": ["nested, not the one"]},
+        "type": "entry",
+        "entry": [
+            {"resource": {"resourceType": "Patient", "name": [{"text": "brackets ]}[{ and \\\" quotes"}]}},
+            {"resource": {"resourceType": "Observation", "valueQuantity": {"value": 123456}}},
+            12345,
+        ],
+        "tail": [{"ignored": True}],
+    }
+    items = list(iter_array_items(io.StringIO(json.dumps(doc)), "entry", chunk_size))
+    assert items == doc["entry"]
+
+
+def test_iter_array_items_rejects_truncated_input():
+    with pytest.raises(ValueError):
+        list(iter_array_items(io.StringIO('{"entry": [{"a": 1}, {"b"'), "entry"))
+
+
+def test_build_query_passes_projection_through():
+    query = build_query(["AllergyIntolerance"], {"patient": "emily"})
+    assert query.path.endswith("emily.json")
+    assert query.resource_types == ("AllergyIntolerance",)
+    assert build_query([], {"patient": "emily"}).resource_types is None
+
+
+def test_projected_bundle_keeps_only_requested_types(monkeypatch):
+    monkeypatch.setattr(client, "FHIR_STREAM_MIN_BYTES", 0)
+    query = build_query(["AllergyIntolerance"], {"patient": "emily"})
+    projected = client.fetch_projected_bundle(query)
+    full = client.fetch_compiled_bundle(query.path)
+    assert projected is not full
+    assert projected.allergies == full.allergies
+    assert projected.conditions == () and projected.medications == ()
+
+
+def test_summary_store_renders_only_asked_categories_for_large_bundles(patient_dir, monkeypatch):
+    monkeypatch.setattr(client, "FHIR_STREAM_MIN_BYTES", 0)
+    store = SummaryStore(persist_dir="")
+    assert store.get("p1", "conditions") == "2020: Asthma"
+    assert set(store._summaries["p1"][1]) == {"conditions"}
+    assert store.get("p1", "generalInfo").startswith("Patient: Ann Lee")
+    assert store.stats()["renders"] == 2
@@ -0,0 +1,837 @@
+# tests/test_rag_pipeline.py
+
+import sys, os, json, asyncio, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from fastapi.testclient import TestClient
+
+# ensure project root is on PYTHONPATH
+sys.path.insert(0, os.path.abspath(os.getcwd()))
+
+import src.core.rag_controller as rag_controller
+import src.core.prompt_router as prompt_router
+from src.core.prompt_router import FUNCTION_FHIR, FUNCTION_DRUG
+from src.core.fast_router import FastRouter
+from src.core.router_cache import RouterCache
+from src.core.memory import SessionStore
+from src.core.answer_cache import AnswerCache
+from src.core.context_builder import ContextBuilder, estimate_tokens
+from src.api import app
+from src.llm.model_runner import OllamaClient, response_text
+from src.llm.scheduler import LLMScheduler, SchedulerBusy
+
+ROUTES = {
+    "What allergies do I have?": {"function": FUNCTION_FHIR, "arguments": {"patient": "emily", "categories": ["allergies"]}},
+}
+
+
+@pytest.fixture(autouse=True)
+def stub_llm(monkeypatch):
+    """Deterministic router + a generator that 'streams' the retrieved data back."""
+    seen = {}
+
+    def fake_route(prompt):
+        return ROUTES.get(prompt, {"function": None, "arguments": {}})
+
+    def fake_stream(user_prompt, retrieved_data, show_intro=False):
+        seen["retrieved_data"] = retrieved_data
+        seen.setdefault("intros", []).append(show_intro)
+        for line in retrieved_data.splitlines(keepends=True):
+            yield line
+
+    async def fake_aroute(prompt):
+        return fake_route(prompt)
+
+    async def fake_astream(user_prompt, retrieved_data, show_intro=False):
+        for chunk in fake_stream(user_prompt, retrieved_data, show_intro):
+            yield chunk
+
+    async def fake_agenerate(user_prompt, retrieved_data, show_intro=False):
+        return "".join(fake_stream(user_prompt, retrieved_data, show_intro))
+
+    monkeypatch.setattr(rag_controller, "route_prompt", fake_route)
+    monkeypatch.setattr(rag_controller, "generate_response_stream", fake_stream)
+    monkeypatch.setattr(rag_controller, "generate_response", lambda p, d, i=False: "".join(fake_stream(p, d, i)))
+    monkeypatch.setattr(rag_controller, "aroute_prompt", fake_aroute)
+    monkeypatch.setattr(rag_controller, "agenerate_response_stream", fake_astream)
+    monkeypatch.setattr(rag_controller, "agenerate_response", fake_agenerate)
+    monkeypatch.setattr(rag_controller, "sessions", SessionStore())
+    return seen
+
+
+def test_rag_inference_stream_events(stub_llm):
+    events = list(rag_controller.rag_inference_stream("What allergies do I have?"))
+    stages = [e["stage"] for e in events if e["event"] == "stage"]
+    assert stages == ["routing", "retrieving", "generating"]
+
+    tokens = "".join(e["text"] for e in events if e["event"] == "token")
+    done = events[-1]
+    assert done["event"] == "done" and done["source"] == "fhir"
+    assert done["response"] == tokens.strip()
+    assert "Allergy:" in done["response"]
+
+
+def test_rag_inference_stream_unknown_route():
+    events = list(rag_controller.rag_inference_stream("???"))
+    assert events[-1] == {"event": "done", "source": None, "response": rag_controller.UNKNOWN_REQUEST}
+
+
+@pytest.mark.parametrize("body, headers, media", [
+    ({"stream": "ndjson"}, {}, "application/x-ndjson"),
+    ({"stream": True}, {}, "application/x-ndjson"),
+    ({}, {"accept": "text/event-stream"}, "text/event-stream"),
+])
+def test_ask_streams_events(body, headers, media):
+    client = TestClient(app)
+    resp = client.post("/ask", json={"prompt": "What allergies do I have?", **body}, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith(media)
+
+    if media == "text/event-stream":
+        lines = [l[len("data: "):] for l in resp.text.splitlines() if l.startswith("data: ")]
+    else:
+        lines = resp.text.splitlines()
+    events = [json.loads(l) for l in lines]
+    assert events[0] == {"event": "stage", "stage": "routing"}
+    assert events[-1]["event"] == "done"
+    assert "Allergy:" in events[-1]["response"]
+
+
+def test_ask_plain_text_returns_without_keepalive_delay():
+    client = TestClient(app)
+    resp = client.post("/ask", json={"prompt": "What allergies do I have?"})
+    lines = resp.text.splitlines()
+    assert lines[0] == "starting..."
+    assert "keepalive" not in resp.text
+    assert json.loads(lines[-1])["source"] == "fhir"
+
+
+def test_intro_is_shown_once_per_session(stub_llm):
+    client = TestClient(app)
+    for sid in ("a", "a", "b"):
+        resp = client.post("/ask", json={"prompt": "What allergies do I have?", "session_id": sid, "stream": True})
+        assert resp.headers["x-session-id"] == sid
+    assert stub_llm["intros"] == [True, False, True]
+    assert rag_controller.sessions.stats()["sessions"] == 2
+    assert rag_controller.sessions.stats()["in_use"] == 0
+
+    resp = client.post("/ask", json={"prompt": "What allergies do I have?", "session_id": "x" * 1000})
+    assert resp.status_code == 400
+
+
+@pytest.fixture
+def patient_routes(monkeypatch):
+    """Routes for the default patient and for the other bundled patient."""
+    default = rag_controller.DEFAULT_PATIENT_ID
+    other = "maria" if default == "emily" else "emily"
+    routes = {
+        "My allergies?": {"function": FUNCTION_FHIR, "arguments": {"patient": default, "categories": ["allergies"]}},
+        "Their allergies?": {"function": FUNCTION_FHIR, "arguments": {"patient": other, "categories": ["allergies"]}},
+        "My conditions?": {"function": FUNCTION_FHIR, "arguments": {"patient": default, "categories": ["conditions"]}},
+    }
+
+    def route(prompt):
+        time.sleep(0.02)  # an LLM round trip, long enough for an idle pool to pick the prefetch up
+        return routes.get(prompt, {"function": None, "arguments": {}})
+
+    monkeypatch.setattr(rag_controller, "route_prompt", route)
+
+
+@pytest.mark.parametrize("prompt, outcome", [
+    ("My allergies?", "used"),
+    ("Their allergies?", "wrong_patient"),
+    ("???", "discarded"),
+])
+def test_prefetch_is_used_or_discarded(monkeypatch, patient_routes, prompt, outcome):
+    result = rag_controller.rag_inference(prompt)
+    assert result["timings"]["prefetch"] == outcome
+
+    monkeypatch.setattr(rag_controller, "PREFETCH_ENABLED", False)
+    monkeypatch.setattr(rag_controller, "sessions", SessionStore())
+    inline = rag_controller.rag_inference(prompt)
+    assert inline["timings"]["prefetch"] == "off"
+    assert inline["response"] == result["response"]
+
+
+def test_prefetch_takes_retrieval_off_the_critical_path(monkeypatch, patient_routes):
+    from src.core.summary_store import summary_store
+    routed = rag_controller.route_prompt
+
+    def slow_route(prompt):
+        time.sleep(0.05)
+        return routed(prompt)
+
+    monkeypatch.setattr(rag_controller, "route_prompt", slow_route)
+    summary_store.clear()
+    timings = rag_controller.rag_inference("My conditions?")["timings"]
+    assert set(timings) >= {"route_ms", "retrieve_ms", "generate_ms", "prefetch_ms"}
+    # the summaries were rendered while routing; retrieval only picks them up
+    assert timings["retrieve_ms"] < timings["route_ms"]
+
+    stats = TestClient(app).get("/metrics").json()["pipeline"]
+    assert stats["prefetch"]["used"] >= 1 and stats["avg_ms"]["route_ms"] is not None
+
+
+def test_saturated_prefetch_pool_does_not_delay_retrieval(monkeypatch, patient_routes):
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    pool.submit(release.wait)   # another request's speculative work holds the only worker
+    monkeypatch.setattr(rag_controller, "_prefetch_pool", pool)
+    submitted = []
+    start_prefetch = rag_controller.start_prefetch
+    monkeypatch.setattr(rag_controller, "start_prefetch", lambda p: submitted.append(start_prefetch(p)) or submitted[-1])
+    try:
+        result = rag_controller.rag_inference("My allergies?")
+        assert result["timings"]["prefetch"] == "cancelled" and result["source"] == "fhir"
+        assert rag_controller.rag_inference("???")["timings"]["prefetch"] == "discarded"
+        assert all(f.cancelled() for f in submitted)
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_no_prefetch_for_a_route_known_not_to_need_it(monkeypatch):
+    cache = RouterCache()
+    monkeypatch.setattr(prompt_router, "router_cache", cache)
+    cache.put("tell me about lisinopril", prompt_router.DEFAULT_PATIENT_ID, prompt_router.router_fingerprint(),
+              {"function": FUNCTION_DRUG, "arguments": {"drug_name": "lisinopril"}})
+    assert rag_controller.start_prefetch("Tell me about lisinopril") is None
+    assert cache.stats()["hits"] == 0
+
+
+# ---------- answer cache ----------
+
+def test_answer_cache_bounds_and_sqlite_tier(tmp_path, monkeypatch):
+    import src.core.answer_cache as answer_cache_mod
+
+    db_path = str(tmp_path / "answers.db")
+    cache = AnswerCache(enabled=True, maxsize=2, max_bytes=200, ttl=60, db_path=db_path)
+    cache.put("k1", "a" * 50)
+    cache.put("k2", "b" * 50)
+    cache.get("k1")
+    cache.put("k3", "c" * 50)  # over maxsize: k2 is least recently used
+    assert cache.stats()["size"] == 2 and cache.stats()["evictions"] == 1
+    cache.put("k4", "d" * 120)  # over max_bytes
+    assert cache.stats()["bytes"] <= 200
+
+    # evicted from memory, still served (and promoted) from SQLite
+    assert cache.get("k2") == "b" * 50
+    assert cache.stats()["disk_hits"] == 1
+    cache.close()
+
+    restarted = AnswerCache(enabled=True, db_path=db_path)
+    assert restarted.get("k1") == "a" * 50
+    now = time.time()
+    monkeypatch.setattr(answer_cache_mod.time, "time", lambda: now + 120)
+    assert restarted.get("k3") is None
+    restarted.close()
+    assert AnswerCache(enabled=False).get("k1") is None
+
+
+def test_rag_inference_reuses_cached_answer(monkeypatch, stub_llm):
+    monkeypatch.setattr(rag_controller, "answer_cache", AnswerCache(enabled=True))
+    calls = []
+    monkeypatch.setattr(rag_controller, "generate_response", lambda p, d, i=False: calls.append(d) or "Answer")
+
+    prompt = "What allergies do I have?"
+    first = rag_controller.rag_inference(prompt, "a")
+    second = rag_controller.rag_inference(prompt, "b")
+    assert first["response"] == second["response"] == "Answer"
+    assert first["timings"]["answer_cache"] == "miss" and second["timings"]["answer_cache"] == "hit"
+    assert "generate_ms" not in second["timings"]
+    assert len(calls) == 1
+
+    # a streamed hit replays the answer as a single token
+    events = list(rag_controller.rag_inference_stream(prompt, "c"))
+    assert [e["text"] for e in events if e["event"] == "token"] == ["Answer"]
+
+    # a rebuilt drug DB gives new keys
+    monkeypatch.setattr(rag_controller, "drug_db_version", lambda: "rebuilt")
+    assert rag_controller.rag_inference(prompt, "d")["timings"]["answer_cache"] == "miss"
+    assert len(calls) == 2
+
+
+def test_drug_knowledge_cache_follows_the_drug_db(monkeypatch):
+    lookups = []
+    monkeypatch.setattr(rag_controller, "get_drug_knowledge", lambda slug: lookups.append(slug) or f"facts about {slug}")
+    monkeypatch.setattr(rag_controller, "drug_db_version", lambda: "v1")
+    rag_controller._drug_knowledge.cache_clear()
+    assert rag_controller.get_cached_drug_knowledge("advil") == "facts about advil"
+    rag_controller.get_cached_drug_knowledge("advil")
+    assert lookups == ["advil"]
+
+    monkeypatch.setattr(rag_controller, "drug_db_version", lambda: "v2")
+    rag_controller.get_cached_drug_knowledge("advil")
+    assert lookups == ["advil", "advil"]
+    rag_controller._drug_knowledge.cache_clear()
+
+
+# ---------- context budget ----------
+
+def test_context_builder_keeps_latest_and_active_within_budget():
+    builder = ContextBuilder(budget=120, max_item_tokens=20)
+    years = range(2000, 2024)
+    builder.add_category("observations", "\n".join(f"{y}-01-01: Glucose = {y}mg/dL" for y in years))
+    builder.add_category("currentMedications", "Aspirin (status: stopped)\nMetformin (status: active)")
+    builder.add("label", ["• metformin (warnings):\n" + "lactic acidosis " * 50], title="--- Relevant Label Sections ---", sep="\n\n")
+    result = builder.build()
+
+    assert result.tokens == estimate_tokens(result.text) <= 120
+    lines = result.text.splitlines()
+    assert lines[0].startswith("2023-01-01")  # newest observation first
+    assert result.dropped["observations"] > 0 and "omitted" in result.text
+    # the stopped medication is the one that didn't fit
+    assert "Metformin" in result.text and "Aspirin" not in result.text
+    assert result.kept["label"] == 1 and result.truncated == 1
+    assert result.report()["budget"] == 120
+
+
+def test_context_builder_keeps_keys_aligned_when_items_are_empty():
+    builder = ContextBuilder(budget=1000)
+    builder.add("drugs", ["", "Advil facts", None, "Motrin facts"], keys=["aspirin", "advil", "tylenol", "motrin"])
+    assert builder.build().kept_keys == {"advil", "motrin"}
+
+
+def test_rag_context_stays_within_budget(monkeypatch, stub_llm):
+    import src.core.context_builder as context_builder
+
+    monkeypatch.setattr(context_builder, "CONTEXT_TOKEN_BUDGET", 25)
+    result = rag_controller.rag_inference("What allergies do I have?")
+    context = result["timings"]["context"]
+    assert context["budget"] == 25
+    assert estimate_tokens(stub_llm["retrieved_data"]) <= 25
+    assert rag_controller.pipeline_stats.stats()["context"]["avg_tokens"] is not None
+
+
+def test_drug_facts_match_brand_question_to_generic_coded_medication(monkeypatch):
+    from types import SimpleNamespace
+    from src.core.memory import PromptMemory
+
+    # FHIR codes the generic; the user asks about the brand
+    meds = [SimpleNamespace(resource={"id": "0", "code": {"text": "ibuprofen 200 MG Oral Tablet"}}),
+            SimpleNamespace(resource={"code": {"text": "metformin 500 MG"}})]
+    bundle = SimpleNamespace(medications=meds, medication_statements=[])
+    rows = [{"name": "Advil", "generic_name": "IBUPROFEN", "slug_id": "advil-pfizer"},
+            {"name": "Glucophage", "generic_name": "METFORMIN", "slug_id": "glucophage"}]
+    monkeypatch.setattr(rag_controller, "medications_bundle", lambda pid: bundle)
+    monkeypatch.setattr(rag_controller, "match_fhir_medication_list", lambda resources: rows)
+    monkeypatch.setattr(rag_controller, "label_sections", lambda prompt, names: [])
+    monkeypatch.setattr(rag_controller, "get_cached_drug_knowledge", lambda slug: f"facts about {slug}")
+
+    args = {"patient": "emily", "categories": []}
+    text = rag_controller.build_fhir_context("Can Advil cause side effects?", args, PromptMemory())
+    assert "facts about advil-pfizer" in text and "glucophage" not in text
+    text = rag_controller.build_fhir_context("Is Metformin a drug I take?", args, PromptMemory())
+    assert "facts about glucophage" in text and "advil" not in text
+
+    # matches stay aligned by position, even with an id of "0" and one without an id
+    assert rag_controller.prefetch_patient("Is Glucophage a drug I take?").matches == tuple(rows)
+
+
+def test_label_sections_only_for_medication_questions(monkeypatch):
+    from src.core.memory import PromptMemory
+
+    searched = []
+    monkeypatch.setattr(rag_controller, "label_sections", lambda prompt, names: searched.append(prompt) or [])
+    args = {"patient": rag_controller.DEFAULT_PATIENT_ID, "categories": ["currentMedications"]}
+    rag_controller.build_fhir_context("What am I taking?", args, PromptMemory())
+    assert searched == []
+    rag_controller.build_fhir_context("Any side effects from my meds?", args, PromptMemory())
+    assert searched == ["Any side effects from my meds?"]
+
+
+def test_async_pipeline_retrieves_off_the_event_loop(monkeypatch, stub_llm):
+    threads = []
+
+    def fake_context(user_prompt, args, memory, prefetched=None, timings=None):
+        threads.append(threading.current_thread())
+        return "Allergy: peanuts"
+
+    monkeypatch.setattr(rag_controller, "build_fhir_context", fake_context)
+    result = asyncio.run(rag_controller.arag_inference("What allergies do I have?"))
+    events = asyncio.run(_collect(rag_controller.arag_inference_stream("What allergies do I have?")))
+    assert result["response"] == events[-1]["response"] == "Allergy: peanuts"
+    assert len(threads) == 2 and threading.main_thread() not in threads
+
+
+async def _collect(events):
+    return [e async for e in events]
+
+
+def test_session_store_ttl_and_caps():
+    store = SessionStore(ttl=0)
+    store.get("a").remember_drug("Aspirin")
+    assert not store.get("a").already_mentioned("aspirin")  # expired, fresh session
+    assert store.stats()["expirations"] == 1
+
+    store = SessionStore(max_sessions=2)
+    for sid in ("a", "b", "c"):
+        store.get(sid)
+    assert store.stats()["sessions"] == 2 and store.stats()["evictions"] == 1
+
+    store = SessionStore(max_bytes=4096)
+    a = store.get("a")
+    a.update("q", "x" * 3000)
+    store.get("b").update("q", "y" * 3000)   # pushes "a" out
+    assert store.stats()["sessions"] == 1
+    assert store.stats()["bytes"] <= 4096
+
+
+def test_session_store_keeps_sessions_in_use():
+    store = SessionStore(max_sessions=1)
+    a = store.acquire("a")
+    store.get("b")
+    store.get("c")   # "a" is in use: "b" goes instead
+    assert store.get("a") is a and store.stats()["in_use"] == 1
+    store.release("a", a)
+    store.get("d")
+    assert store.stats()["sessions"] == 1 and store.stats()["in_use"] == 0
+
+    # a stale memory's byte count doesn't land on the session recreated under its id
+    store = SessionStore(max_bytes=4096)
+    late = store.get("a").on_resize   # a resize still in flight when "a" goes away
+    store.discard("a")
+    new = store.get("a")
+    before = store.stats()["bytes"]
+    late(10_000)
+    assert store.stats()["bytes"] == before and store.get("a") is new
+
+
+def test_recent_drugs_are_bounded():
+    memory = SessionStore().get("a")
+    for i in range(memory.max_drugs + 10):
+        memory.remember_drug(f"drug{i}")
+    assert len(memory.recent_drugs) == memory.max_drugs
+    assert memory.already_mentioned(f"drug{memory.max_drugs + 9}")
+    assert not memory.already_mentioned("drug0")
+
+
+# ---------- shared Ollama client against a stub server ----------
+
+@pytest.fixture
+def ollama_stub():
+    """Minimal /api/generate and /api/chat stand-in; `fail_first` requests answer 503."""
+    state = {"fail_first": 0, "calls": 0, "payloads": [], "paths": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            state["calls"] += 1
+            state["payloads"].append(body)
+            state["paths"].append(self.path)
+            if state["calls"] <= state["fail_first"]:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            chat = self.path == "/api/chat"
+            usage = {"prompt_eval_count": 40, "prompt_eval_duration": 2_000_000, "eval_count": 5, "eval_duration": 1_000_000}
+
+            def text(t):
+                return {"message": {"role": "assistant", "content": t}} if chat else {"response": t}
+
+            if body.get("stream"):
+                lines = [{**text(t), "done": False} for t in ("Hel", "lo")] + [{**text(""), "done": True, **usage}]
+                out = "".join(json.dumps(l) + "\n" for l in lines).encode()
+            else:
+                out = {**text("Hello"), "done": True, **usage}
+                if not chat:
+                    out["context"] = [1, 2, 3]
+                out = json.dumps(out).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    state["chat_url"] = f"http://127.0.0.1:{server.server_address[1]}/api/chat"
+    yield state
+    server.shutdown()
+
+
+def test_ollama_client_sync_and_retries(ollama_stub):
+    client = OllamaClient(url=ollama_stub["url"], retry_backoff=0)
+    ollama_stub["fail_first"] = 2
+    assert client.generate({"model": "m", "prompt": "p"})["response"] == "Hello"
+    assert [d["response"] for d in client.stream({"model": "m", "prompt": "p"})] == ["Hel", "lo", ""]
+    stats = client.stats()
+    assert stats["retries"] == 2 and stats["errors"] == 0
+    assert ollama_stub["payloads"][-1]["stream"] is True
+    client.close()
+
+
+def test_ollama_client_async(ollama_stub):
+    client = OllamaClient(url=ollama_stub["url"], retry_backoff=0)
+
+    async def run():
+        data = await client.agenerate({"model": "m", "prompt": "p"})
+        chunks = [d["response"] async for d in client.astream({"model": "m", "prompt": "p"})]
+        await client.aclose()
+        return data, chunks
+
+    data, chunks = asyncio.run(run())
+    assert data["response"] == "Hello"
+    assert chunks == ["Hel", "lo", ""]
+
+
+def test_ollama_client_gives_up_after_max_retries(ollama_stub):
+    client = OllamaClient(url=ollama_stub["url"], retry_backoff=0, max_retries=1)
+    ollama_stub["fail_first"] = 5
+    with pytest.raises(Exception):
+        client.generate({"model": "m", "prompt": "p"})
+    assert ollama_stub["calls"] == 2
+    assert client.stats()["errors"] == 1
+
+
+def test_complete_sends_static_system_prefix(ollama_stub):
+    client = OllamaClient(url=ollama_stub["url"], chat_url=ollama_stub["chat_url"], keep_alive="5m")
+    assert response_text(client.complete("SYSTEM", "question one", label="router", model="m")) == "Hello"
+    chunks = [response_text(d) for d in client.complete_stream("SYSTEM", "question two", label="router", model="m")]
+    assert chunks == ["Hel", "lo", ""]
+
+    assert ollama_stub["paths"] == ["/api/chat", "/api/chat"]
+    for payload, question in zip(ollama_stub["payloads"], ("question one", "question two")):
+        assert payload["messages"] == [
+            {"role": "system", "content": "SYSTEM"},
+            {"role": "user", "content": question},
+        ]
+        assert payload["keep_alive"] == "5m"
+
+    usage = client.stats()["usage"]["router"]
+    assert usage["calls"] == 2
+    assert usage["avg_prompt_eval_tokens"] == 40 and usage["avg_prompt_eval_ms"] == 2.0
+    client.close()
+
+
+def test_complete_context_mode_reuses_prefix(ollama_stub):
+    client = OllamaClient(url=ollama_stub["url"], chat_url=ollama_stub["chat_url"], prompt_mode="context")
+
+    async def run():
+        data = await client.acomplete("SYSTEM", "question two", label="response", model="m")
+        await client.aclose()
+        return data
+
+    client.complete("SYSTEM", "question one", label="response", model="m", options={"temperature": 0}, format="json")
+    assert response_text(asyncio.run(run())) == "Hello"
+
+    # the prefix is evaluated once, untemplated and without generating;
+    # later calls send only the suffix plus its context
+    prime, first, second = ollama_stub["payloads"]
+    assert prime["prompt"] == "SYSTEM" and "context" not in prime
+    assert prime["raw"] is True and prime["options"] == {"num_predict": 0}
+    assert first["options"] == {"temperature": 0} and first["format"] == "json"
+    assert "options" not in second and "format" not in second
+    assert first["prompt"] == "question one" and first["context"] == [1, 2, 3]
+    assert second["prompt"] == "question two" and second["context"] == [1, 2, 3]
+    assert set(ollama_stub["paths"]) == {"/api/generate"}
+    assert client.stats()["usage"]["prefix"]["calls"] == 1
+    client.close()
+
+
+# ---------- LLM scheduler ----------
+
+def _occupy(scheduler, release):
+    """Hold one slot from another thread until `release` is set."""
+    held = threading.Event()
+
+    def hold():
+        with scheduler.slot():
+            held.set()
+            release.wait(5)
+
+    t = threading.Thread(target=hold)
+    t.start()
+    held.wait(5)
+    return t
+
+
+def test_scheduler_admits_router_calls_first():
+    scheduler = LLMScheduler(max_inflight=1, max_queue=8, queue_timeout=5)
+    release, order = threading.Event(), []
+    holder = _occupy(scheduler, release)
+
+    def call(label, priority):
+        scheduler.run(lambda: order.append(label), priority)
+
+    waiters = [threading.Thread(target=call, args=("response", 1)), threading.Thread(target=call, args=("router", 0))]
+    for t in waiters:
+        t.start()
+        while scheduler.stats()["queued"] < waiters.index(t) + 1:
+            time.sleep(0.005)
+    release.set()
+    for t in [holder, *waiters]:
+        t.join(5)
+
+    assert order == ["router", "response"]
+    stats = scheduler.stats()
+    assert stats["admitted"] == 3 and stats["inflight"] == 0 and stats["queued"] == 0
+    assert stats["max_wait_ms"] > 0
+
+
+def test_scheduler_rejects_when_full_and_times_out():
+    scheduler = LLMScheduler(max_inflight=1, max_queue=0, queue_timeout=0.05)
+    release = threading.Event()
+    holder = _occupy(scheduler, release)
+    assert scheduler.saturated()
+    with pytest.raises(SchedulerBusy) as busy:
+        scheduler.run(lambda: None)
+    assert busy.value.status == 429 and busy.value.retry_after >= 1
+
+    scheduler.max_queue = 1
+    with pytest.raises(SchedulerBusy) as busy:
+        asyncio.run(_aslot_once(scheduler))
+    assert busy.value.status == 503
+    release.set()
+    holder.join(5)
+    assert scheduler.stats()["rejected"] == 1 and scheduler.stats()["timed_out"] == 1
+    assert scheduler.stats()["inflight"] == 0
+
+
+async def _aslot_once(scheduler):
+    async with scheduler.aslot():
+        pass
+
+
+def test_scheduler_single_flight_dedupes_identical_calls():
+    scheduler = LLMScheduler(max_inflight=2)
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"response": "Hello"}
+
+    async def run():
+        return await asyncio.gather(*(scheduler.arun(generate, key="same") for _ in range(3)))
+
+    assert asyncio.run(run()) == [{"response": "Hello"}] * 3
+    assert len(calls) == 1
+    assert scheduler.stats()["deduped"] == 2
+
+
+def test_scheduler_single_flight_survives_a_cancelled_follower():
+    scheduler = LLMScheduler(max_inflight=2)
+
+    async def generate():
+        await asyncio.sleep(0.05)
+        return "Hello"
+
+    async def run():
+        leader = asyncio.ensure_future(scheduler.arun(generate, key="same"))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(scheduler.arun(generate, key="same")) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        followers[0].cancel()
+        return await asyncio.gather(leader, followers[1], followers[0], return_exceptions=True)
+
+    leader, follower, cancelled = asyncio.run(run())
+    assert leader == follower == "Hello"
+    assert isinstance(cancelled, asyncio.CancelledError)
+
+
+def test_scheduler_single_flight_survives_a_cancelled_leader():
+    scheduler = LLMScheduler(max_inflight=2)
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "Hello"
+
+    async def run():
+        leader = asyncio.ensure_future(scheduler.arun(generate, key="same"))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(scheduler.arun(generate, key="same"))
+        await asyncio.sleep(0.01)
+        leader.cancel()   # e.g. its HTTP client disconnected
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader, follower = asyncio.run(run())
+    assert isinstance(leader, asyncio.CancelledError)
+    assert follower == "Hello" and len(calls) == 2   # the follower took over
+
+
+def test_scheduler_sheds_shadow_calls_instead_of_queueing():
+    from src.llm.scheduler import priority_for
+
+    scheduler = LLMScheduler(max_inflight=1, max_queue=1, queue_timeout=5)
+    release = threading.Event()
+    holder = _occupy(scheduler, release)
+    with pytest.raises(SchedulerBusy):
+        scheduler.run(lambda: None, priority_for("shadow"))
+    stats = scheduler.stats()
+    assert stats["shed"] == 1 and stats["queued"] == 0 and stats["rejected"] == 0
+    assert not scheduler.saturated()
+    release.set()
+    holder.join(5)
+    assert scheduler.run(lambda: "ran", priority_for("shadow")) == "ran"
+
+
+def test_ask_returns_429_with_retry_after_when_saturated(monkeypatch):
+    from src.llm.model_runner import get_client
+
+    monkeypatch.setattr(get_client().scheduler, "saturated", lambda: True)
+    resp = TestClient(app).post("/ask", json={"prompt": "What allergies do I have?"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert resp.json()["retry_after"] >= 1
+
+
+# ---------- fast-path router ----------
+
+@pytest.fixture
+def fast_router(monkeypatch):
+    router = FastRouter.train([
+        ("What is my current metformin dosage?", {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}),
+        ("How often do I need to take ibuprofen?", {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}),
+        ("What allergies do I have?", {"function": FUNCTION_FHIR, "arguments": {"categories": ["allergies"]}}),
+        ("Tell me about the drug lisinopril", {"function": FUNCTION_DRUG, "arguments": {}}),
+    ])
+    monkeypatch.setattr(prompt_router, "get_fast_router", lambda: router)
+    monkeypatch.setattr(prompt_router, "router_cache", RouterCache(maxsize=0))
+    llm_calls = []
+
+    def fake_llm(prompt, label="router"):
+        llm_calls.append(prompt)
+        return {"function": FUNCTION_FHIR, "arguments": {"patient": "emily", "categories": ["conditions"]}}
+
+    monkeypatch.setattr(prompt_router, "route_with_llm", fake_llm)
+    return router, llm_calls
+
+
+def test_fast_router_answers_confident_prompts_locally(fast_router):
+    router, llm_calls = fast_router
+    route = prompt_router.route_prompt("what is my current metformin dosage")
+    assert route["function"] == FUNCTION_FHIR
+    assert route["arguments"]["categories"] == ["currentMedications"]
+    assert route["arguments"]["patient"] == prompt_router.DEFAULT_PATIENT_ID
+    assert llm_calls == []
+    assert router.stats()["hits"] == 1
+
+
+def test_fast_router_falls_back_and_tracks_agreement(fast_router):
+    router, llm_calls = fast_router
+    route = prompt_router.route_prompt("Show me my active conditions.")
+    assert route["arguments"]["categories"] == ["conditions"]
+    assert llm_calls == ["Show me my active conditions."]
+    stats = router.stats()
+    assert stats["fallbacks"] == 1 and stats["compared_with_llm"] == 1
+    assert stats["agreement"] == 0.0
+
+
+def test_fast_router_shadow_call_is_off_the_critical_path(fast_router, monkeypatch):
+    router, llm_calls = fast_router
+    release = threading.Event()
+
+    def slow_llm(prompt, label="router"):
+        release.wait(5)
+        llm_calls.append(label)
+        return {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}
+
+    monkeypatch.setattr(prompt_router, "route_with_llm", slow_llm)
+    monkeypatch.setattr(prompt_router, "FAST_ROUTER_SHADOW_RATE", 1.0)
+    route = prompt_router.route_prompt("what is my current metformin dosage")
+    assert route["arguments"]["categories"] == ["currentMedications"]
+    assert llm_calls == []   # returned before the shadow call finished
+    release.set()
+    prompt_router._shadow_pool.submit(lambda: None).result(5)   # drain the shadow worker
+    assert llm_calls == ["shadow"]
+    assert router.stats()["compared_with_llm"] == 1
+
+
+def test_fast_router_never_answers_drug_route_locally(fast_router):
+    router, llm_calls = fast_router
+    prompt_router.route_prompt("Tell me about the drug lisinopril")
+    assert len(llm_calls) == 1
+
+
+def test_fast_router_with_one_label_is_never_confident():
+    router = FastRouter.train([
+        ("What is my current metformin dosage?", {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}),
+        ("Which medications am I currently taking?", {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}),
+    ])
+    pred = router.predict("What is my current metformin dosage?", patient="emily")
+    assert pred.confidence > router.threshold and not pred.confident
+
+
+def test_fast_router_artifact_round_trip(tmp_path, fast_router):
+    router, _ = fast_router
+    path = tmp_path / "fast_router.json"
+    router.save(str(path))
+    loaded = FastRouter.load(str(path))
+    prompt = "Do I need to take ibuprofen with food?"
+    assert loaded.predict(prompt, "emily").route == router.predict(prompt, "emily").route
+
+
+# ---------- router decision cache ----------
+
+@pytest.fixture
+def router_cache(monkeypatch, fast_router):
+    cache = RouterCache(near_dup_functions=(FUNCTION_FHIR,), near_dup_terms=prompt_router.route_terms)
+    monkeypatch.setattr(prompt_router, "router_cache", cache)
+    monkeypatch.setattr(prompt_router, "get_fast_router", lambda: None)
+    return cache, fast_router[1]
+
+
+def test_router_cache_hits_normalized_prompt(router_cache):
+    cache, llm_calls = router_cache
+    first = prompt_router.route_prompt("Show me my active conditions.")
+    first["arguments"]["categories"].append("mutated")
+    again = prompt_router.route_prompt("  show me my ACTIVE conditions ")
+    assert again["arguments"]["categories"] == ["conditions"]
+    assert len(llm_calls) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_router_cache_near_duplicates_only_for_fhir_route():
+    cache = RouterCache(near_dup=True, near_dup_functions=(FUNCTION_FHIR,), near_dup_terms=prompt_router.route_terms)
+    fhir = {"function": FUNCTION_FHIR, "arguments": {"categories": ["currentMedications"]}}
+    drug = {"function": FUNCTION_DRUG, "arguments": {"drug_name": "lisinopril"}}
+    cache.put("what meds am I taking", "emily", "fp", fhir)
+    cache.put("tell me about lisinopril", "emily", "fp", drug)
+
+    assert cache.get("What meds am I taking now?", "emily", "fp") == fhir
+    assert cache.get("tell me about lisinoprill", "emily", "fp") is None
+    assert cache.get("What meds am I taking now?", "other", "fp") is None
+    assert cache.stats()["near_hits"] == 1
+    assert not RouterCache().near_dup  # opt-in
+
+
+def test_router_cache_near_duplicates_need_the_same_categories_and_patient():
+    cache = RouterCache(near_dup=True, near_dup_functions=(FUNCTION_FHIR,), near_dup_terms=prompt_router.route_terms)
+    prefix = "could you please tell me what the patient's most recent "
+    observations = {"function": FUNCTION_FHIR, "arguments": {"patient": "emily", "categories": ["observations"]}}
+    cache.put(prefix + "lab results are", "emily", "fp", observations)
+    assert cache.get(prefix + "lab results are now", "emily", "fp") == observations
+    assert cache.get(prefix + "allergies are", "emily", "fp") is None
+
+    question = "can you please tell me what current medications the patient {} is taking right now"
+    maria = {"function": FUNCTION_FHIR, "arguments": {"patient": "maria", "categories": ["currentMedications"]}}
+    cache.put(question.format("maria"), "emily", "fp", maria)
+    assert cache.get(question.format("emily"), "emily", "fp") is None
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_router_cache_expires_and_invalidates(monkeypatch, router_cache):
+    _, llm_calls = router_cache
+    cache = RouterCache(ttl=0)
+    route = {"function": FUNCTION_FHIR, "arguments": {}}
+    cache.put("any allergies?", "emily", "fp", route)
+    assert cache.get("any allergies?", "emily", "fp") is None
+    assert cache.stats()["expirations"] == 1
+
+    prompt_router.route_prompt("Show me my active conditions.")
+    monkeypatch.setattr(prompt_router, "ALLOWED_CATEGORIES", prompt_router.ALLOWED_CATEGORIES + ["immunizations"])
+    prompt_router.route_prompt("Show me my active conditions.")
+    assert len(llm_calls) == 2
+    assert prompt_router.router_cache.stats()["invalidations"] == 1
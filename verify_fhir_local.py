@@ -6,7 +6,7 @@ from src.core.summarizer        import summarize_fhir_bundle
 
 def main():
     # Load the entire patient bundle
-    path   = build_query([], {"patient": "emily"})
+    path   = build_query([], {"patient": "emily"}).path
     bundle = fetch_fhir_resources(path)
     print("\n=== Summary for emily ===\n")
     print(summarize_fhir_bundle(bundle))